@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class AccountsConfig(AppConfig):
     name = 'accounts'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from accounts.models import Activation
+        from accounts.resolver import clear_address_cache
+
+        for model in (User, Activation):
+            signals.post_save.connect(clear_address_cache, sender=model,
+                dispatch_uid='accounts_address_cache_save_%s' % model.__name__)
+            signals.post_delete.connect(clear_address_cache, sender=model,
+                dispatch_uid='accounts_address_cache_delete_%s' % model.__name__)
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activation',
+            name='peppolID',
+            field=models.CharField(blank=True, db_index=True, max_length=20, null=True),
+        ),
+        migrations.AlterField(
+            model_name='activation',
+            name='webID',
+            field=models.URLField(blank=True, db_index=True),
+        ),
+    ]
@@ -7,5 +7,5 @@ class Activation(models.Model):
     created_at  = models.DateTimeField(auto_now_add=True)
     code        = models.CharField(max_length=20, unique=True)
     email       = models.EmailField(blank=True)
-    webID       = models.URLField(blank=True)
-    peppolID    = models.CharField(max_length=20, blank=True, null=True)
+    webID       = models.URLField(blank=True, db_index=True)
+    peppolID    = models.CharField(max_length=20, blank=True, null=True, db_index=True)
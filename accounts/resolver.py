@@ -0,0 +1,160 @@
+import hashlib
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+
+WEBID = 'webID'
+PEPPOLID = 'peppolID'
+USERNAME = 'username'
+
+# lower wins when one address matches more than one identifier type
+MATCH_PRIORITY = (WEBID, PEPPOLID, USERNAME)
+
+ADDRESS_CACHE_TTL = getattr(settings, 'ACCOUNTS_ADDRESS_CACHE_TTL', 300)
+
+# resolved addresses live in the shared cache under a generation that any
+# change to a user or an activation bumps, so every worker sees it at once
+GENERATION_KEY = 'accounts-addr-gen'
+
+ResolvedAddress = namedtuple('ResolvedAddress', ['user', 'kind'])
+
+
+def _new_generation():
+    # start from the clock, an evicted generation never comes back to a
+    # number that stale entries are still stored under
+    return int(time.time() * 1000)
+
+
+def _address_key(address, generation):
+    return 'accounts-addr-%s-%s' % (generation, hashlib.md5(address.encode('utf-8')).hexdigest())
+
+
+def _cache_generation():
+    return cache.get_or_set(GENERATION_KEY, _new_generation, None)
+
+
+def resolve_address(address, use_cache=True):
+    """
+    Resolves a WebID, PeppolID or username to a user in a single query.
+    Returns a ``ResolvedAddress(user, kind)`` where ``kind`` is one of
+    ``WEBID``, ``PEPPOLID`` or ``USERNAME``, or ``None`` if nothing matches.
+    """
+    address = (address or '').strip()
+    if not address:
+        return None
+
+    if use_cache:
+        key = _address_key(address, _cache_generation())
+        resolved = cache.get(key)
+        if resolved is not None:
+            return resolved
+
+    priority = Case(
+        When(activation__webID=address, then=Value(0)),
+        When(activation__peppolID=address, then=Value(1)),
+        default=Value(2),
+        output_field=IntegerField(),
+    )
+    user = (
+        User.objects.filter(
+            Q(activation__webID=address)
+            | Q(activation__peppolID=address)
+            | Q(username=address)
+        )
+        .annotate(match_priority=priority)
+        .order_by('match_priority', 'pk')
+        .first()
+    )
+    if user is None:
+        return None
+
+    resolved = ResolvedAddress(user, MATCH_PRIORITY[user.match_priority])
+    if use_cache:
+        cache.set(key, resolved, ADDRESS_CACHE_TTL)
+    return resolved
+
+
+def resolve_addresses(addresses, use_cache=True):
+    """
+    Set based version of ``resolve_address``. Resolves every address with
+    one query and returns a dict mapping each address that matched to its
+    ``ResolvedAddress``. Addresses that match nothing are left out.
+    """
+    addresses = {(address or '').strip() for address in addresses} - {''}
+    resolved = {}
+    if use_cache:
+        generation = _cache_generation()
+        keys = {_address_key(address, generation): address for address in addresses}
+        for key, hit in cache.get_many(keys).items():
+            resolved[keys[key]] = hit
+    missing = addresses - set(resolved)
+
+    if not missing:
+        return resolved
+
+    users = (
+        User.objects.filter(
+            Q(activation__webID__in=missing)
+            | Q(activation__peppolID__in=missing)
+            | Q(username__in=missing)
+        )
+        .annotate(
+            matched_webid=F('activation__webID'),
+            matched_peppolid=F('activation__peppolID'),
+        )
+        .order_by('pk')
+    )
+    ranked = {}
+    for user in users:
+        candidates = (
+            (0, user.matched_webid),
+            (1, user.matched_peppolid),
+            (2, user.username),
+        )
+        for priority, address in candidates:
+            if address in missing and priority < ranked.get(address, (3,))[0]:
+                ranked[address] = (priority, user)
+
+    found = {}
+    for address, (priority, user) in ranked.items():
+        found[address] = ResolvedAddress(user, MATCH_PRIORITY[priority])
+    resolved.update(found)
+    if use_cache and found:
+        cache.set_many(
+            {_address_key(address, generation): hit for address, hit in found.items()},
+            ADDRESS_CACHE_TTL,
+        )
+    return resolved
+
+
+def resolve_user(address, use_cache=True):
+    """
+    Shortcut for callers that only need the user.
+    """
+    resolved = resolve_address(address, use_cache=use_cache)
+    if resolved is None:
+        return None
+    return resolved.user
+
+
+def clear_address_cache(sender=None, update_fields=None, **kwargs):
+    """
+    Signal receiver, any change to a user or an activation may move an
+    address to another user so we start a new generation once the change
+    commits. Logins only touch ``last_login`` and are skipped.
+    """
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+
+    def bump():
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            cache.set(GENERATION_KEY, _new_generation(), None)
+
+    transaction.on_commit(bump)
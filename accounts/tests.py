@@ -0,0 +1,49 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from accounts.models import Activation
+from accounts.resolver import PEPPOLID, USERNAME, WEBID, resolve_address, resolve_addresses
+
+
+class ResolverTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        Activation.objects.create(user=self.bob, code='b', webID='https://bob.example/#me', peppolID='0088:bob')
+
+    def test_priority(self):
+        # bob's PeppolID beats a user literally named like it
+        User.objects.create(username='0088:bob')
+        self.assertEqual(resolve_address('0088:bob'), (self.bob, PEPPOLID))
+        self.assertEqual(resolve_address(' https://bob.example/#me '), (self.bob, WEBID))
+        self.assertEqual(resolve_address('alice'), (self.alice, USERNAME))
+        self.assertIsNone(resolve_address('nobody'))
+
+    def test_cached(self):
+        resolve_address('alice')
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_address('alice').user, self.alice)
+        with self.assertNumQueries(1):
+            resolved = resolve_addresses(['alice', '0088:bob', 'nobody', ''])
+        self.assertEqual(resolved, {'alice': (self.alice, USERNAME), '0088:bob': (self.bob, PEPPOLID)})
+        with self.assertNumQueries(0):
+            resolve_addresses(['alice', '0088:bob'])
+
+    def test_changes_clear_the_cache(self):
+        resolve_address('alice')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.username = 'carol'
+            self.alice.save()
+        self.assertIsNone(resolve_address('alice'))
+
+    def test_logins_keep_the_cache(self):
+        resolve_address('alice')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.last_login = timezone.now()
+            self.alice.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            resolve_address('alice')
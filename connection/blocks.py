@@ -0,0 +1,82 @@
+"""
+Block checks for the send path.
+
+Every user has one cached set of the users they block or are blocked by,
+so a single lookup answers both directions. Large sets are fronted by a
+Bloom filter stored under the user's ``blocks`` key: most checks are
+negative and only need those few bytes, the full pk array is fetched
+when the filter says the pk may be in there. Both live under the user's
+cache generation, which ``add_block``/``remove_block`` bump.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
+from connection.exceptions import BlockedError
+from connection.models import Block, cache_generation, cache_key, cached_pks
+from connection.pksets import BloomFilter, UserPkSet, _pk
+
+# sets larger than this are checked through a Bloom filter first
+BLOOM_THRESHOLD = getattr(settings, "CONNECTION_BLOCK_BLOOM_THRESHOLD", 1024)
+
+
+def _other_pks(user_pk):
+    qs = Block.objects.filter(Q(blocker_id=user_pk) | Q(blocked_id=user_pk))
+    return (
+        blocked if blocker == user_pk else blocker
+        for blocker, blocked in qs.values_list("blocker_id", "blocked_id")
+    )
+
+
+def _block_set(user_pk, generation, packed):
+    if BloomFilter.unpack(packed) is not None:
+        return cached_pks("block_pks", user_pk, _other_pks(user_pk))
+
+    pks = UserPkSet.unpack(packed)
+    if pks is None:
+        pks = UserPkSet(_other_pks(user_pk))
+        if len(pks) > BLOOM_THRESHOLD:
+            cache.set_many(
+                {
+                    cache_key("blocks", user_pk, generation): BloomFilter(pks.pks).pack(),
+                    cache_key("block_pks", user_pk, generation): pks.pack(),
+                }
+            )
+        else:
+            cache.set(cache_key("blocks", user_pk, generation), pks.pack())
+    return pks
+
+
+def block_set(user):
+    """
+    Return the ``UserPkSet`` of everyone user blocks or is blocked by
+    """
+    user_pk = _pk(user)
+    generation = cache_generation(user_pk)
+    return _block_set(user_pk, generation, cache.get(cache_key("blocks", user_pk, generation)))
+
+
+def is_blocked(user1, user2):
+    """
+    Has either user blocked the other? Two cache reads and no query once
+    the cache is warm.
+    """
+    user_pk = _pk(user1)
+    generation = cache_generation(user_pk)
+    packed = cache.get(cache_key("blocks", user_pk, generation))
+
+    bloom = BloomFilter.unpack(packed)
+    if bloom is not None and user2 not in bloom:
+        return False
+    return user2 in _block_set(user_pk, generation, packed)
+
+
+def check_not_blocked(sender, recipient):
+    """
+    Raise ``BlockedError`` if sender and recipient have blocked each other
+    """
+    if is_blocked(sender, recipient):
+        raise BlockedError(_("You can't contact this user."))
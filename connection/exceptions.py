@@ -6,3 +6,6 @@ class AlreadyExistsError(IntegrityError):
 
 class ValidationError(IntegrityError):
     pass
+
+class BlockedError(IntegrityError):
+    pass
@@ -0,0 +1,482 @@
+"""
+Read only snapshot of the contact and follow graphs, for partner
+suggestions and mutual connection counts that are too slow as joins.
+
+Each graph is stored in CSR form: ``indptr[pk]:indptr[pk + 1]`` is the
+range of ``indices`` holding the sorted pks a user points at, with a
+parallel ``roles`` array of ``SUPPLIER``/``COSTUMER`` bits for contacts.
+Row numbers are user pks. The arrays are written as ``.npy`` files into a
+new directory under ``CONNECTION_GRAPH_DIR`` which is then published by
+replacing the ``CURRENT`` file, readers memory map them so all workers on
+a host share one copy in the page cache.
+
+With numpy installed the queries are vectorized, without it the same
+files are mapped through ``memoryview`` and answered in plain Python.
+
+``update_snapshot`` is run on a schedule by the ``build_connection_graph``
+command. When rows were only added since the last build it merges the new
+edges into the previous snapshot, otherwise it streams the whole table.
+"""
+from __future__ import unicode_literals
+
+import ast
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db.models import Count, Max, Q, Sum
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from connection.models import Contact, Follow
+from connection.pksets import _pk
+
+GRAPH_DIR = getattr(
+    settings,
+    "CONNECTION_GRAPH_DIR",
+    os.path.join(tempfile.gettempdir(), "connection-graph"),
+)
+CHUNK_SIZE = 10000
+KEEP_BUILDS = 2
+
+CONTACTS = "contacts"
+FOLLOWS = "follows"
+
+# role bits of a contact edge, from_user -> to_user
+SUPPLIER = 1
+COSTUMER = 2
+
+NPY_MAGIC = b"\x93NUMPY"
+# array type code to .npy dtype, little endian
+DESCR = {"q": "<i8", "i": "<i4", "B": "|u1"}
+
+
+def write_npy(path, values):
+    """
+    Write an ``array.array`` as a version 1.0 ``.npy`` file, which numpy
+    can load without being installed here
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        DESCR[values.typecode],
+        len(values),
+    )
+    # numpy aligns the data on 64 bytes
+    header += " " * (-(len(NPY_MAGIC) + 4 + len(header) + 1) % 64) + "\n"
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, "wb") as f:
+        f.write(NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(header)))
+        f.write(header.encode("latin1"))
+        values.tofile(f)
+
+
+def load_npy(path):
+    """
+    Memory map a ``.npy`` file written by ``write_npy``, as a numpy array
+    or, without numpy, a ``memoryview`` of the array's type code
+    """
+    if numpy is not None:
+        return numpy.load(path, mmap_mode="r")
+
+    with open(path, "rb") as f:
+        f.seek(len(NPY_MAGIC) + 2)
+        (length,) = struct.unpack("<H", f.read(2))
+        header = ast.literal_eval(f.read(length).decode("latin1"))
+        typecode = {descr: code for code, descr in DESCR.items()}[header["descr"]]
+        if not header["shape"][0]:
+            return array(typecode)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(data)[len(NPY_MAGIC) + 4 + length :].cast(typecode)
+
+
+def _raw(values, start=None, end=None):
+    # bytes of a slice of an array, memoryview or numpy array
+    return bytes(values[start:end])
+
+
+class Graph(object):
+    """ One CSR adjacency, rows and columns are user pks """
+
+    def __init__(self, indptr, indices, roles=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.roles = roles
+
+    @property
+    def nodes(self):
+        return len(self.indptr) - 1
+
+    @property
+    def edges(self):
+        return len(self.indices)
+
+    def _range(self, pk):
+        if 0 <= pk < self.nodes:
+            return int(self.indptr[pk]), int(self.indptr[pk + 1])
+        return 0, 0
+
+    def degree(self, user):
+        start, end = self._range(_pk(user))
+        return end - start
+
+    def neighbors(self, user, role=None):
+        """
+        Sorted pks the user points at, only through edges having any of
+        the role bits if given
+        """
+        start, end = self._range(_pk(user))
+        if numpy is not None:
+            found = self.indices[start:end]
+            if role is not None:
+                found = found[(self.roles[start:end] & role) != 0]
+            return found
+        if role is None:
+            return list(self.indices[start:end])
+        return [
+            pk
+            for pk, bits in zip(self.indices[start:end], self.roles[start:end])
+            if bits & role
+        ]
+
+    def _gather(self, rows, role=None):
+        # numpy only, the neighbors of all rows concatenated and the
+        # position in rows each of them came from
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        rows = rows[(rows >= 0) & (rows < self.nodes)]
+        starts = numpy.asarray(self.indptr[rows], dtype=numpy.int64)
+        lengths = numpy.asarray(self.indptr[rows + 1], dtype=numpy.int64) - starts
+        total = int(lengths.sum())
+        offsets = numpy.cumsum(lengths) - lengths
+        positions = numpy.repeat(starts - offsets, lengths) + numpy.arange(total)
+        owners = numpy.repeat(numpy.arange(len(rows)), lengths)
+        found = self.indices[positions]
+        if role is not None:
+            keep = (self.roles[positions] & role) != 0
+            found, owners = found[keep], owners[keep]
+        return rows, found, owners
+
+    def mutual_counts(self, user, others):
+        """
+        Return a dict of pk to the number of neighbors it shares with user
+        """
+        others = [_pk(other) for other in others]
+        if numpy is not None:
+            mask = numpy.zeros(self.nodes + 1, dtype=bool)
+            mask[self.neighbors(user)] = True
+            counts = dict.fromkeys(others, 0)
+            rows, found, owners = self._gather(others)
+            shared = numpy.bincount(owners, weights=mask[found], minlength=len(rows))
+            counts.update(zip(rows.tolist(), shared.astype(numpy.int64).tolist()))
+            return counts
+
+        mine = set(self.neighbors(user))
+        return {
+            other: sum(1 for pk in self.neighbors(other) if pk in mine) for other in others
+        }
+
+    def suggestions(self, user, limit=10, role=None):
+        """
+        Users two hops away that user doesn't point at yet, as a list of
+        ``(pk, paths)`` with the most paths first. With a role only edges
+        having it are followed, e.g. ``SUPPLIER`` gives the suppliers of
+        my suppliers.
+        """
+        user_pk = _pk(user)
+        first = self.neighbors(user_pk, role)
+        if numpy is not None:
+            rows, found, owners = self._gather(first, role)
+            found = found[(found != user_pk) & ~numpy.isin(found, first)]
+            pks, paths = numpy.unique(found, return_counts=True)
+            order = numpy.lexsort((pks, -paths))[:limit]
+            return list(zip(pks[order].tolist(), paths[order].tolist()))
+
+        known = set(first)
+        paths = Counter()
+        for pk in first:
+            paths.update(
+                other
+                for other in self.neighbors(pk, role)
+                if other != user_pk and other not in known
+            )
+        return sorted(paths.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def degree_stats(self):
+        """ Out-degree statistics over users with at least one edge """
+        if numpy is not None:
+            degrees = numpy.diff(numpy.asarray(self.indptr, dtype=numpy.int64))
+            degrees = degrees[degrees > 0]
+            if not len(degrees):
+                return {"users": 0, "edges": 0}
+            return {
+                "users": int(len(degrees)),
+                "edges": int(degrees.sum()),
+                "mean": float(degrees.mean()),
+                "median": float(numpy.median(degrees)),
+                "p99": float(numpy.percentile(degrees, 99)),
+                "max": int(degrees.max()),
+            }
+
+        degrees = sorted(
+            d for d in (self.indptr[i + 1] - self.indptr[i] for i in range(self.nodes)) if d
+        )
+        if not degrees:
+            return {"users": 0, "edges": 0}
+        middle = len(degrees) // 2
+        return {
+            "users": len(degrees),
+            "edges": sum(degrees),
+            "mean": sum(degrees) / float(len(degrees)),
+            "median": float(
+                degrees[middle]
+                if len(degrees) % 2
+                else (degrees[middle - 1] + degrees[middle]) / 2.0
+            ),
+            "p99": float(degrees[min(len(degrees) - 1, int(len(degrees) * 0.99))]),
+            "max": degrees[-1],
+        }
+
+
+class Snapshot(object):
+    """ The graphs of one published build """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.graphs = {
+            name: Graph(*[self._load(name, part) for part in ("indptr", "indices", "roles")])
+            for name in (CONTACTS, FOLLOWS)
+        }
+
+    def _load(self, name, part):
+        filename = os.path.join(self.path, "%s.%s.npy" % (name, part))
+        return load_npy(filename) if os.path.exists(filename) else None
+
+    @property
+    def contacts(self):
+        return self.graphs[CONTACTS]
+
+    @property
+    def follows(self):
+        return self.graphs[FOLLOWS]
+
+
+_snapshot = None
+_snapshot_build = None
+
+
+def _current_build(graph_dir=GRAPH_DIR):
+    try:
+        with open(os.path.join(graph_dir, "CURRENT")) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def get_snapshot(graph_dir=GRAPH_DIR):
+    """
+    Return the published ``Snapshot``, reopened when a newer build was
+    published, or None if nothing was built yet
+    """
+    global _snapshot, _snapshot_build
+    build = _current_build(graph_dir)
+    if build is None:
+        return None
+    path = os.path.join(graph_dir, build)
+    if path != _snapshot_build:
+        _snapshot = Snapshot(path)
+        _snapshot_build = path
+    return _snapshot
+
+
+def _contact_rows(qs):
+    for from_pk, to_pk, is_supplier, is_costumer in qs.values_list(
+        "from_user_id", "to_user_id", "is_supplier", "is_costumer"
+    ).iterator(chunk_size=CHUNK_SIZE):
+        yield from_pk, to_pk, (SUPPLIER if is_supplier else 0) | (COSTUMER if is_costumer else 0)
+
+
+def _follow_rows(qs):
+    for follower_pk, followee_pk in qs.values_list("follower_id", "followee_id").iterator(
+        chunk_size=CHUNK_SIZE
+    ):
+        yield follower_pk, followee_pk, 0
+
+
+SOURCES = {
+    CONTACTS: (Contact, ("from_user_id", "to_user_id"), _contact_rows, True),
+    FOLLOWS: (Follow, ("follower_id", "followee_id"), _follow_rows, False),
+}
+
+
+def signature(name, qs=None):
+    """
+    Aggregates that tell whether a table changed since a build. The sums
+    of the ids having a role catch a role moving between existing rows,
+    which leaves the counts as they were.
+    """
+    if qs is None:
+        qs = SOURCES[name][0].objects.all()
+    aggregates = {"max_id": Max("id"), "count": Count("id")}
+    if name == CONTACTS:
+        aggregates["suppliers"] = Count("id", filter=Q(is_supplier=True))
+        aggregates["costumers"] = Count("id", filter=Q(is_costumer=True))
+        aggregates["supplier_ids"] = Sum("id", filter=Q(is_supplier=True))
+        aggregates["costumer_ids"] = Sum("id", filter=Q(is_costumer=True))
+    return {key: value or 0 for key, value in qs.aggregate(**aggregates).items()}
+
+
+def build_csr(rows, with_roles):
+    """
+    Build ``(indptr, indices, roles)`` from ``(src, dst, role)`` rows
+    sorted by src and dst, in one pass
+    """
+    indptr = array("q", [0])
+    indices = array("i")
+    roles = array("B")
+    nodes = 0
+    for src, dst, role in rows:
+        while len(indptr) <= src:
+            indptr.append(len(indices))
+        indices.append(dst)
+        if with_roles:
+            roles.append(role)
+        nodes = max(nodes, src + 1, dst + 1)
+    while len(indptr) <= nodes:
+        indptr.append(len(indices))
+    return indptr, indices, roles if with_roles else None
+
+
+def merge_csr(graph, rows, with_roles):
+    """
+    Return the arrays of graph with the new ``(src, dst, role)`` rows
+    added, copying the untouched ranges in bulk
+    """
+    added = defaultdict(list)
+    nodes = graph.nodes
+    for src, dst, role in rows:
+        added[src].append((dst, role))
+        nodes = max(nodes, src + 1, dst + 1)
+
+    old_end = int(graph.indptr[-1])
+
+    def old_start(pk):
+        return int(graph.indptr[pk]) if pk <= graph.nodes else old_end
+
+    indices = array("i")
+    roles = array("B")
+    copied = 0
+    for src in sorted(added):
+        start, end = old_start(src), old_start(src + 1)
+        indices.frombytes(_raw(graph.indices, copied, start))
+        if with_roles:
+            roles.frombytes(_raw(graph.roles, copied, start))
+            row = list(zip(graph.indices[start:end], graph.roles[start:end]))
+        else:
+            row = [(pk, 0) for pk in graph.indices[start:end]]
+        for dst, role in sorted(row + added[src]):
+            indices.append(int(dst))
+            if with_roles:
+                roles.append(int(role))
+        copied = end
+    indices.frombytes(_raw(graph.indices, copied, None))
+    if with_roles:
+        roles.frombytes(_raw(graph.roles, copied, None))
+
+    indptr = array("q", [0])
+    shift = 0
+    for pk in range(nodes):
+        shift += len(added.get(pk, ()))
+        indptr.append(old_start(pk + 1) + shift)
+    return indptr, indices, roles if with_roles else None
+
+
+def update_snapshot(full=False, graph_dir=GRAPH_DIR):
+    """
+    Build and publish a new snapshot if the tables changed since the
+    current one. Returns the new build's meta, or None if nothing changed.
+    """
+    previous = get_snapshot(graph_dir)
+    signatures = {name: signature(name) for name in SOURCES}
+    if not full and previous is not None and previous.meta["tables"] == signatures:
+        return None
+
+    os.makedirs(graph_dir, exist_ok=True)
+    path = tempfile.mkdtemp(prefix="%d-" % (time.time() * 1000), dir=graph_dir)
+    build = os.path.basename(path)
+    os.chmod(path, 0o755)
+    meta = {"built_at": time.time(), "tables": signatures, "incremental": []}
+
+    for name, (model, order, rows, with_roles) in SOURCES.items():
+        qs = model.objects.order_by(*order)
+        old = previous.meta["tables"][name] if previous is not None else None
+        new = signatures[name]
+        arrays = None
+        if not full and old is not None and old["max_id"] and old.keys() == new.keys():
+            # the table is the previous one plus the rows after max_id only
+            # if the old aggregates and those of the new rows add up
+            qs_new = qs.filter(id__gt=old["max_id"])
+            added = signature(name, qs_new)
+            expected = {key: old[key] + added[key] for key in old}
+            expected["max_id"] = added["max_id"] or old["max_id"]
+            if expected == new:
+                arrays = merge_csr(previous.graphs[name], rows(qs_new), with_roles)
+                meta["incremental"].append(name)
+        if arrays is None:
+            arrays = build_csr(rows(qs), with_roles)
+        for part, values in zip(("indptr", "indices", "roles"), arrays):
+            if values is not None:
+                write_npy(os.path.join(path, "%s.%s.npy" % (name, part)), values)
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    current = os.path.join(graph_dir, "CURRENT")
+    with open(current + ".tmp", "w") as f:
+        f.write(build)
+    os.replace(current + ".tmp", current)
+
+    # mapped files stay readable after unlinking, so workers still on an
+    # older build are fine
+    builds = sorted(
+        (entry for entry in os.listdir(graph_dir) if os.path.isdir(os.path.join(graph_dir, entry))),
+        key=lambda entry: (int(entry.split("-")[0]), entry),
+    )
+    for entry in builds[:-KEEP_BUILDS]:
+        if entry == build:
+            continue
+        shutil.rmtree(os.path.join(graph_dir, entry), ignore_errors=True)
+    return meta
+
+
+def mutual_connection_counts(user, others):
+    """
+    Number of connections user shares with each of others, empty until a
+    snapshot was built
+    """
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return {}
+    return snapshot.contacts.mutual_counts(user, others)
+
+
+def partner_suggestions(user, limit=10, role=SUPPLIER):
+    """
+    Users two contact hops away, by default the suppliers of user's
+    suppliers, as ``(pk, paths)`` pairs
+    """
+    snapshot = get_snapshot()
+    if snapshot is None:
+        return []
+    return snapshot.contacts.suggestions(user, limit=limit, role=role)
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from connection.graph import GRAPH_DIR, get_snapshot, update_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Builds the contact and follow graph snapshot used for partner suggestions "
+            "and mutual connection counts. Does nothing if the tables didn't change.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+            help="Rebuild from scratch instead of merging new rows into the last snapshot.")
+        parser.add_argument('--dir', default=GRAPH_DIR,
+            help="Directory holding the snapshots.")
+        parser.add_argument('--loop', action='store_true',
+            help="Keep rebuilding instead of exiting after one build.")
+        parser.add_argument('--sleep', type=float, default=300,
+            help="Seconds to wait between builds with --loop.")
+        parser.add_argument('--full-every', type=int, default=12,
+            help="With --loop, rebuild from scratch every this many builds, as a "
+                 "safety net for changes the incremental check can't see.")
+
+    def handle(self, *args, **options):
+        full = options['full']
+        builds = 0
+        while True:
+            started = time.monotonic()
+            meta = update_snapshot(full=full, graph_dir=options['dir'])
+            if meta is None:
+                self.stdout.write("Graph unchanged")
+            else:
+                snapshot = get_snapshot(options['dir'])
+                self.stdout.write(self.style.SUCCESS(
+                    "Graph built in %.2fs, %d contact and %d follow edges%s" % (
+                        time.monotonic() - started,
+                        snapshot.contacts.edges,
+                        snapshot.follows.edges,
+                        " (merged %s)" % ", ".join(meta['incremental']) if meta['incremental'] else "",
+                    )))
+            if not options['loop']:
+                break
+            builds += 1
+            full = bool(options['full_every']) and builds % options['full_every'] == 0
+            time.sleep(options['sleep'])
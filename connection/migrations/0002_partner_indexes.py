@@ -0,0 +1,21 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connection', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(condition=models.Q(('is_supplier', True)), fields=['from_user', 'to_user'], name='connection_supplier_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(condition=models.Q(('is_costumer', True)), fields=['from_user', 'to_user'], name='connection_costumer_idx'),
+        ),
+    ]
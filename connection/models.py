@@ -1,14 +1,22 @@
 from __future__ import unicode_literals
 
+import hashlib
+import time
+from collections import defaultdict, namedtuple
+from functools import reduce
+from operator import or_
+
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, Q, Value, When
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from connection.exceptions import AlreadyExistsError
+from connection.pksets import UserPkSet, _pk
 from connection.signals import (
     block_created,
     block_removed,
@@ -28,11 +36,27 @@ from connection.signals import (
 
 AUTH_USER_MODEL = getattr(settings, "AUTH_USER_MODEL", "auth.User")
 
+PARTNER_PAGE_SIZE = getattr(settings, "CONNECTION_PARTNER_PAGE_SIZE", 100)
+PARTNER_FIELDS = ("id", "username", "first_name", "last_name", "email")
+
+SUPPLIER = "supplier"
+COSTUMER = "costumer"
+PARTNER_ROLES = {SUPPLIER: "is_supplier", COSTUMER: "is_costumer"}
+
+# outcomes of ConnectionManager._request_state
+CONNECTED = 1
+REQUEST_SENT = 2
+REQUEST_RECEIVED = 3
+
+PartnerPage = namedtuple("PartnerPage", ["partners", "next_cursor"])
+
 CACHE_TYPES = {
     "connections": "c-%s",
+    "partners": "cp-%s",
     "followers": "fo-%s",
     "following": "fl-%s",
     "blocks": "b-%s",
+    "block_pks": "bp-%s",
     "blocked": "bo-%s",
     "blocking": "bd-%s",
     "requests": "cr-%s",
@@ -45,40 +69,226 @@ CACHE_TYPES = {
     "unrejected_request_count": "crurc-%s",
 }
 
-BUST_CACHES = {
-    "connections": ["connections"],
-    "followers": ["followers"],
-    "blocks": ["blocks"],
-    "blocked": ["blocked"],
-    "following": ["following"],
-    "blocking": ["blocking"],
-    "requests": [
-        "requests",
-        "unread_requests",
-        "unread_request_count",
-        "read_requests",
-        "rejected_requests",
-        "unrejected_requests",
-        "unrejected_request_count",
-    ],
-    "sent_requests": ["sent_requests"],
-}
+# every relationship cache of a user is keyed on one generation number,
+# bumping it invalidates all of them at once and the old entries expire
+GENERATION_KEY = "cg-%s"
+
 
+def _new_generation():
+    # start from the clock, so a generation evicted from the cache never
+    # comes back to a number that stale entries are still stored under
+    return int(time.time() * 1000)
 
-def cache_key(type, user_pk):
+
+def cache_generation(user_pk):
+    """
+    Return the current generation of a user's relationship caches
+    """
+    return cache.get_or_set(GENERATION_KEY % user_pk, _new_generation, None)
+
+
+def cache_generations(user_pks):
+    """
+    Return a dict of the current generation of many users, in one cache
+    round trip unless some have to be started
+    """
+    keys = {GENERATION_KEY % user_pk: user_pk for user_pk in user_pks}
+    found = cache.get_many(keys)
+    generations = {keys[key]: generation for key, generation in found.items()}
+    for key, user_pk in keys.items():
+        if key not in found:
+            generations[user_pk] = cache_generation(user_pk)
+    return generations
+
+
+def cache_key(type, user_pk, generation=None):
     """
     Build the cache key for a particular type of cached value
     """
-    return CACHE_TYPES[type] % user_pk
+    if generation is None:
+        generation = cache_generation(user_pk)
+    return "%s-%s" % (CACHE_TYPES[type] % user_pk, generation)
+
+
+def bust_caches(*user_pks):
+    """
+    Bust every cache of the given users, one cache write per user. This
+    happens once the current transaction commits, so a reader can't fill
+    the new generation from data that is about to change.
+    """
+    user_pks = set(user_pks)
+
+    def bump():
+        for user_pk in user_pks:
+            key = GENERATION_KEY % user_pk
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, _new_generation(), None)
+
+    transaction.on_commit(bump)
 
 
 def bust_cache(type, user_pk):
     """
-    Bust our cache for a given type, can bust multiple caches
+    Bust our cache for a given type, which busts all caches of the user
+    """
+    bust_caches(user_pk)
+
+
+def cached_pks(type, user_pk, queryset):
+    """
+    Return the ``UserPkSet`` cached for a type, filling the cache from a
+    ``values_list`` queryset of user pks on a miss
+    """
+    key = cache_key(type, user_pk)
+    pks = UserPkSet.unpack(cache.get(key))
+
+    if pks is None:
+        pks = UserPkSet(queryset)
+        cache.set(key, pks.pack())
+
+    return pks
+
+
+def cached_pks_many(type, users, queryset, owner, member):
+    """
+    Batch version of ``cached_pks``, returns a dict of user pk to
+    ``UserPkSet``. The misses are filled by one query grouping the
+    ``(owner, member)`` pk pairs of queryset.
+    """
+    user_pks = {_pk(user) for user in users}
+    generations = cache_generations(user_pks)
+    keys = {
+        cache_key(type, user_pk, generations[user_pk]): user_pk for user_pk in user_pks
+    }
+    sets = {}
+    for key, packed in cache.get_many(keys).items():
+        pks = UserPkSet.unpack(packed)
+        if pks is not None:
+            sets[keys[key]] = pks
+
+    missing = user_pks - set(sets)
+    if missing:
+        grouped = {user_pk: [] for user_pk in missing}
+        qs = queryset.filter(**{"%s__in" % owner: missing}).values_list(owner, member)
+        for owner_pk, member_pk in qs:
+            grouped[owner_pk].append(member_pk)
+        fresh = {}
+        for key, user_pk in keys.items():
+            if user_pk in grouped:
+                sets[user_pk] = UserPkSet(grouped[user_pk])
+                fresh[key] = sets[user_pk].pack()
+        cache.set_many(fresh)
+
+    return sets
+
+
+def _pairs_in(sets, pairs):
+    return {
+        (_pk(user1), _pk(user2)): _pk(user2) in sets[_pk(user1)] for user1, user2 in pairs
+    }
+
+
+def _has_insert_returning(connection):
+    if connection.vendor == "postgresql":
+        return True
+    # ON CONFLICT came with 3.24 and RETURNING with 3.35
+    return connection.vendor == "sqlite" and connection.Database.sqlite_version_info >= (3, 35)
+
+
+def cached_member(type, user_pk, user):
     """
-    bust_keys = BUST_CACHES[type]
-    keys = [CACHE_TYPES[k] % user_pk for k in bust_keys]
-    cache.delete_many(keys)
+    Is user in the cached set of a type? None when nothing is cached
+    """
+    pks = UserPkSet.unpack(cache.get(cache_key(type, user_pk)))
+    if pks is None:
+        return None
+    return user in pks
+
+
+class ConnectionRequestManager(models.Manager):
+    """ Connection request manager, set based versions of accept/reject/cancel """
+
+    def _locked(self, requests):
+        # a queryset is read inside the transaction, locking the rows where
+        # the database can, so two workers can't handle the same requests.
+        # Only the requests are locked, not the joined users.
+        if isinstance(requests, models.QuerySet):
+            features = connections[requests.db].features
+            if features.has_select_for_update:
+                of = ("self",) if features.has_select_for_update_of else ()
+                requests = requests.select_for_update(of=of)
+            requests = requests.select_related("from_user", "to_user")
+        return [r for r in requests if r.from_user_id != r.to_user_id]
+
+    def accept(self, requests):
+        """
+        Accept many requests in one transaction: the mirrored contacts are
+        inserted in one batch, the requests and their reverse requests
+        deleted in one statement. Returns the accepted requests.
+        """
+        with transaction.atomic(using=self.db):
+            requests = self._locked(requests)
+            if not requests:
+                return []
+
+            Contact.objects.bulk_create(
+                [
+                    Contact(from_user_id=from_pk, to_user_id=to_pk)
+                    for r in requests
+                    for from_pk, to_pk in (
+                        (r.from_user_id, r.to_user_id),
+                        (r.to_user_id, r.from_user_id),
+                    )
+                ],
+                ignore_conflicts=True,
+            )
+
+            senders = defaultdict(set)
+            for r in requests:
+                senders[r.to_user_id].add(r.from_user_id)
+            reverse = [
+                Q(from_user_id=to_pk, to_user_id__in=from_pks)
+                for to_pk, from_pks in senders.items()
+            ]
+            ConnectionRequest.objects.filter(
+                reduce(or_, reverse, Q(pk__in=[r.pk for r in requests]))
+            ).delete()
+
+            for r in requests:
+                connection_request_accepted.send(
+                    sender=r, from_user=r.from_user, to_user=r.to_user
+                )
+            # Bust requests, reverse requests and connections caches
+            bust_caches(*[pk for r in requests for pk in (r.from_user_id, r.to_user_id)])
+
+        return requests
+
+    def reject(self, requests):
+        """ Reject many requests in one transaction """
+        with transaction.atomic(using=self.db):
+            requests = self._delete(requests)
+            now = timezone.now()
+            for r in requests:
+                r.rejected = now
+                connection_request_rejected.send(sender=r)
+        return requests
+
+    def cancel(self, requests):
+        """ Cancel many requests in one transaction """
+        with transaction.atomic(using=self.db):
+            requests = self._delete(requests)
+            for r in requests:
+                connection_request_canceled.send(sender=r)
+        return requests
+
+    def _delete(self, requests):
+        requests = self._locked(requests)
+        if requests:
+            ConnectionRequest.objects.filter(pk__in=[r.pk for r in requests]).delete()
+            bust_caches(*[pk for r in requests for pk in (r.from_user_id, r.to_user_id)])
+        return requests
 
 
 class ConnectionRequest(models.Model):
@@ -101,6 +311,8 @@ class ConnectionRequest(models.Model):
     rejected = models.DateTimeField(blank=True, null=True)
     viewed = models.DateTimeField(blank=True, null=True)
 
+    objects = ConnectionRequestManager()
+
     class Meta:
         verbose_name = _("Connection Request")
         verbose_name_plural = _("Connection Requests")
@@ -111,59 +323,24 @@ class ConnectionRequest(models.Model):
 
     def accept(self):
         """ Accept this connection request """
-        Contact.objects.create(from_user=self.from_user, to_user=self.to_user)
-
-        Contact.objects.create(from_user=self.to_user, to_user=self.from_user)
-
-        connection_request_accepted.send(
-            sender=self, from_user=self.from_user, to_user=self.to_user
-        )
-
-        self.delete()
-
-        # Delete any reverse requests
-        ConnectionRequest.objects.filter(
-            from_user=self.to_user, to_user=self.from_user
-        ).delete()
-
-        # Bust requests cache - request is deleted
-        bust_cache("requests", self.to_user.pk)
-        bust_cache("sent_requests", self.from_user.pk)
-        # Bust reverse requests cache - reverse request might be deleted
-        bust_cache("requests", self.from_user.pk)
-        bust_cache("sent_requests", self.to_user.pk)
-        # Bust connections cache - new connections added
-        bust_cache("connections", self.to_user.pk)
-        bust_cache("connections", self.from_user.pk)
-
+        ConnectionRequest.objects.accept([self])
         return True
 
     def reject(self):
         """ reject this connection request """
-        self.rejected = timezone.now()
-        self.delete()
-        connection_request_rejected.send(sender=self)
-        bust_cache("requests", self.to_user.pk)
-        bust_cache("sent_requests", self.from_user.pk)
+        ConnectionRequest.objects.reject([self])
         return True
 
     def cancel(self):
         """ cancel this connection request """
-        self.delete()
-        connection_request_canceled.send(sender=self)
-        bust_cache("requests", self.to_user.pk)
-        bust_cache("sent_requests", self.from_user.pk)
-
-        bust_cache("requests", self.from_user.pk)
-        bust_cache("sent_requests", self.to_user.pk)
-
+        ConnectionRequest.objects.cancel([self])
         return True
 
     def mark_viewed(self):
         self.viewed = timezone.now()
         connection_request_viewed.send(sender=self)
         self.save()
-        bust_cache("requests", self.to_user.pk)
+        bust_caches(self.to_user_id)
         return True
 
 
@@ -171,38 +348,95 @@ class ConnectionManager(models.Manager):
     """ Connection manager """
 
     def suppliers(self, from_user):
-
         """ Return a list of all suppliers """
-        suppliers = Contact.objects.filter(from_user = from_user , is_supplier = True)
-        sup = []
-        for x in suppliers:
-            sup.append(x.to_user)
-        return sup
+        return list(
+            get_user_model().objects.filter(
+                connections__from_user=from_user, connections__is_supplier=True
+            ).order_by("pk")
+        )
 
     def costumers(self, from_user):
         """ Return a list of all costumers """
-        costumers = Contact.objects.filter(from_user = from_user , is_costumer = True)
-        cos = []
-        for x in costumers:
-            cos.append(x.to_user)
-        return cos
+        return list(
+            get_user_model().objects.filter(
+                connections__from_user=from_user, connections__is_costumer=True
+            ).order_by("pk")
+        )
+
+    def partners(
+        self,
+        from_user,
+        roles=(SUPPLIER, COSTUMER),
+        cursor=None,
+        limit=PARTNER_PAGE_SIZE,
+        fields=PARTNER_FIELDS,
+    ):
+        """
+        Return a ``PartnerPage`` of the contacts of from_user having any of
+        the given roles, ordered by user id. Each partner is a dict of the
+        requested user fields plus ``is_supplier`` and ``is_costumer``.
+        Pass ``next_cursor`` back as cursor for the next page, a limit of
+        None returns everything in one page, a cursor that isn't a user id
+        an empty one. Pages are cached until the owner's caches are busted,
+        which an edit of one of the listed users does as well.
+        """
+        roles = tuple(sorted(set(roles)))
+        fields = tuple(fields)
+        if cursor is not None:
+            try:
+                cursor = int(cursor)
+            except (TypeError, ValueError):
+                # a cursor we didn't hand out, there is nothing after it
+                return PartnerPage([], None)
+        params = repr((roles, cursor, limit, fields)).encode("utf-8")
+        key = "%s-%s" % (
+            cache_key("partners", from_user.pk),
+            hashlib.md5(params).hexdigest(),
+        )
+        page = cache.get(key)
+
+        if page is None:
+            role_filter = Q()
+            for role in roles:
+                role_filter |= Q(**{PARTNER_ROLES[role]: True})
+
+            qs = Contact.objects.filter(role_filter, from_user=from_user)
+            if cursor is not None:
+                qs = qs.filter(to_user_id__gt=cursor)
+            qs = qs.order_by("to_user_id")
+            if limit is not None:
+                qs = qs[: limit + 1]
+
+            names = fields + ("is_supplier", "is_costumer")
+            columns = [
+                "to_user_id" if name == "id" else "to_user__%s" % name for name in fields
+            ]
+            rows = list(qs.values_list("to_user_id", "is_supplier", "is_costumer", *columns))
+
+            next_cursor = None
+            if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = rows[-1][0]
+            partners = [dict(zip(names, row[3:] + row[1:3])) for row in rows]
+            page = PartnerPage(partners, next_cursor)
+            cache.set(key, page)
+
+        return page
 
     def connections(self, user):
         """ Return a list of all connections """
-        key = cache_key("connections", user.pk)
-        connections = cache.get(key)
-
-        if connections is None:
-            qs = (
-                Contact.objects.select_related("from_user", "to_user")
-                .filter(to_user=user)
-                .all()
-            )
-            connections = [u.from_user for u in qs]
-            cache.set(key, connections)
+        return cached_pks(
+            "connections",
+            user.pk,
+            Contact.objects.filter(to_user=user).values_list("from_user_id", flat=True),
+        ).users()
 
-        return connections
 
+    def connections_many(self, users):
+        """ Batch version of ``connections``, a dict of user pk to ``UserPkSet`` """
+        return cached_pks_many(
+            "connections", users, Contact.objects.all(), "to_user_id", "from_user_id"
+        )
 
     def requests(self, user):
         """ Return a list of connection requests """
@@ -331,59 +565,180 @@ class ConnectionManager(models.Manager):
         return count
 
     def add_connection(self, from_user, to_user, message=None):
-        """ Create a connection request """
+        """ Create a connection request, raises ``BlockedError`` if either user blocked the other """
         if from_user == to_user:
             raise AlreadyExistsError("Users cannot contact themselves")
 
-        if self.are_connections(from_user, to_user):
+        from connection.blocks import check_not_blocked
+
+        check_not_blocked(from_user, to_user)
+
+        # known partners are answered without a query when the set is
+        # cached, it isn't loaded here as every new request busts it
+        if cached_member("connections", from_user.pk, to_user):
             raise AlreadyExistsError("You are already connections")
 
-        if (ConnectionRequest.objects.filter(from_user=from_user, to_user=to_user).exists()):
+        state = self._request_state(from_user, to_user)
+        if CONNECTED in state:
+            raise AlreadyExistsError("You are already connections")
+        if REQUEST_SENT in state:
             raise AlreadyExistsError("You already requested connection from this user.")
-
-        if (ConnectionRequest.objects.filter(from_user=to_user, to_user=from_user).exists()):
+        if REQUEST_RECEIVED in state:
             raise AlreadyExistsError("This user already requested connection from you.")
 
-        if message is None:
-            message = ""
-
-        request, created = ConnectionRequest.objects.get_or_create(
-            from_user=from_user, to_user=to_user
-        )
-
-        if created is False:
+        request = self._insert_request(from_user, to_user, message or "")
+        if request is None:
             raise AlreadyExistsError("Connection already requested")
 
-        if message:
-            request.message = message
-            request.save()
-
-        bust_cache("requests", to_user.pk)
-        bust_cache("sent_requests", from_user.pk)
         connection_request_created.send(sender=request)
 
         return request
 
+    def _request_state(self, from_user, to_user):
+        """
+        Return which of ``CONNECTED``, ``REQUEST_SENT`` and
+        ``REQUEST_RECEIVED`` hold between the two users, in one query
+        """
+        connected = (
+            Contact.objects.filter(to_user=from_user, from_user=to_user)
+            .annotate(state=Value(CONNECTED, output_field=models.IntegerField()))
+            .values_list("state")
+        )
+        requested = (
+            ConnectionRequest.objects.filter(
+                Q(from_user=from_user, to_user=to_user) | Q(from_user=to_user, to_user=from_user)
+            )
+            .annotate(
+                state=Case(
+                    When(from_user=from_user, then=Value(REQUEST_SENT)),
+                    default=Value(REQUEST_RECEIVED),
+                    output_field=models.IntegerField(),
+                )
+            )
+            .values_list("state")
+        )
+        return {state for state, in connected.union(requested, all=True)}
+
+    def _insert_request(self, from_user, to_user, message):
+        """
+        Insert a request unless one exists, returns it or None on conflict,
+        busting the caches of both users when a row was written.
+        Uses INSERT ... ON CONFLICT DO NOTHING RETURNING where the database
+        has it, a savepoint around a plain insert elsewhere. The raw insert
+        sends no pre_save or post_save, receivers of those only run on the
+        savepoint path.
+        """
+        db = ConnectionRequest.objects.db
+        connection = connections[db]
+        request = ConnectionRequest(
+            from_user=from_user, to_user=to_user, message=message, created=timezone.now()
+        )
+        if not _has_insert_returning(connection):
+            try:
+                with transaction.atomic(using=db):
+                    request.save(force_insert=True, using=db)
+            except IntegrityError:
+                return None
+            bust_caches(to_user.pk, from_user.pk)
+            return request
+
+        opts = ConnectionRequest._meta
+        quote = connection.ops.quote_name
+        fields = [opts.get_field(name) for name in ("from_user", "to_user", "message", "created")]
+        sql = "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s, %s) DO NOTHING RETURNING %s" % (
+            quote(opts.db_table),
+            ", ".join(quote(f.column) for f in fields),
+            ", ".join(["%s"] * len(fields)),
+            quote(fields[0].column),
+            quote(fields[1].column),
+            quote(opts.pk.column),
+        )
+        params = [f.get_db_prep_save(f.pre_save(request, True), connection) for f in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        request.pk = row[0]
+        request._state.adding = False
+        request._state.db = db
+        bust_caches(to_user.pk, from_user.pk)
+        return request
+
+    def add_connections(self, from_user, to_users, message=""):
+        """
+        Set based version of ``add_connection`` for many recipients. Users
+        that are already connected, have a pending request in either
+        direction or blocked from_user (or were blocked by them) are skipped
+        instead of raising. Returns the list of created requests.
+        """
+        from connection.blocks import block_set
+
+        blocks = block_set(from_user)
+        to_ids = {u.pk for u in to_users if u.pk != from_user.pk and u.pk not in blocks}
+        if not to_ids:
+            return []
+
+        connected = Contact.objects.filter(
+            to_user=from_user, from_user__in=to_ids
+        ).values_list("from_user_id", flat=True)
+        requested = ConnectionRequest.objects.filter(
+            Q(from_user=from_user, to_user__in=to_ids)
+            | Q(from_user__in=to_ids, to_user=from_user)
+        ).values_list("from_user_id", "to_user_id")
+
+        skip = set(connected)
+        for request_from, request_to in requested:
+            skip.add(request_to if request_from == from_user.pk else request_from)
+        new_ids = to_ids - skip
+        if not new_ids:
+            return []
+
+        ConnectionRequest.objects.bulk_create(
+            [
+                ConnectionRequest(from_user=from_user, to_user_id=pk, message=message)
+                for pk in new_ids
+            ],
+            ignore_conflicts=True,
+        )
+        created = list(
+            ConnectionRequest.objects.filter(from_user=from_user, to_user__in=new_ids)
+        )
+
+        bust_caches(from_user.pk, *[request.to_user_id for request in created])
+        for request in created:
+            connection_request_created.send(sender=request)
+
+        return created
+
+    def set_roles(self, from_user, to_users, is_supplier=None, is_costumer=None):
+        """
+        Set the supplier and/or costumer flag of many contacts of from_user
+        with one UPDATE, returns the number of contacts matched
+        """
+        values = {}
+        if is_supplier is not None:
+            values["is_supplier"] = is_supplier
+        if is_costumer is not None:
+            values["is_costumer"] = is_costumer
+        to_ids = {_pk(u) for u in to_users}
+        if not values or not to_ids:
+            return 0
+
+        matched = Contact.objects.filter(from_user=from_user, to_user__in=to_ids).update(
+            **values
+        )
+        if matched:
+            bust_caches(from_user.pk)
+        return matched
+
     def remove_supplier(self ,from_user, to_user):
         """ Remove a supplier """
-
-        try:
-            connection = Contact.objects.get(from_user=from_user, to_user=to_user)
-            connection.is_supplier = False
-            connection.save()
-            return True
-        except Contact.DoesNotExist:
-            return False
+        return self.set_roles(from_user, [to_user], is_supplier=False) > 0
 
     def remove_costumer(self ,from_user, to_user):
         """ Remove a costumer """
-        try:
-            connection = Contact.objects.get(from_user=from_user, to_user=to_user)
-            connection.is_costumer = False
-            connection.save()
-            return True
-        except Contact.DoesNotExist:
-            return False
+        return self.set_roles(from_user, [to_user], is_costumer=False) > 0
 
     def remove_connection(self, from_user, to_user):
         """ Destroy a connection relationship """
@@ -396,10 +751,7 @@ class ConnectionManager(models.Manager):
                     sender=distinct_qs[0], from_user=from_user, to_user=to_user
                 )
                 qs.delete()
-                bust_cache("connections", to_user.pk)
-                bust_cache("connections", from_user.pk)
-                bust_cache("sent_requests", to_user.pk)
-                bust_cache("sent_requests", from_user.pk)
+                bust_caches(to_user.pk, from_user.pk)
 
                 return True
             else:
@@ -408,19 +760,20 @@ class ConnectionManager(models.Manager):
             return False
 
     def are_connections(self, user1, user2):
-        """ Are these two users connections? """
-        connections1 = cache.get(cache_key("connections", user1.pk))
-        connections2 = cache.get(cache_key("connections", user2.pk))
-        if connections1 and user2 in connections1:
-            return True
-        elif connections2 and user1 in connections2:
-            return True
-        else:
-            try:
-                Contact.objects.get(to_user=user1, from_user=user2)
-                return True
-            except Contact.DoesNotExist:
-                return False
+        """ Are these two users connections? A cached set answers either way """
+        member = cached_member("connections", user1.pk, user2)
+        if member is None:
+            member = cached_member("connections", user2.pk, user1)
+        if member is None:
+            member = Contact.objects.filter(to_user=user1, from_user=user2).exists()
+        return member
+
+    def are_connections_many(self, pairs):
+        """ Batch version of ``are_connections``, a dict of pk pair to bool """
+        pairs = list(pairs)
+        sets = self.connections_many(user1 for user1, user2 in pairs)
+        return _pairs_in(sets, pairs)
+
 
 class Contact(models.Model):
     """ Model to represent Connections """
@@ -443,6 +796,19 @@ class Contact(models.Model):
         verbose_name = _("Contact")
         verbose_name_plural = _("Contacts")
         unique_together = ("from_user", "to_user")
+        indexes = [
+            # partner directory, see ConnectionManager.partners
+            models.Index(
+                fields=["from_user", "to_user"],
+                condition=Q(is_supplier=True),
+                name="connection_supplier_idx",
+            ),
+            models.Index(
+                fields=["from_user", "to_user"],
+                condition=Q(is_costumer=True),
+                name="connection_costumer_idx",
+            ),
+        ]
 
     def __str__(self):
         return "User #%s is connections with #%s" % (self.to_user_id, self.from_user_id)
@@ -452,6 +818,10 @@ class Contact(models.Model):
         if self.to_user == self.from_user:
             raise ValidationError("Users cannot be connections with themselves.")
         super(Contact, self).save(*args, **kwargs)
+        # the cached sets answer "no" as well, so a contact created outside
+        # accept() (admin, shell) must not leave a stale one behind, and an
+        # update may change the roles listed in the partner directory
+        bust_caches(self.from_user_id, self.to_user_id)
 
 
 class FollowingManager(models.Manager):
@@ -459,27 +829,31 @@ class FollowingManager(models.Manager):
 
     def followers(self, user):
         """ Return a list of all followers """
-        key = cache_key("followers", user.pk)
-        followers = cache.get(key)
-
-        if followers is None:
-            qs = Follow.objects.filter(followee=user).all()
-            followers = [u.follower for u in qs]
-            cache.set(key, followers)
-
-        return followers
+        return cached_pks(
+            "followers",
+            user.pk,
+            Follow.objects.filter(followee=user).values_list("follower_id", flat=True),
+        ).users()
 
     def following(self, user):
         """ Return a list of all users the given user follows """
-        key = cache_key("following", user.pk)
-        following = cache.get(key)
-
-        if following is None:
-            qs = Follow.objects.filter(follower=user).all()
-            following = [u.followee for u in qs]
-            cache.set(key, following)
+        return cached_pks(
+            "following",
+            user.pk,
+            Follow.objects.filter(follower=user).values_list("followee_id", flat=True),
+        ).users()
+
+    def followers_many(self, users):
+        """ Batch version of ``followers``, a dict of user pk to ``UserPkSet`` """
+        return cached_pks_many(
+            "followers", users, Follow.objects.all(), "followee_id", "follower_id"
+        )
 
-        return following
+    def following_many(self, users):
+        """ Batch version of ``following``, a dict of user pk to ``UserPkSet`` """
+        return cached_pks_many(
+            "following", users, Follow.objects.all(), "follower_id", "followee_id"
+        )
 
     def add_follower(self, follower, followee):
         """ Create 'follower' follows 'followee' relationship """
@@ -499,8 +873,7 @@ class FollowingManager(models.Manager):
         followee_created.send(sender=self, followee=followee)
         following_created.send(sender=self, following=relation)
 
-        bust_cache("followers", followee.pk)
-        bust_cache("following", follower.pk)
+        bust_caches(followee.pk, follower.pk)
 
         return relation
 
@@ -512,23 +885,29 @@ class FollowingManager(models.Manager):
             followee_removed.send(sender=rel, followee=rel.followee)
             following_removed.send(sender=rel, following=rel)
             rel.delete()
-            bust_cache("followers", followee.pk)
-            bust_cache("following", follower.pk)
+            bust_caches(followee.pk, follower.pk)
             return True
         except Follow.DoesNotExist:
             return False
 
     def follows(self, follower, followee):
-        """ Does follower follow followee? Smartly uses caches if exists """
-        followers = cache.get(cache_key("following", follower.pk))
-        following = cache.get(cache_key("followers", followee.pk))
+        """ Does follower follow followee? A cached set answers either way """
+        member = cached_member("following", follower.pk, followee)
+        if member is None:
+            member = cached_member("followers", followee.pk, follower)
+        if member is None:
+            member = Follow.objects.filter(follower=follower, followee=followee).exists()
+        return member
 
-        if followers and followee in followers:
-            return True
-        elif following and follower in following:
-            return True
-        else:
-            return Follow.objects.filter(follower=follower, followee=followee).exists()
+
+    def follows_many(self, pairs):
+        """
+        Batch version of ``follows`` for (follower, followee) pairs, a dict
+        of pk pair to bool
+        """
+        pairs = list(pairs)
+        sets = self.following_many(follower for follower, followee in pairs)
+        return _pairs_in(sets, pairs)
 
 
 class Follow(models.Model):
@@ -557,34 +936,39 @@ class Follow(models.Model):
         if self.follower == self.followee:
             raise ValidationError("Users cannot follow themselves.")
         super(Follow, self).save(*args, **kwargs)
+        bust_caches(self.follower_id, self.followee_id)
 
 
 class BlockManager(models.Manager):
     """ Following manager """
 
     def blocked(self, user):
-        """ Return a list of all blocks """
-        key = cache_key("blocked", user.pk)
-        blocked = cache.get(key)
-
-        if blocked is None:
-            qs = Block.objects.filter(blocked=user).all()
-            blocked = [u.blocked for u in qs]
-            cache.set(key, blocked)
-
-        return blocked
+        """ Return a list of all users blocking the given user """
+        return cached_pks(
+            "blocked",
+            user.pk,
+            Block.objects.filter(blocked=user).values_list("blocker_id", flat=True),
+        ).users()
 
     def blocking(self, user):
         """ Return a list of all users the given user blocks """
-        key = cache_key("blocking", user.pk)
-        blocking = cache.get(key)
-
-        if blocking is None:
-            qs = Block.objects.filter(blocker=user).all()
-            blocking = [u.blocked for u in qs]
-            cache.set(key, blocking)
+        return cached_pks(
+            "blocking",
+            user.pk,
+            Block.objects.filter(blocker=user).values_list("blocked_id", flat=True),
+        ).users()
+
+    def blocked_many(self, users):
+        """ Batch version of ``blocked``, a dict of user pk to ``UserPkSet`` """
+        return cached_pks_many(
+            "blocked", users, Block.objects.all(), "blocked_id", "blocker_id"
+        )
 
-        return blocking
+    def blocking_many(self, users):
+        """ Batch version of ``blocking``, a dict of user pk to ``UserPkSet`` """
+        return cached_pks_many(
+            "blocking", users, Block.objects.all(), "blocker_id", "blocked_id"
+        )
 
     def add_block(self, blocker, blocked):
         """ Create 'follower' follows 'followee' relationship """
@@ -604,8 +988,7 @@ class BlockManager(models.Manager):
         block_created.send(sender=self, blocked=blocked)
         block_created.send(sender=self, blocking=relation)
 
-        bust_cache("blocked", blocked.pk)
-        bust_cache("blocking", blocker.pk)
+        bust_caches(blocked.pk, blocker.pk)
 
         return relation
 
@@ -617,26 +1000,23 @@ class BlockManager(models.Manager):
             block_removed.send(sender=rel, blocked=rel.blocked)
             block_removed.send(sender=rel, blocking=rel)
             rel.delete()
-            bust_cache("blocked", blocked.pk)
-            bust_cache("blocking", blocker.pk)
+            bust_caches(blocked.pk, blocker.pk)
             return True
         except Block.DoesNotExist:
             return False
 
     def is_blocked(self, user1, user2):
-        """ Are these two users blocked? """
-        block1 = cache.get(cache_key("blocks", user1.pk))
-        block2 = cache.get(cache_key("blocks", user2.pk))
-        if block1 and user2 in block1:
-            return True
-        elif block2 and user1 in block2:
-            return True
-        else:
-            try:
-                Block.objects.get(blocker=user1, blocked=user2)
-                return True
-            except Block.DoesNotExist:
-                return False
+        """ Has either of these two users blocked the other? """
+        from connection.blocks import is_blocked
+
+        return is_blocked(user1, user2)
+
+    def is_blocked_many(self, pairs):
+        """ Batch version of ``is_blocked``, a dict of pk pair to bool """
+        pairs = list(pairs)
+        blocking = _pairs_in(self.blocking_many(user1 for user1, user2 in pairs), pairs)
+        blocked = _pairs_in(self.blocked_many(user1 for user1, user2 in pairs), pairs)
+        return {pair: blocking[pair] or blocked[pair] for pair in blocking}
 
 
 class Block(models.Model):
@@ -665,3 +1045,20 @@ class Block(models.Model):
         if self.blocker == self.blocked:
             raise ValidationError("Users cannot block themselves.")
         super(Block, self).save(*args, **kwargs)
+        bust_caches(self.blocker_id, self.blocked_id)
+
+
+def bust_partner_owners(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Signal receiver, the partner directory pages of everyone listing this
+    user carry the user's fields. Logins only touch ``last_login``.
+    """
+    if created or (update_fields is not None and set(update_fields) <= {"last_login"}):
+        return
+    owners = list(Contact.objects.filter(to_user_id=instance.pk).values_list("from_user_id", flat=True))
+    if owners:
+        bust_caches(*owners)
+
+models.signals.post_save.connect(
+    bust_partner_owners, sender=AUTH_USER_MODEL, dispatch_uid="connection_bust_partner_owners"
+)
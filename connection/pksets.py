@@ -0,0 +1,138 @@
+"""
+Compact sets of user primary keys for the relationship caches.
+
+The cached connection, follower and block lists used to be pickled lists
+of whole ``User`` instances, which got expensive to fetch and scan for
+users with tens of thousands of contacts. They are now stored as a sorted
+array of pks packed into bytes: membership is a binary search and the
+users themselves are only loaded when somebody iterates the set.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import math
+import struct
+from array import array
+from bisect import bisect_left
+
+from django.contrib.auth import get_user_model
+
+# array type codes, tried in order, the first one wide enough is used
+TYPECODES = ("i", "q")
+
+# first byte of a packed BloomFilter, never a TYPECODES entry
+BLOOM_MARK = b"B"
+
+
+def _pk(user):
+    return getattr(user, "pk", user)
+
+
+class UserPkSet(object):
+    """ Sorted, duplicate free array of user pks, hydrated lazily """
+
+    def __init__(self, pks=()):
+        pks = sorted(set(pks))
+        for typecode in TYPECODES:
+            limit = 1 << (array(typecode).itemsize * 8 - 1)
+            if not pks or (-limit <= pks[0] and pks[-1] < limit):
+                break
+        self.pks = array(typecode, pks)
+        self._users = None
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Rebuild a set from ``pack()`` output, returns None for anything else
+        (e.g. a list of users cached by an older release).
+        """
+        if not isinstance(packed, bytes) or not packed:
+            return None
+        typecode = packed[:1].decode("ascii")
+        if typecode not in TYPECODES:
+            return None
+        pkset = cls.__new__(cls)
+        pkset.pks = array(typecode)
+        pkset.pks.frombytes(packed[1:])
+        pkset._users = None
+        return pkset
+
+    def pack(self):
+        """ Type code followed by the raw array, what goes into the cache """
+        return self.pks.typecode.encode("ascii") + self.pks.tobytes()
+
+    def __contains__(self, user):
+        pk = _pk(user)
+        i = bisect_left(self.pks, pk)
+        return i < len(self.pks) and self.pks[i] == pk
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __bool__(self):
+        return len(self.pks) > 0
+
+    __nonzero__ = __bool__
+
+    def users(self):
+        """ The users themselves in pk order, loaded on first use """
+        if self._users is None:
+            by_pk = get_user_model().objects.in_bulk(list(self.pks))
+            self._users = [by_pk[pk] for pk in self.pks if pk in by_pk]
+        return self._users
+
+    def __iter__(self):
+        return iter(self.users())
+
+    def __getitem__(self, index):
+        return self.users()[index]
+
+    def __repr__(self):
+        return "<%s: %d users>" % (self.__class__.__name__, len(self))
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over user pks, a few bits per pk. Membership may give a
+    false positive but never a false negative, so it can stand in front of
+    a ``UserPkSet`` that is only fetched when the filter says yes.
+    """
+
+    HEADER = struct.Struct("<IB")
+
+    def __init__(self, pks=(), error_rate=0.01, bits=None, hashes=None):
+        if bits is None:
+            n = max(len(pks), 1)
+            bits = int(math.ceil(-n * math.log(error_rate) / math.log(2) ** 2))
+            hashes = max(1, int(round(bits / float(n) * math.log(2))))
+        self.bits = max(bits, 8)
+        self.hashes = hashes
+        self.array = bytearray((self.bits + 7) // 8)
+        for pk in pks:
+            for i in self._positions(pk):
+                self.array[i >> 3] |= 1 << (i & 7)
+
+    @classmethod
+    def unpack(cls, packed):
+        """ Rebuild a filter from ``pack()`` output, None for anything else """
+        if not isinstance(packed, bytes) or packed[:1] != BLOOM_MARK:
+            return None
+        bits, hashes = cls.HEADER.unpack_from(packed, 1)
+        bloom = cls.__new__(cls)
+        bloom.bits = bits
+        bloom.hashes = hashes
+        bloom.array = bytearray(packed[1 + cls.HEADER.size :])
+        return bloom
+
+    def pack(self):
+        return BLOOM_MARK + self.HEADER.pack(self.bits, self.hashes) + bytes(self.array)
+
+    def _positions(self, pk):
+        # double hashing, stable across processes unlike hash()
+        digest = hashlib.blake2b(struct.pack("<q", pk), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, user):
+        array = self.array
+        return all(array[i >> 3] & (1 << (i & 7)) for i in self._positions(_pk(user)))
@@ -0,0 +1,295 @@
+import shutil
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection as db_connection
+from django.db.models import QuerySet
+from django.test import TestCase
+
+from connection import graph
+from connection.exceptions import AlreadyExistsError, BlockedError
+from connection import models as connection_models
+from connection.models import SUPPLIER, Block, ConnectionRequest, Contact, Follow
+
+
+class GraphTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.graph_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.graph_dir, True)
+        self.users = [User.objects.create(username='user%d' % i) for i in range(8)]
+
+    def contact(self, i, j, **roles):
+        return Contact.objects.create(from_user=self.users[i], to_user=self.users[j], **roles)
+
+    def rows(self, g, roles=True):
+        # every edge as (src, dst, role), independent of how it is stored
+        return [
+            (pk, int(dst), int(role) if roles else 0)
+            for pk in range(g.nodes)
+            for dst, role in zip(g.neighbors(pk), g.roles[g._range(pk)[0]:g._range(pk)[1]]
+                                 if roles else [0] * g.degree(pk))
+        ]
+
+    def test_build_keeps_rows_pointing_at_lower_pks(self):
+        g = graph.Graph(*graph.build_csr([(1, 2, 0), (5, 1, 0)], False))
+        self.assertEqual(list(g.neighbors(5)), [1])
+        self.assertEqual(list(g.neighbors(1)), [2])
+
+    def test_merge_matches_full_build(self):
+        self.contact(5, 1, is_supplier=True)
+        self.contact(1, 2)
+        Follow.objects.create(follower=self.users[7], followee=self.users[0])
+        graph.update_snapshot(graph_dir=self.graph_dir)
+
+        self.contact(6, 0, is_costumer=True)
+        self.contact(1, 0, is_supplier=True)
+        Follow.objects.create(follower=self.users[3], followee=self.users[1])
+        merged = graph.update_snapshot(graph_dir=self.graph_dir)
+        self.assertEqual(sorted(merged['incremental']), [graph.CONTACTS, graph.FOLLOWS])
+        incremental = graph.get_snapshot(self.graph_dir)
+        merged_rows = (self.rows(incremental.contacts), self.rows(incremental.follows, False))
+
+        graph.update_snapshot(full=True, graph_dir=self.graph_dir)
+        full = graph.get_snapshot(self.graph_dir)
+        self.assertEqual(merged_rows, (self.rows(full.contacts), self.rows(full.follows, False)))
+        self.assertEqual(len(merged_rows[0]), 4)
+        self.assertEqual(list(full.follows.neighbors(self.users[7])), [self.users[0].pk])
+
+    def test_role_moved_between_contacts_is_rebuilt(self):
+        first = self.contact(0, 1, is_supplier=True)
+        second = self.contact(0, 2)
+        graph.update_snapshot(graph_dir=self.graph_dir)
+        Contact.objects.filter(pk=first.pk).update(is_supplier=False)
+        Contact.objects.filter(pk=second.pk).update(is_supplier=True)
+
+        meta = graph.update_snapshot(graph_dir=self.graph_dir)
+        self.assertIsNotNone(meta)
+        self.assertNotIn(graph.CONTACTS, meta['incremental'])
+        contacts = graph.get_snapshot(self.graph_dir).contacts
+        self.assertEqual(list(contacts.neighbors(self.users[0], graph.SUPPLIER)), [self.users[2].pk])
+
+    def test_unchanged_tables_skip_the_build(self):
+        self.contact(0, 1)
+        graph.update_snapshot(graph_dir=self.graph_dir)
+        self.assertIsNone(graph.update_snapshot(graph_dir=self.graph_dir))
+
+    def test_queries(self):
+        for i, j in [(0, 1), (0, 2), (3, 1), (3, 2), (1, 4), (2, 4), (2, 5)]:
+            self.contact(i, j, is_supplier=True)
+        graph.update_snapshot(graph_dir=self.graph_dir)
+        contacts = graph.get_snapshot(self.graph_dir).contacts
+        pk = lambda i: self.users[i].pk
+        self.assertEqual(contacts.mutual_counts(self.users[0], [self.users[3], self.users[1]]),
+                         {pk(3): 2, pk(1): 0})
+        self.assertEqual(contacts.suggestions(self.users[0], role=graph.SUPPLIER),
+                         [(pk(4), 2), (pk(5), 1)])
+        self.assertEqual(contacts.degree_stats()['edges'], 7)
+
+
+class CachedMembershipTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+
+    def test_cached_negative_answers_without_query(self):
+        Contact.objects.connections(self.alice)
+        Follow.objects.following(self.alice)
+        with self.assertNumQueries(0):
+            self.assertFalse(Contact.objects.are_connections(self.alice, self.bob))
+            self.assertFalse(Follow.objects.follows(self.alice, self.bob))
+
+    def test_uncached_asks_the_database(self):
+        Contact.objects.create(to_user=self.alice, from_user=self.bob)
+        Follow.objects.create(follower=self.alice, followee=self.bob)
+        with self.assertNumQueries(2):
+            self.assertTrue(Contact.objects.are_connections(self.alice, self.bob))
+            self.assertTrue(Follow.objects.follows(self.alice, self.bob))
+
+    def test_created_directly_busts_the_cache(self):
+        self.assertFalse(Contact.objects.are_connections(self.alice, self.bob))
+        self.assertFalse(Follow.objects.follows(self.alice, self.bob))
+        with self.captureOnCommitCallbacks(execute=True):
+            Contact.objects.create(to_user=self.alice, from_user=self.bob)
+            Follow.objects.create(follower=self.alice, followee=self.bob)
+        self.assertTrue(Contact.objects.are_connections(self.alice, self.bob))
+        self.assertTrue(Follow.objects.follows(self.alice, self.bob))
+
+    def test_lists_of_users(self):
+        Contact.objects.create(to_user=self.alice, from_user=self.bob)
+        connections = Contact.objects.connections(self.alice)
+        self.assertEqual(connections, [self.bob])
+        self.assertEqual(Follow.objects.followers(self.alice), [])
+
+    def test_cache_is_busted_on_follow(self):
+        Follow.objects.following(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            Follow.objects.add_follower(self.alice, self.bob)
+        self.assertTrue(Follow.objects.follows(self.alice, self.bob))
+
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner, connected, pending, blocked, follower = [
+            User.objects.create(username=name)
+            for name in ('owner', 'connected', 'pending', 'blocked', 'follower')]
+        Contact.objects.create(from_user=owner, to_user=connected, is_supplier=True)
+        Contact.objects.create(from_user=connected, to_user=owner, is_costumer=True)
+        ConnectionRequest.objects.create(from_user=owner, to_user=pending)
+        Block.objects.create(blocker=owner, blocked=blocked)
+        Follow.objects.create(follower=follower, followee=owner)
+        Follow.objects.create(follower=owner, followee=pending)
+        unknown = User(pk=follower.pk + 100, username='unknown')
+        self.users = [owner, connected, pending, blocked, follower, unknown]
+        self.pairs = [(user1, user2) for user1 in self.users for user2 in self.users if user1 != user2]
+
+    def assertBatchesMatch(self):
+        for manager, name in ((Contact.objects, 'connections'), (Follow.objects, 'followers'),
+                              (Follow.objects, 'following'), (Block.objects, 'blocked'),
+                              (Block.objects, 'blocking')):
+            sets = getattr(manager, name + '_many')(self.users)
+            self.assertEqual(set(sets), {user.pk for user in self.users})
+            for user in self.users:
+                self.assertEqual(sets[user.pk].users(), getattr(manager, name)(user), (name, user))
+
+        for manager, name in ((Contact.objects, 'are_connections'), (Follow.objects, 'follows'),
+                              (Block.objects, 'is_blocked')):
+            answers = getattr(manager, name + '_many')(self.pairs)
+            self.assertEqual(answers, {
+                (user1.pk, user2.pk): getattr(manager, name)(user1, user2) for user1, user2 in self.pairs
+            }, name)
+
+    def test_matches_single_user_versions(self):
+        self.assertBatchesMatch()
+
+    def test_matches_when_partly_cached(self):
+        owner, connected = self.users[:2]
+        Contact.objects.connections(owner)
+        Follow.objects.following(connected)
+        Block.objects.blocked(self.users[3])
+        self.assertBatchesMatch()
+        # everything is cached now
+        self.assertBatchesMatch()
+
+
+class ConnectionRequestTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+
+    def test_add_connection(self):
+        request = Contact.objects.add_connection(self.alice, self.bob, message='hi')
+        self.assertEqual(ConnectionRequest.objects.get(), request)
+        self.assertEqual(request.message, 'hi')
+        for from_user, to_user in ((self.alice, self.bob), (self.bob, self.alice), (self.alice, self.alice)):
+            with self.assertRaises(AlreadyExistsError):
+                Contact.objects.add_connection(from_user, to_user)
+        Contact.objects.create(to_user=self.alice, from_user=self.carol)
+        with self.assertRaises(AlreadyExistsError):
+            Contact.objects.add_connection(self.alice, self.carol)
+
+    def test_blocked_requests(self):
+        Block.objects.create(blocker=self.bob, blocked=self.alice)
+        with self.assertRaises(BlockedError):
+            Contact.objects.add_connection(self.alice, self.bob)
+        with self.assertRaises(BlockedError):
+            Contact.objects.add_connection(self.bob, self.alice)
+        created = Contact.objects.add_connections(self.alice, [self.bob, self.carol])
+        self.assertEqual([request.to_user for request in created], [self.carol])
+
+    def test_insert_request_conflict(self):
+        # both the ON CONFLICT statement and the savepoint fallback
+        for returning in (connection_models._has_insert_returning(db_connection), False):
+            ConnectionRequest.objects.all().delete()
+            with mock.patch('connection.models._has_insert_returning', return_value=returning):
+                first = Contact.objects._insert_request(self.alice, self.bob, '')
+                self.assertIsNone(Contact.objects._insert_request(self.alice, self.bob, ''))
+            self.assertEqual(ConnectionRequest.objects.get().pk, first.pk)
+            self.assertFalse(first._state.adding)
+
+    def test_insert_request_busts_caches(self):
+        for returning in (connection_models._has_insert_returning(db_connection), False):
+            ConnectionRequest.objects.all().delete()
+            cache.clear()
+            self.assertEqual(Contact.objects.unrejected_request_count(self.bob), 0)
+            self.assertEqual(Contact.objects.sent_requests(self.alice), [])
+            with mock.patch('connection.models._has_insert_returning', return_value=returning), \
+                    self.captureOnCommitCallbacks(execute=True):
+                request = Contact.objects._insert_request(self.alice, self.bob, '')
+            self.assertEqual(Contact.objects.unrejected_request_count(self.bob), 1)
+            self.assertEqual(Contact.objects.sent_requests(self.alice), [request])
+
+    def test_accept_many(self):
+        ConnectionRequest.objects.create(from_user=self.alice, to_user=self.bob)
+        ConnectionRequest.objects.create(from_user=self.carol, to_user=self.bob)
+        accepted = ConnectionRequest.objects.accept(ConnectionRequest.objects.filter(to_user=self.bob))
+        self.assertEqual(len(accepted), 2)
+        self.assertFalse(ConnectionRequest.objects.exists())
+        self.assertEqual(
+            sorted(Contact.objects.values_list('from_user__username', 'to_user__username')),
+            [('alice', 'bob'), ('bob', 'alice'), ('bob', 'carol'), ('carol', 'bob')])
+
+    def test_only_requests_are_locked(self):
+        ConnectionRequest.objects.create(from_user=self.alice, to_user=self.bob)
+        calls = []
+
+        def select_for_update(qs, **kwargs):
+            calls.append(kwargs)
+            return qs
+
+        with mock.patch.object(db_connection.features, 'has_select_for_update', True), \
+                mock.patch.object(db_connection.features, 'has_select_for_update_of', True), \
+                mock.patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=select_for_update):
+            ConnectionRequest.objects.reject(ConnectionRequest.objects.all())
+        self.assertEqual(calls, [{'of': ('self',)}])
+
+
+class PartnersTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create(username='owner')
+        self.users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        for user, roles in zip(self.users, ({'is_supplier': True}, {'is_costumer': True}, {})):
+            Contact.objects.create(from_user=self.owner, to_user=user, **roles)
+
+    def usernames(self, page):
+        return [partner['username'] for partner in page.partners]
+
+    def test_pages(self):
+        first = Contact.objects.partners(self.owner, limit=1)
+        self.assertEqual(self.usernames(first), ['user0'])
+        self.assertEqual(first.partners[0]['is_supplier'], True)
+        second = Contact.objects.partners(self.owner, cursor=first.next_cursor, limit=1)
+        self.assertEqual((self.usernames(second), second.next_cursor), (['user1'], None))
+        self.assertEqual(self.usernames(Contact.objects.partners(self.owner, roles=[SUPPLIER])), ['user0'])
+
+    def test_one_query_and_cached(self):
+        with self.assertNumQueries(1):
+            Contact.objects.partners(self.owner, limit=None)
+        with self.assertNumQueries(0):
+            page = Contact.objects.partners(self.owner, limit=None)
+        self.assertEqual(page.partners[0], {
+            'id': self.users[0].pk, 'username': 'user0', 'first_name': '', 'last_name': '', 'email': '',
+            'is_supplier': True, 'is_costumer': False,
+        })
+
+    def test_profile_edits_show_up(self):
+        Contact.objects.partners(self.owner)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[0].first_name = 'Ada'
+            self.users[0].save()
+        self.assertEqual(Contact.objects.partners(self.owner).partners[0]['first_name'], 'Ada')
+
+    def test_malformed_cursor(self):
+        self.assertEqual(Contact.objects.partners(self.owner, cursor='nope'), ([], None))
@@ -0,0 +1,133 @@
+"""
+Moves old and fully deleted messages out of the ``Message`` table into
+``ArchivedMessage``, so that the hot table and its indexes only grow with
+recent traffic.
+
+Messages are moved in batches, each in its own transaction, oldest id
+first. A run can be stopped at any time and the next one picks up where
+it left off, since whatever was moved is no longer a candidate.
+
+Rows that point at a moved message are dealt with in the same batch:
+replies keep their ``thread_id`` but lose ``parent_msg``, invoice
+summaries and notifications are dropped, outbox jobs forget the message,
+the unread counters and the search index are updated. Stored XML keeps
+its reference and is released when the archived row is deleted.
+
+Some data is lost on the way, on purpose. A reply still in ``Message``
+can't point at an archived parent, so ``parent_msg`` is cleared and only
+the archived row remembers the link (``ArchivedMessage.parent_msg_id``
+of archived replies is kept). ``InvoiceSummary`` has no archive table,
+the summary of an archived message can be extracted again from its
+stored XML with ``summary_fields_for``.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from django_messages.models import (
+    ArchivedMessage, InvoiceSummary, Message, Notification, OutboxMessage, UnreadCount,
+)
+from django_messages.search import get_search_backend
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'DJANGO_MESSAGES_ARCHIVE_AFTER_DAYS', 365 * 2)
+
+ARCHIVE_FIELDS = [
+    'id', 'subject', 'body', 'sender_id', 'recipient_id', 'parent_msg_id', 'sent_at', 'read_at',
+    'replied_at', 'sender_deleted_at', 'recipient_deleted_at', 'xml', 'xml_type', 'peppol_classic',
+    'thread_id', 'depth',
+]
+
+
+def archivable(older_than=None):
+    """
+    Messages deleted by both sides, or sent before ``older_than`` (a
+    timedelta, defaults to ``DJANGO_MESSAGES_ARCHIVE_AFTER_DAYS``).
+    """
+    if older_than is None:
+        older_than = timedelta(days=ARCHIVE_AFTER_DAYS)
+    return Message.objects.filter(
+        Q(sender_deleted_at__isnull=False, recipient_deleted_at__isnull=False)
+        | Q(sent_at__lt=timezone.now() - older_than)
+    )
+
+
+def partition_name(year):
+    return '%s_y%d' % (ArchivedMessage._meta.db_table, year)
+
+
+def ensure_partitions(connection, years):
+    """
+    Creates the yearly partitions of the archive on PostgreSQL.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    table = connection.ops.quote_name(ArchivedMessage._meta.db_table)
+    with connection.cursor() as cursor:
+        for year in sorted(years):
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%d-01-01') TO ('%d-01-01')"
+                % (connection.ops.quote_name(partition_name(year)), table, year, year + 1)
+            )
+
+
+def archive_batch(batch_size=1000, older_than=None):
+    """
+    Moves up to ``batch_size`` archivable messages and returns how many
+    were moved.
+    """
+    using = Message.objects.db
+    connection = connections[using]
+    now = timezone.now()
+    with transaction.atomic(using=using):
+        qs = archivable(older_than).order_by('pk')
+        if connection.features.has_select_for_update:
+            qs = qs.select_for_update()
+        rows = list(qs.values(*ARCHIVE_FIELDS)[:batch_size])
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+
+        for row in rows:
+            row['sent_at'] = row['sent_at'] or now
+        # partition bounds are in the connection time zone, UTC with USE_TZ
+        ensure_partitions(connection, {
+            (row['sent_at'].astimezone(timezone.utc) if timezone.is_aware(row['sent_at']) else row['sent_at']).year
+            for row in rows
+        })
+        ArchivedMessage.objects.bulk_create([ArchivedMessage(archived_at=now, **row) for row in rows])
+
+        Message.objects.filter(parent_msg_id__in=ids).update(parent_msg=None)
+        OutboxMessage.objects.filter(message_id__in=ids).update(message=None)
+        OutboxMessage.objects.filter(parent_msg_id__in=ids).update(parent_msg=None)
+        InvoiceSummary.objects.filter(message_id__in=ids).delete()
+        Notification.objects.filter(message_id__in=ids).delete()
+        UnreadCount.objects.adjust(_unread_deltas(rows))
+        get_search_backend(using).remove(ids)
+        # the dependants are gone and the XML reference moves with the row,
+        # so skip the collector and the post_delete receivers
+        _delete_rows(connection, ids)
+    return len(ids)
+
+
+def _delete_rows(connection, ids):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM %s WHERE %s IN (%s)" % (
+                connection.ops.quote_name(Message._meta.db_table),
+                connection.ops.quote_name(Message._meta.pk.column),
+                ', '.join(['%s'] * len(ids)),
+            ),
+            ids,
+        )
+
+
+def _unread_deltas(rows):
+    deltas = Counter()
+    for row in rows:
+        if row['recipient_id'] is not None and row['read_at'] is None and row['recipient_deleted_at'] is None:
+            deltas[row['recipient_id']] -= 1
+    return deltas
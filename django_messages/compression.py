@@ -0,0 +1,148 @@
+"""
+Compression helpers for stored XML attachments.
+
+Compressed files keep their name, readers tell them apart by the magic
+bytes at the start of the file, so uncompressed files written before
+compression was turned on keep working.
+
+gzip is always available. zstd needs the optional ``zstandard`` package
+and can use a dictionary trained on UBL documents
+(``DJANGO_MESSAGES_ZSTD_DICT``), which helps a lot on small invoices.
+"""
+import gzip
+import io
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+XML_COMPRESSION = getattr(settings, 'DJANGO_MESSAGES_XML_COMPRESSION', GZIP)
+ZSTD_DICT = getattr(settings, 'DJANGO_MESSAGES_ZSTD_DICT', None)
+ZSTD_LEVEL = getattr(settings, 'DJANGO_MESSAGES_ZSTD_LEVEL', 10)
+GZIP_LEVEL = getattr(settings, 'DJANGO_MESSAGES_GZIP_LEVEL', 6)
+
+_zstd_dict = None
+
+
+def get_zstd_dict():
+    global _zstd_dict
+    if _zstd_dict is None and ZSTD_DICT:
+        with open(ZSTD_DICT, 'rb') as f:
+            _zstd_dict = zstandard.ZstdCompressionDict(f.read())
+    return _zstd_dict
+
+
+def default_algorithm():
+    """
+    The configured algorithm, falling back to gzip when zstandard is not
+    installed.
+    """
+    if XML_COMPRESSION == ZSTD and zstandard is None:
+        return GZIP
+    return XML_COMPRESSION
+
+
+def detect(head):
+    """
+    Returns the algorithm a file starting with ``head`` was compressed
+    with, or ``None`` for a plain file.
+    """
+    if head.startswith(GZIP_MAGIC):
+        return GZIP
+    if head.startswith(ZSTD_MAGIC):
+        return ZSTD
+    return None
+
+
+class _GzipReader(gzip.GzipFile):
+    """
+    Closes the underlying file together with the reader.
+    """
+
+    def close(self):
+        fileobj = self.fileobj
+        super(_GzipReader, self).close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+class _ZstdWriter(io.RawIOBase):
+    """
+    Keeps the underlying file open when the compressor is closed, like
+    ``GzipFile(fileobj=...)`` does.
+    """
+
+    def __init__(self, fileobj, level):
+        self._writer = zstandard.ZstdCompressor(
+            level=level, dict_data=get_zstd_dict(), write_checksum=True,
+        ).stream_writer(fileobj, closefd=False)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._writer.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._writer.flush(zstandard.FLUSH_FRAME)
+            self._writer.close()
+        super(_ZstdWriter, self).close()
+
+
+def compressing_writer(fileobj, algorithm=None):
+    """
+    Wraps a binary file so that everything written to it is compressed.
+    Closing the wrapper finishes the stream but leaves ``fileobj`` open.
+    """
+    algorithm = algorithm or default_algorithm()
+    if algorithm == ZSTD:
+        if zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+        return _ZstdWriter(fileobj, ZSTD_LEVEL)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompressing_reader(fileobj):
+    """
+    Returns a binary file object reading the decompressed content of
+    ``fileobj``, which must be seekable. Plain files are returned as-is.
+    Closing the reader closes ``fileobj``.
+    """
+    head = fileobj.read(4)
+    fileobj.seek(0)
+    algorithm = detect(head)
+    if algorithm == GZIP:
+        return _GzipReader(fileobj=fileobj, mode='rb')
+    if algorithm == ZSTD:
+        if zstandard is None:
+            raise ImportError("reading zstd compressed files needs the zstandard package")
+        reader = zstandard.ZstdDecompressor(dict_data=get_zstd_dict()).stream_reader(fileobj)
+        return io.BufferedReader(reader)
+    return fileobj
+
+
+def open_decompressed(path):
+    """
+    Opens a file on disk for reading its decompressed content.
+    """
+    return decompressing_reader(open(path, 'rb'))
+
+
+def train_zstd_dict(samples, size=112640):
+    """
+    Trains a zstd dictionary from a list of sample documents (bytes).
+    """
+    if zstandard is None:
+        raise ImportError("training a zstd dictionary needs the zstandard package")
+    return zstandard.train_dictionary(size, samples).as_bytes()
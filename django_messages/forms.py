@@ -10,13 +10,13 @@ else:
 
 from django_messages.models import Message , MessageManager
 
-from django_messages.utils import get_user_model
+from django_messages.utils import get_invoice_template, get_user_model
+from django_messages.validation import VALIDATE_XML, check_file
 from connection.models import Contact
 from connection.exceptions import AlreadyExistsError
 
 from django.contrib.auth.models import User
 from connection.models import Contact, ConnectionManager , ConnectionRequest
-from django.core.files.base import File
 
 
 def my_username(request):
@@ -37,14 +37,15 @@ class ComposeForm(forms.Form):
     A simple default form for private messages.
 
     """
-    def save(self, sender, recipient, xml_type ,peppol_classic, parent_msg=None ,):
+    def save(self, sender, recipient, xml_type ,peppol_classic, parent_msg=None , xml=None):
         recipient = recipient
         xml_type = xml_type
         subject = 'Invoice'
         body = 'Yooo we send you the Invoice for your order.'
-        # Using File
-        f = open('peppol-bis-invoice-3.xml')
-        xml = File(f)
+        if xml is None:
+            xml = get_invoice_template()
+        if VALIDATE_XML:
+            check_file(xml)
 
         peppol_classic = peppol_classic
         message_list = []
@@ -58,6 +59,7 @@ class ComposeForm(forms.Form):
             xml_type = xml_type,
             peppol_classic = peppol_classic,
         )
+        # raises BlockedError before anything is written
         try:
             Contact.objects.add_connection(sender, recipient)
         except AlreadyExistsError:
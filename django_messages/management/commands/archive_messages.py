@@ -0,0 +1,36 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from django_messages.archive import ARCHIVE_AFTER_DAYS, archive_batch
+
+
+class Command(BaseCommand):
+    help = ("Moves messages deleted by both sides or older than the cut-off to the archive. "
+            "Safe to interrupt, the next run carries on.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+            help="Archive messages sent more than this many days ago.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of messages moved per transaction.")
+        parser.add_argument('--max-batches', type=int, default=None,
+            help="Stop after this many batches.")
+        parser.add_argument('--sleep', type=float, default=0,
+            help="Seconds to wait between batches, to go easy on the database.")
+
+    def handle(self, *args, **options):
+        older_than = timedelta(days=options['days'])
+        total = batches = 0
+        while options['max_batches'] is None or batches < options['max_batches']:
+            moved = archive_batch(batch_size=options['batch_size'], older_than=older_than)
+            if not moved:
+                break
+            total += moved
+            batches += 1
+            self.stdout.write("%d messages archived" % total)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS("%d messages archived" % total))
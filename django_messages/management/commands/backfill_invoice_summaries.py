@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from lxml import etree
+
+from django_messages.models import InvoiceSummary, Message
+from django_messages.summary import summary_fields_for
+
+
+class Command(BaseCommand):
+    help = "Creates the missing invoice summaries for messages with an XML attachment."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of summaries written per insert.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        qs = (
+            Message.objects.filter(invoice_summary__isnull=True)
+            .exclude(xml='')
+            .only('pk', 'xml')
+            .order_by('pk')
+        )
+
+        created = failed = 0
+        batch = []
+        for message in qs.iterator(chunk_size=batch_size):
+            try:
+                values = summary_fields_for(message.xml)
+            except (etree.XMLSyntaxError, OSError, ValueError) as e:
+                failed += 1
+                self.stderr.write("Message %s: %s" % (message.pk, e))
+                continue
+            batch.append(InvoiceSummary(message_id=message.pk, **values))
+            if len(batch) >= batch_size:
+                InvoiceSummary.objects.bulk_create(batch, ignore_conflicts=True)
+                created += len(batch)
+                batch = []
+                self.stdout.write("%d summaries created" % created)
+        if batch:
+            InvoiceSummary.objects.bulk_create(batch, ignore_conflicts=True)
+            created += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            "%d summaries created, %d attachments could not be read" % (created, failed)))
@@ -0,0 +1,132 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from django_messages.models import Message
+
+USER_PREFIX = 'bench-mailbox-'
+
+# (name, queryset given the manager of the benchmark database and a
+# user, how the timed runs evaluate it)
+QUERIES = (
+    ('inbox_for', lambda messages, user: messages.inbox_for(user)[:50], list),
+    ('outbox_for', lambda messages, user: messages.outbox_for(user)[:50], list),
+    ('trash_for', lambda messages, user: messages.trash_for(user)[:50], list),
+    ('unread_count', lambda messages, user: messages.filter(
+        recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True), QuerySet.count),
+)
+
+
+class Command(BaseCommand):
+    help = ("Seeds a large mailbox and prints query plans and timings of the "
+            "MessageManager queries without and with the mailbox indexes. "
+            "It drops and recreates indexes, so it refuses to run against "
+            "the default database unless --force is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help="Database alias to benchmark, a copy set up for it.")
+        parser.add_argument('--force', action='store_true',
+            help="Run against the default database anyway.")
+        parser.add_argument('--seed', action='store_true',
+            help="Create the benchmark users and messages first.")
+        parser.add_argument('--messages', type=int, default=1000000,
+            help="Number of messages to seed.")
+        parser.add_argument('--users', type=int, default=1000,
+            help="Number of users to spread the messages over.")
+        parser.add_argument('--runs', type=int, default=20,
+            help="Number of timed runs per query.")
+        parser.add_argument('--cleanup', action='store_true',
+            help="Delete the benchmark data afterwards.")
+
+    def seed(self, using, message_count, user_count):
+        User.objects.using(using).bulk_create(
+            [User(username='%s%d' % (USER_PREFIX, i)) for i in range(user_count)],
+            ignore_conflicts=True,
+        )
+        user_ids = list(User.objects.using(using).filter(
+            username__startswith=USER_PREFIX).values_list('pk', flat=True))
+        now = timezone.now()
+        rng = random.Random(42)
+        batch_size = 10000
+        created = 0
+        while created < message_count:
+            batch = []
+            for i in range(min(batch_size, message_count - created)):
+                sent_at = now - timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+                batch.append(Message(
+                    subject='Invoice',
+                    body='Benchmark message',
+                    sender_id=rng.choice(user_ids),
+                    recipient_id=rng.choice(user_ids),
+                    sent_at=sent_at,
+                    read_at=sent_at if rng.random() < 0.7 else None,
+                    recipient_deleted_at=sent_at if rng.random() < 0.1 else None,
+                    sender_deleted_at=sent_at if rng.random() < 0.1 else None,
+                    xml_type='invoice',
+                ))
+            Message.objects.using(using).bulk_create(batch)
+            created += len(batch)
+            self.stdout.write("%d/%d messages seeded" % (created, message_count))
+        self.analyze(using)
+
+    def analyze(self, using):
+        connection = connections[using]
+        if connection.vendor in ('sqlite', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def measure(self, label, using, users, runs):
+        messages = Message.objects.db_manager(using)
+        self.stdout.write(self.style.MIGRATE_HEADING("== %s" % label))
+        for name, build, evaluate in QUERIES:
+            self.stdout.write("-- %s" % name)
+            self.stdout.write(build(messages, users[0]).explain())
+        for name, build, evaluate in QUERIES:
+            timings = []
+            for i in range(runs):
+                user = users[i % len(users)]
+                started = time.perf_counter()
+                evaluate(build(messages, user))
+                timings.append((time.perf_counter() - started) * 1000)
+            self.stdout.write("%-16s median %8.2f ms   max %8.2f ms" % (
+                name, statistics.median(timings), max(timings)))
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if using == DEFAULT_DB_ALIAS and not options['force']:
+            raise CommandError("Refusing to drop indexes of the default database, pass "
+                               "--database with the alias of a benchmark database or --force")
+        connection = connections[using]
+
+        if options['seed']:
+            self.seed(using, options['messages'], options['users'])
+
+        users = list(User.objects.using(using).filter(username__startswith=USER_PREFIX).order_by('?')[:10])
+        if not users:
+            raise CommandError("No benchmark data, run with --seed first")
+
+        indexes = Message._meta.indexes
+        if connection.features.supports_partial_indexes:
+            with connection.schema_editor() as schema_editor:
+                for index in indexes:
+                    schema_editor.remove_index(Message, index)
+            try:
+                self.measure("without mailbox indexes", using, users, options['runs'])
+            finally:
+                with connection.schema_editor() as schema_editor:
+                    for index in indexes:
+                        schema_editor.add_index(Message, index)
+            self.analyze(using)
+        self.measure("with mailbox indexes", using, users, options['runs'])
+
+        if options['cleanup']:
+            Message.objects.using(using).filter(sender__username__startswith=USER_PREFIX).delete()
+            User.objects.using(using).filter(username__startswith=USER_PREFIX).delete()
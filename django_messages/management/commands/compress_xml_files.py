@@ -0,0 +1,130 @@
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from django_messages.compression import (
+    ZSTD, compressing_writer, default_algorithm, detect, open_decompressed, train_zstd_dict, zstandard,
+)
+from django_messages.models import Message
+from django_messages.storage import CompressionMixin
+
+
+def compress_file(path, algorithm):
+    """
+    Compresses one file in place. The compressed copy is written next to
+    it and moved over the original, so readers always see a whole file.
+    Returns ``(size before, size after)``, or ``None`` when there was
+    nothing to do.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        if detect(f.read(4)) is not None:
+            return None
+        f.seek(0)
+        before = os.fstat(f.fileno()).st_size
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                writer = compressing_writer(out, algorithm)
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    writer.write(chunk)
+                writer.close()
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return before, os.path.getsize(path)
+
+
+def _compress_chunk(paths, algorithm):
+    results = []
+    for path in paths:
+        try:
+            results.append(compress_file(path, algorithm))
+        except (OSError, ValueError):
+            results.append(False)
+    return results
+
+
+class Command(BaseCommand):
+    help = "Compresses stored message XML files in place."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+            help="Number of compression processes, defaults to the number of CPUs.")
+        parser.add_argument('--algorithm', choices=['gzip', 'zstd'], default=None,
+            help="Defaults to DJANGO_MESSAGES_XML_COMPRESSION.")
+        parser.add_argument('--chunk-size', type=int, default=100,
+            help="Number of files handed to a worker at once.")
+        parser.add_argument('--train-dict', metavar='PATH', default=None,
+            help="Train a zstd dictionary from stored files, write it to PATH and exit.")
+        parser.add_argument('--samples', type=int, default=1000,
+            help="Number of files to train the dictionary on.")
+
+    def paths(self):
+        storage = Message._meta.get_field('xml').storage
+        names = Message.objects.exclude(xml='').values_list('xml', flat=True).distinct()
+        return [storage.path(name) for name in names.iterator()]
+
+    def handle(self, *args, **options):
+        storage = Message._meta.get_field('xml').storage
+        if not isinstance(storage, CompressionMixin):
+            raise CommandError(
+                "DJANGO_MESSAGES_XML_STORAGE must be a compressing storage, "
+                "otherwise compressed files could not be read back")
+        paths = self.paths()
+
+        if options['train_dict']:
+            if zstandard is None:
+                raise CommandError("Training a dictionary needs the zstandard package")
+            samples = []
+            for path in random.sample(paths, min(options['samples'], len(paths))):
+                with open_decompressed(path) as f:
+                    samples.append(f.read())
+            try:
+                dict_data = train_zstd_dict(samples)
+            except zstandard.ZstdError as e:
+                raise CommandError("Could not train a dictionary on %d files: %s" % (len(samples), e))
+            with open(options['train_dict'], 'wb') as f:
+                f.write(dict_data)
+            self.stdout.write(self.style.SUCCESS(
+                "Dictionary trained on %d files written to %s" % (len(samples), options['train_dict'])))
+            return
+
+        algorithm = options['algorithm'] or default_algorithm()
+        if algorithm == ZSTD and zstandard is None:
+            raise CommandError("zstd compression needs the zstandard package")
+
+        chunk_size = options['chunk_size']
+        chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+        compressed = skipped = failed = 0
+        before_total = after_total = 0
+
+        # children inherit the parent's sockets, never share them
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            for results in executor.map(_compress_chunk, chunks, [algorithm] * len(chunks)):
+                for result in results:
+                    if result is None:
+                        skipped += 1
+                    elif result is False:
+                        failed += 1
+                    else:
+                        compressed += 1
+                        before_total += result[0]
+                        after_total += result[1]
+                self.stdout.write("%d/%d files done" % (compressed + skipped + failed, len(paths)))
+
+        ratio = before_total / after_total if after_total else 0
+        self.stdout.write(self.style.SUCCESS(
+            "%d files compressed (%.1fx, %d -> %d bytes), %d already compressed or missing, %d failed"
+            % (compressed, ratio, before_total, after_total, skipped, failed)))
@@ -0,0 +1,57 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from django_messages.models import OutboxMessage
+from django_messages.outbox import OUTBOX_MAX_ATTEMPTS, process_batch
+
+
+class Command(BaseCommand):
+    help = "Sends queued messages from the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+            help="Number of pool workers delivering messages.")
+        parser.add_argument('--mode', choices=['thread', 'process'], default='thread',
+            help="Run the pool with threads or processes.")
+        parser.add_argument('--batch-size', type=int, default=100,
+            help="Number of jobs claimed per round.")
+        parser.add_argument('--max-attempts', type=int, default=OUTBOX_MAX_ATTEMPTS,
+            help="Mark a job as failed after this many attempts.")
+        parser.add_argument('--loop', action='store_true',
+            help="Keep polling for new jobs instead of exiting when the queue is empty.")
+        parser.add_argument('--sleep', type=float, default=1.0,
+            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument('--stale-after', type=int, default=600,
+            help="Requeue jobs claimed more than this many seconds ago.")
+
+    def handle(self, *args, **options):
+        requeued = OutboxMessage.objects.requeue_stale(timedelta(seconds=options['stale_after']))
+        if requeued:
+            self.stdout.write("Requeued %d stale jobs" % requeued)
+
+        total_sent = total_failed = 0
+        started = time.monotonic()
+        while True:
+            claimed, sent, failed = process_batch(
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                mode=options['mode'],
+                max_attempts=options['max_attempts'],
+            )
+            if claimed:
+                total_sent += sent
+                total_failed += failed
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    "Processed %d jobs (%d sent, %d failed), %d sent in total, %.1f/s"
+                    % (claimed, sent, failed, total_sent, total_sent / elapsed if elapsed else 0)
+                )
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Outbox empty, %d sent, %d failed" % (total_sent, total_failed)))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from django_messages.threads import rebuild_threads
+
+
+class Command(BaseCommand):
+    help = "Recomputes the conversation of every message from its parent_msg chain."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of messages written per query.")
+
+    def handle(self, *args, **options):
+        updated = rebuild_threads(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("%d messages updated" % updated))
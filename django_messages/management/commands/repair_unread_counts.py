@@ -0,0 +1,35 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from django_messages.models import UnreadCount
+
+
+class Command(BaseCommand):
+    help = "Recomputes the unread message counters from the messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*',
+            help="Only repair these users, defaults to everyone.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of users recounted per query.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        users = get_user_model().objects.order_by('pk')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+
+        repaired = 0
+        batch = []
+        for user_id in users.values_list('pk', flat=True).iterator(chunk_size=batch_size):
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                UnreadCount.objects.recount(batch)
+                repaired += len(batch)
+                batch = []
+                self.stdout.write("%d counters repaired" % repaired)
+        if batch:
+            UnreadCount.objects.recount(batch)
+            repaired += len(batch)
+
+        self.stdout.write(self.style.SUCCESS("%d counters repaired" % repaired))
@@ -0,0 +1,49 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from django_messages.models import Notification
+from django_messages.notifications import NOTIFY_DIGEST, NOTIFY_MAX_ATTEMPTS, send_batch
+
+
+class Command(BaseCommand):
+    help = "Sends queued new message emails."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+            help="Number of notifications claimed per round.")
+        parser.add_argument('--digest', action='store_true', default=NOTIFY_DIGEST,
+            help="Collapse the notifications of a round to the same recipient into one email.")
+        parser.add_argument('--max-attempts', type=int, default=NOTIFY_MAX_ATTEMPTS,
+            help="Mark a notification as failed after this many attempts.")
+        parser.add_argument('--loop', action='store_true',
+            help="Keep polling for new notifications instead of exiting when the queue is empty.")
+        parser.add_argument('--sleep', type=float, default=5.0,
+            help="Seconds to wait between polls when the queue is empty.")
+        parser.add_argument('--stale-after', type=int, default=600,
+            help="Requeue notifications claimed more than this many seconds ago.")
+
+    def handle(self, *args, **options):
+        requeued = Notification.objects.requeue_stale(timedelta(seconds=options['stale_after']))
+        if requeued:
+            self.stdout.write("Requeued %d stale notifications" % requeued)
+
+        total_sent = total_failed = 0
+        while True:
+            claimed, sent, failed = send_batch(
+                batch_size=options['batch_size'],
+                digest=options['digest'],
+                max_attempts=options['max_attempts'],
+            )
+            if claimed:
+                total_sent += sent
+                total_failed += failed
+                self.stdout.write("Processed %d notifications (%d sent, %d failed)" % (claimed, sent, failed))
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(
+            "Queue empty, %d sent, %d failed" % (total_sent, total_failed)))
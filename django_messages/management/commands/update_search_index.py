@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from django_messages.models import Message
+from django_messages.search import get_search_backend, index_messages
+
+
+class Command(BaseCommand):
+    help = "Adds the messages missing from the search index, or rebuilds it."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+            help="Empty the index and index every message again.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help="Number of messages indexed at once.")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        batch_size = options['batch_size']
+        if options['rebuild']:
+            backend.clear()
+
+        qs = Message.objects.only('pk', 'subject', 'body', 'xml', 'sender', 'recipient').order_by('pk')
+        indexed = 0
+        batch = []
+        for message in qs.iterator(chunk_size=batch_size):
+            batch.append(message)
+            if len(batch) >= batch_size:
+                indexed += self.index(backend, batch, options['rebuild'])
+                batch = []
+                self.stdout.write("%d messages indexed" % indexed)
+        if batch:
+            indexed += self.index(backend, batch, options['rebuild'])
+
+        self.stdout.write(self.style.SUCCESS("%d messages indexed" % indexed))
+
+    def index(self, backend, messages, rebuild):
+        if not rebuild:
+            present = backend.indexed([message.pk for message in messages])
+            messages = [message for message in messages if message.pk not in present]
+        index_messages(messages)
+        return len(messages)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from django_messages.models import Message
+from django_messages.validation import is_valid, validate_many
+
+
+class Command(BaseCommand):
+    help = "Validates the XML attached to messages against the UBL XSD and Schematron rules."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+            help="Number of validation processes, defaults to the number of CPUs.")
+        parser.add_argument('--since', type=int, default=0,
+            help="Only validate messages with an id greater than this.")
+        parser.add_argument('--limit', type=int, default=None,
+            help="Validate at most this many messages.")
+        parser.add_argument('--verbose-issues', action='store_true',
+            help="Print every issue instead of a count per file.")
+
+    def handle(self, *args, **options):
+        qs = Message.objects.filter(pk__gt=options['since']).exclude(xml='').order_by('pk')
+        if options['limit']:
+            qs = qs[:options['limit']]
+
+        # deduplicated attachments are shared, validate every file once
+        names = {}
+        for pk, name in qs.values_list('pk', 'xml').iterator():
+            names.setdefault(name, []).append(pk)
+        if not names:
+            self.stdout.write("Nothing to validate")
+            return
+
+        storage = Message._meta.get_field('xml').storage
+        paths = [storage.path(name) for name in names]
+        results = validate_many(paths, workers=options['workers'])
+
+        invalid = 0
+        for (name, pks), issues in zip(names.items(), results):
+            if is_valid(issues):
+                continue
+            invalid += 1
+            self.stdout.write("%s (messages %s): %d issues" % (
+                name, ', '.join(map(str, pks[:10])), len(issues)))
+            if options['verbose_issues']:
+                for issue in issues:
+                    self.stdout.write("  [%s] %s %s: %s" % (
+                        issue.stage, issue.severity, issue.rule or issue.location or '', issue.message))
+
+        style = self.style.ERROR if invalid else self.style.SUCCESS
+        self.stdout.write(style("%d files checked, %d invalid" % (len(names), invalid)))
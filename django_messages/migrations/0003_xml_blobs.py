@@ -0,0 +1,35 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:28
+
+from django.db import migrations, models
+import django.utils.timezone
+import django_messages.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0002_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XmlBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256')),
+                ('name', models.CharField(max_length=254, unique=True, verbose_name='Name')),
+                ('size', models.PositiveIntegerField(verbose_name='Size')),
+                ('refcount', models.PositiveIntegerField(default=0, verbose_name='References')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='created at')),
+            ],
+            options={
+                'verbose_name': 'XML blob',
+                'verbose_name_plural': 'XML blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='xml',
+            field=models.FileField(max_length=254, storage=django_messages.storage.get_xml_storage, upload_to=None),
+        ),
+    ]
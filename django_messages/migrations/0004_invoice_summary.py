@@ -0,0 +1,34 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0003_xml_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceSummary',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='invoice_summary', serialize=False, to='django_messages.message', verbose_name='Message')),
+                ('document_type', models.CharField(blank=True, max_length=20, verbose_name='Document type')),
+                ('invoice_id', models.CharField(blank=True, db_index=True, max_length=100, verbose_name='Invoice ID')),
+                ('issue_date', models.DateField(blank=True, db_index=True, null=True, verbose_name='Issue date')),
+                ('due_date', models.DateField(blank=True, db_index=True, null=True, verbose_name='Due date')),
+                ('currency', models.CharField(blank=True, max_length=3, verbose_name='Currency')),
+                ('seller_endpoint', models.CharField(blank=True, db_index=True, max_length=100, verbose_name='Seller endpoint')),
+                ('seller_scheme', models.CharField(blank=True, max_length=10, verbose_name='Seller scheme')),
+                ('buyer_endpoint', models.CharField(blank=True, db_index=True, max_length=100, verbose_name='Buyer endpoint')),
+                ('buyer_scheme', models.CharField(blank=True, max_length=10, verbose_name='Buyer scheme')),
+                ('payable_amount', models.DecimalField(blank=True, decimal_places=4, max_digits=19, null=True, verbose_name='Payable amount')),
+            ],
+            options={
+                'verbose_name': 'Invoice summary',
+                'verbose_name_plural': 'Invoice summaries',
+            },
+        ),
+    ]
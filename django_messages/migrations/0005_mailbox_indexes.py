@@ -0,0 +1,59 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:34
+
+from django.db import migrations, models
+
+# plain composite indexes for backends that skip the partial ones, the
+# columns of the partial conditions lead followed by the columns of the
+# partial indexes in Message.Meta.indexes
+FALLBACK_INDEXES = [
+    models.Index(fields=['recipient', 'recipient_deleted_at', '-sent_at', '-id'], name='dm_inbox_fb_idx'),
+    models.Index(fields=['recipient', 'recipient_deleted_at', 'read_at', '-sent_at'], name='dm_unread_fb_idx'),
+    models.Index(fields=['sender', 'sender_deleted_at', '-sent_at', '-id'], name='dm_outbox_fb_idx'),
+]
+
+
+def add_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    Message = apps.get_model('django_messages', 'Message')
+    for index in FALLBACK_INDEXES:
+        schema_editor.add_index(Message, index)
+
+
+def remove_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    Message = apps.get_model('django_messages', 'Message')
+    for index in FALLBACK_INDEXES:
+        schema_editor.remove_index(Message, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0004_invoice_summary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('recipient_deleted_at__isnull', True)), fields=['recipient', '-sent_at'], name='dm_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read_at__isnull', True), ('recipient_deleted_at__isnull', True)), fields=['recipient', '-sent_at'], name='dm_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('sender_deleted_at__isnull', True)), fields=['sender', '-sent_at'], name='dm_outbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('recipient_deleted_at__isnull', False)), fields=['recipient', '-sent_at'], name='dm_trash_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('sender_deleted_at__isnull', False)), fields=['sender', '-sent_at'], name='dm_trash_sender_idx'),
+        ),
+        migrations.RunPython(add_fallback_indexes, remove_fallback_indexes),
+    ]
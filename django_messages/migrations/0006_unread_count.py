@@ -0,0 +1,27 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_messages', '0005_mailbox_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+                ('count', models.IntegerField(default=0, verbose_name='Unread messages')),
+            ],
+            options={
+                'verbose_name': 'Unread count',
+                'verbose_name_plural': 'Unread counts',
+            },
+        ),
+    ]
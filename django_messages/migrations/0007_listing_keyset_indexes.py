@@ -0,0 +1,45 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0006_unread_count'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='dm_inbox_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='dm_outbox_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='dm_trash_recipient_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='dm_trash_sender_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('recipient_deleted_at__isnull', True)), fields=['recipient', '-sent_at', '-id'], name='dm_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('sender_deleted_at__isnull', True)), fields=['sender', '-sent_at', '-id'], name='dm_outbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('recipient_deleted_at__isnull', False)), fields=['recipient', '-sent_at', '-id'], name='dm_trash_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('sender_deleted_at__isnull', False)), fields=['sender', '-sent_at', '-id'], name='dm_trash_sender_idx'),
+        ),
+    ]
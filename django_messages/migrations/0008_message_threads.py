@@ -0,0 +1,33 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:38
+
+from django.db import migrations, models
+
+
+def backfill_threads(apps, schema_editor):
+    from django_messages.threads import rebuild_threads
+    rebuild_threads(apps.get_model('django_messages', 'Message'), schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0007_listing_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, verbose_name='Depth'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thread_id',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Thread'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_id', 'sent_at', 'id'], name='dm_thread_idx'),
+        ),
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+    ]
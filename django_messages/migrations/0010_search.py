@@ -0,0 +1,48 @@
+from django.db import migrations
+
+# the search table is not a model, its shape depends on the backend and
+# backends without full text search are searched with LIKE queries instead.
+# Existing messages are indexed by the update_search_index command.
+SQLITE_TABLE = (
+    "CREATE VIRTUAL TABLE django_messages_search USING fts5("
+    "subject, body, invoice, owners, tokenize='unicode61 remove_diacritics %d')"
+)
+POSTGRES_TABLE = (
+    "CREATE TABLE django_messages_search ("
+    "message_id integer PRIMARY KEY REFERENCES django_messages_message (id) "
+    "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)"
+)
+POSTGRES_INDEX = "CREATE INDEX django_messages_search_document ON django_messages_search USING GIN (document)"
+
+
+def create_search_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                return
+        # remove_diacritics 2 needs SQLite 3.27, 1 leaves a few letters
+        # with several diacritics alone
+        remove_diacritics = 2 if connection.Database.sqlite_version_info >= (3, 27) else 1
+        schema_editor.execute(SQLITE_TABLE % remove_diacritics)
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_TABLE)
+        schema_editor.execute(POSTGRES_INDEX)
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute("DROP TABLE IF EXISTS django_messages_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0009_notifications'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
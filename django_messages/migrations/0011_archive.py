@@ -0,0 +1,100 @@
+# Generated by Django 3.2.5 on 2026-10-16 22:45
+
+from django.db import migrations, models
+import django.utils.timezone
+import django_messages.storage
+
+ARCHIVE_TABLE = 'django_messages_archivedmessage'
+
+# (column, field type, null, type parameters), in the order of Message so
+# that both tables can be read in one UNION
+ARCHIVE_COLUMNS = [
+    ('id', 'IntegerField', False, {}),
+    ('subject', 'CharField', False, {'max_length': 140}),
+    ('body', 'TextField', False, {}),
+    ('sender_id', 'IntegerField', False, {}),
+    ('recipient_id', 'IntegerField', True, {}),
+    ('parent_msg_id', 'IntegerField', True, {}),
+    ('sent_at', 'DateTimeField', False, {}),
+    ('read_at', 'DateTimeField', True, {}),
+    ('replied_at', 'DateTimeField', True, {}),
+    ('sender_deleted_at', 'DateTimeField', True, {}),
+    ('recipient_deleted_at', 'DateTimeField', True, {}),
+    ('xml', 'CharField', False, {'max_length': 254}),
+    ('xml_type', 'CharField', True, {'max_length': 20}),
+    ('peppol_classic', 'BooleanField', False, {}),
+    ('thread_id', 'IntegerField', True, {}),
+    ('depth', 'IntegerField', False, {}),
+    ('archived_at', 'DateTimeField', False, {}),
+]
+ARCHIVE_INDEXES = [
+    ('dm_archive_recipient_idx', ['recipient_id', 'sent_at', 'id']),
+    ('dm_archive_sender_idx', ['sender_id', 'sent_at', 'id']),
+    ('dm_archive_thread_idx', ['thread_id']),
+]
+
+
+def create_archive_table(apps, schema_editor):
+    """
+    The archive is created by hand, on PostgreSQL it is partitioned by
+    range of sent_at, which needs sent_at in the primary key. Partitions
+    are added by the archiver as it needs them.
+    """
+    connection = schema_editor.connection
+    quote = schema_editor.quote_name
+    columns = [
+        '%s %s %s' % (quote(name), connection.data_types[field_type] % params, 'NULL' if null else 'NOT NULL')
+        for name, field_type, null, params in ARCHIVE_COLUMNS
+    ]
+    if connection.vendor == 'postgresql':
+        columns.append('PRIMARY KEY (%s, %s)' % (quote('id'), quote('sent_at')))
+        suffix = ' PARTITION BY RANGE (%s)' % quote('sent_at')
+    else:
+        columns.append('PRIMARY KEY (%s)' % quote('id'))
+        suffix = ''
+    schema_editor.execute('CREATE TABLE %s (%s)%s' % (quote(ARCHIVE_TABLE), ', '.join(columns), suffix))
+    for name, fields in ARCHIVE_INDEXES:
+        schema_editor.execute('CREATE INDEX %s ON %s (%s)' % (
+            quote(name), quote(ARCHIVE_TABLE), ', '.join(quote(field) for field in fields)))
+
+
+def drop_archive_table(apps, schema_editor):
+    schema_editor.execute('DROP TABLE %s' % schema_editor.quote_name(ARCHIVE_TABLE))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_messages', '0010_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('subject', models.CharField(max_length=140, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('parent_msg_id', models.IntegerField(blank=True, null=True, verbose_name='Parent message')),
+                ('sent_at', models.DateTimeField(verbose_name='sent at')),
+                ('read_at', models.DateTimeField(blank=True, null=True, verbose_name='read at')),
+                ('replied_at', models.DateTimeField(blank=True, null=True, verbose_name='replied at')),
+                ('sender_deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Sender deleted at')),
+                ('recipient_deleted_at', models.DateTimeField(blank=True, null=True, verbose_name='Recipient deleted at')),
+                ('xml', models.FileField(max_length=254, storage=django_messages.storage.get_xml_storage, upload_to=None)),
+                ('xml_type', models.CharField(max_length=20, null=True)),
+                ('peppol_classic', models.BooleanField(default=False)),
+                ('thread_id', models.PositiveIntegerField(blank=True, null=True, verbose_name='Thread')),
+                ('depth', models.PositiveIntegerField(default=0, verbose_name='Depth')),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='archived at')),
+            ],
+            options={
+                'verbose_name': 'Archived message',
+                'verbose_name_plural': 'Archived messages',
+                'db_table': 'django_messages_archivedmessage',
+                'ordering': ['-sent_at'],
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_archive_table, drop_archive_table),
+    ]
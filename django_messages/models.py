@@ -1,52 +1,303 @@
+import time
+from collections import defaultdict, namedtuple
+
 from django.conf import settings
+from django.core.cache import cache
 try:
     from django.core.urlresolvers import reverse
 except ImportError:
     from django.urls import reverse
-from django.db import models
-from django.db.models import signals
+from django.db import connections, models, transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, signals
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_str
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from six import python_2_unicode_compatible
 from django.utils.translation import gettext_lazy as _
 from connection.models import Contact
+from django_messages.storage import get_xml_storage
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
+PAGE_SIZE = getattr(settings, 'DJANGO_MESSAGES_PAGE_SIZE', 50)
+UNREAD_CACHE_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_UNREAD_CACHE_TIMEOUT', 60 * 60)
+UNREAD_VERSION_KEY = "django_messages:unread-version:%s"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+MessagePage = namedtuple('MessagePage', ['messages', 'next_cursor'])
+
+# sent_at alone is not unique, the id breaks ties
+LISTING_ORDER = ('-sent_at', '-id')
+
+
+def encode_cursor(message):
+    """
+    Returns an opaque cursor pointing right after ``message``
+    """
+    raw = "%s|%s" % (message.sent_at.isoformat(), message.pk)
+    return urlsafe_base64_encode(raw.encode())
+
+
+def decode_cursor(cursor):
+    """
+    Returns the ``(sent_at, id)`` key stored in a cursor
+    """
+    try:
+        sent_at, pk = force_str(urlsafe_base64_decode(cursor)).split('|')
+        sent_at, pk = parse_datetime(sent_at), int(pk)
+    except (TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor: %r" % cursor)
+    if sent_at is None:
+        raise InvalidCursor("Invalid cursor: %r" % cursor)
+    return sent_at, pk
 
 
 class MessageManager(models.Manager):
 
+    def _related(self, queryset, related):
+        if related:
+            return queryset.select_related('sender', 'recipient')
+        return queryset
+
+    def _after(self, queryset, cursor):
+        if cursor is None:
+            return queryset
+        sent_at, pk = decode_cursor(cursor)
+        # the sent_at__lte bound lets the index seek straight to the cursor
+        return queryset.filter(Q(sent_at__lt=sent_at) | Q(pk__lt=pk), sent_at__lte=sent_at)
+
+    def _page(self, queryset, limit):
+        messages = list(queryset[:limit + 1])
+        if len(messages) > limit:
+            return MessagePage(messages[:limit], encode_cursor(messages[limit - 1]))
+        return MessagePage(messages, None)
+
+    def _parts(self, filters, archived):
+        """
+        One queryset per filter, and per filter on the archive as well when
+        ``archived`` is set.
+        """
+        parts = [self.filter(q) for q in filters]
+        if archived:
+            parts += [ArchivedMessage.objects.using(self.db).filter(q) for q in filters]
+        return parts
+
+    def _finish(self, queryset, related, archived):
+        queryset = self._related(queryset, related)
+        if archived:
+            # archive rows line up with Message and come back as (read-only)
+            # messages with ``archived`` set
+            from_archive = queryset.model is ArchivedMessage
+            if from_archive:
+                queryset = queryset.defer('archived_at')
+            queryset = queryset.annotate(archived=models.Value(from_archive, output_field=models.BooleanField()))
+        return queryset
+
+    def _listing(self, filters, related, archived):
+        parts = [self._finish(qs, related, archived).order_by() for qs in self._parts(filters, archived)]
+        if len(parts) == 1:
+            return parts[0].order_by(*LISTING_ORDER)
+        return parts[0].union(*parts[1:]).order_by(*LISTING_ORDER)
+
+    def _listing_page(self, filters, cursor, limit, related, archived):
+        # a message without sent_at has no place in the keyset order and
+        # could not be encoded in a cursor, pages leave them out
+        filters = [q & Q(sent_at__isnull=False) for q in filters]
+        parts = self._parts(filters, archived)
+        if len(parts) == 1:
+            return self._page(self._after(self._finish(parts[0], related, archived).order_by(*LISTING_ORDER), cursor), limit)
+        # each part of the UNION is cut to one page before they are merged
+        branches = []
+        for qs in parts:
+            qs = self._after(qs, cursor).order_by(*LISTING_ORDER)[:limit + 1]
+            if connections[self.db].features.supports_slicing_ordering_in_compound:
+                qs = self._finish(qs, related, archived)
+            else:
+                # e.g. SQLite, which can not LIMIT the parts of a UNION
+                qs = self._finish(qs.model._default_manager.using(self.db).filter(
+                    pk__in=qs.values('pk')), related, archived).order_by()
+            branches.append(qs)
+        return self._page(branches[0].union(*branches[1:]).order_by(*LISTING_ORDER), limit)
+
+    def _inbox_filters(self, user):
+        return [Q(recipient=user, recipient_deleted_at__isnull=True)]
+
+    def _outbox_filters(self, user):
+        return [Q(sender=user, sender_deleted_at__isnull=True)]
 
-    def inbox_for(self, user):
+    def _trash_filters(self, user):
+        return [
+            Q(recipient=user, recipient_deleted_at__isnull=False),
+            Q(sender=user, sender_deleted_at__isnull=False),
+        ]
+
+    def inbox_for(self, user, related=False, archived=False):
         """
         Returns all messages that were received by the given user and are not
         marked as deleted.
+
+        With ``archived`` the archived messages are included, as a UNION
+        that can only be ordered and sliced.
         """
-        return self.filter(
-            recipient=user,
-            recipient_deleted_at__isnull=True,
-        )
-    def outbox_for(self, user):
+        return self._listing(self._inbox_filters(user), related, archived)
+
+    def outbox_for(self, user, related=False, archived=False):
         """
         Returns all messages that were sent by the given user and are not
         marked as deleted.
         """
-        return self.filter(
-            sender=user,
-            sender_deleted_at__isnull=True,
-        )
+        return self._listing(self._outbox_filters(user), related, archived)
 
-    def trash_for(self, user):
+    def trash_for(self, user, related=False, archived=False):
         """
         Returns all messages that were either received or sent by the given
         user and are marked as deleted.
+
+        This is a UNION of the received and the sent messages, each served by
+        its own index, so the result can only be ordered and sliced.
+        """
+        return self._listing(self._trash_filters(user), related, archived)
+
+    def thread_for(self, user, thread_id):
+        """
+        Returns the messages of a conversation the given user takes part in,
+        oldest first, with sender and recipient in the same query.
         """
         return self.filter(
-            recipient=user,
-            recipient_deleted_at__isnull=False,
-        ) | self.filter(
-            sender=user,
-            sender_deleted_at__isnull=False,
-        )
+            Q(recipient=user, recipient_deleted_at__isnull=True)
+            | Q(sender=user, sender_deleted_at__isnull=True),
+            Q(thread_id=thread_id) | Q(pk=thread_id, thread_id__isnull=True),
+        ).select_related('sender', 'recipient').order_by('sent_at', 'id')
+
+    def threads_for(self, user):
+        """
+        Returns one row per conversation of the given user, newest first,
+        as dicts with ``thread`` (the id of its first message),
+        ``last_sent_at``, ``last_message_id``, ``message_count`` and
+        ``unread_count``.
+        """
+        return self.filter(
+            Q(recipient=user, recipient_deleted_at__isnull=True)
+            | Q(sender=user, sender_deleted_at__isnull=True),
+        ).annotate(
+            thread=Coalesce('thread_id', 'id', output_field=models.IntegerField()),
+        ).order_by().values('thread').annotate(
+            last_sent_at=Max('sent_at'),
+            last_message_id=Max('id'),
+            message_count=Count('id'),
+            unread_count=Count('id', filter=Q(recipient=user, read_at__isnull=True)),
+        ).order_by('-last_sent_at', '-thread')
+
+    def _scoped(self, filters, ids):
+        """
+        One queryset per chunk of ``ids`` (all of them when ``ids`` is
+        ``None``), small enough for the backend's parameter limit.
+        """
+        qs = self.filter(filters)
+        if ids is None:
+            return [qs]
+        ids = sorted({int(pk) for pk in ids})
+        size = connections[self.db].features.max_query_params or len(ids) or 1
+        size = max(size - 10, 1)
+        return [qs.filter(pk__in=ids[i:i + size]) for i in range(0, len(ids), size)]
+
+    def _bulk_update(self, filters, ids, **values):
+        return sum(qs.update(**values) for qs in self._scoped(filters, ids))
+
+    def mark_read(self, user, ids=None):
+        """
+        Marks the unread inbox messages of ``user`` with the given ids, or
+        all of them, as read and returns how many changed. Like the other
+        bulk operations this is an UPDATE per chunk of ids and sends no
+        ``post_save``, the unread counter is moved by the difference.
+        """
+        with transaction.atomic(using=self.db):
+            count = self._bulk_update(
+                Q(recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True), ids,
+                read_at=timezone.now())
+            UnreadCount.objects.adjust({user.pk: -count})
+        return count
+
+    def mark_unread(self, user, ids=None):
+        """
+        Marks read inbox messages as unread again.
+        """
+        with transaction.atomic(using=self.db):
+            count = self._bulk_update(
+                Q(recipient=user, read_at__isnull=False, recipient_deleted_at__isnull=True), ids,
+                read_at=None)
+            UnreadCount.objects.adjust({user.pk: count})
+        return count
+
+    def move_to_trash(self, user, ids=None, folder=None):
+        """
+        Marks messages as deleted for ``user``, on the recipient side for
+        received and the sender side for sent messages. ``folder`` limits
+        this to ``'inbox'`` or ``'outbox'``. Returns the number of changes,
+        a message the user sent to themselves counts twice.
+        """
+        now = timezone.now()
+        count = 0
+        with transaction.atomic(using=self.db):
+            if folder != 'outbox':
+                # unread ones separately, they come off the unread counter
+                unread = self._bulk_update(
+                    Q(recipient=user, recipient_deleted_at__isnull=True, read_at__isnull=True), ids,
+                    recipient_deleted_at=now)
+                count += unread + self._bulk_update(
+                    Q(recipient=user, recipient_deleted_at__isnull=True, read_at__isnull=False), ids,
+                    recipient_deleted_at=now)
+                UnreadCount.objects.adjust({user.pk: -unread})
+            if folder != 'inbox':
+                count += self._bulk_update(Q(sender=user, sender_deleted_at__isnull=True), ids,
+                                           sender_deleted_at=now)
+        return count
+
+    def restore(self, user, ids=None, folder=None):
+        """
+        Takes messages of ``user`` out of the trash again, the reverse of
+        ``move_to_trash``.
+        """
+        count = 0
+        with transaction.atomic(using=self.db):
+            if folder != 'outbox':
+                unread = self._bulk_update(
+                    Q(recipient=user, recipient_deleted_at__isnull=False, read_at__isnull=True), ids,
+                    recipient_deleted_at=None)
+                count += unread + self._bulk_update(
+                    Q(recipient=user, recipient_deleted_at__isnull=False, read_at__isnull=False), ids,
+                    recipient_deleted_at=None)
+                UnreadCount.objects.adjust({user.pk: unread})
+            if folder != 'inbox':
+                count += self._bulk_update(Q(sender=user, sender_deleted_at__isnull=False), ids,
+                                           sender_deleted_at=None)
+        return count
+
+    def inbox_page(self, user, cursor=None, limit=PAGE_SIZE, related=False, archived=False):
+        """
+        Returns a ``MessagePage`` of at most ``limit`` inbox messages after
+        ``cursor`` and the cursor of the next page, ``None`` on the last one.
+        Every page costs the same, no matter how deep it is. Messages
+        without ``sent_at`` are not listed.
+        """
+        return self._listing_page(self._inbox_filters(user), cursor, limit, related, archived)
+
+    def outbox_page(self, user, cursor=None, limit=PAGE_SIZE, related=False, archived=False):
+        """
+        Like ``inbox_page`` for the sent messages.
+        """
+        return self._listing_page(self._outbox_filters(user), cursor, limit, related, archived)
+
+    def trash_page(self, user, cursor=None, limit=PAGE_SIZE, related=False, archived=False):
+        """
+        Like ``inbox_page`` for the deleted messages.
+        """
+        return self._listing_page(self._trash_filters(user), cursor, limit, related, archived)
 
 
 @python_2_unicode_compatible
@@ -64,9 +315,13 @@ class Message(models.Model):
     replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
     sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
     recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
-    xml = models.FileField(upload_to=None, max_length=254)
+    xml = models.FileField(upload_to=None, max_length=254, storage=get_xml_storage)
     xml_type = models.CharField(max_length=20, null=True)
     peppol_classic = models.BooleanField(default=False)
+    # id of the first message of the conversation and distance from it,
+    # the first message itself has no thread_id
+    thread_id = models.PositiveIntegerField(_("Thread"), null=True, blank=True)
+    depth = models.PositiveIntegerField(_("Depth"), default=0)
 
 
     objects = MessageManager()
@@ -90,14 +345,422 @@ class Message(models.Model):
         return reverse('django_messages:messages_detail', args=[self.id])
 
     def save(self, **kwargs):
-        if not self.id:
+        if getattr(self, 'archived', False):
+            raise ValueError("Archived messages can not be saved")
+        created = not self.id
+        if created:
             self.sent_at = timezone.now()
+            if self.parent_msg_id is not None and self.thread_id is None:
+                parent = self.parent_msg
+                self.thread_id = parent.thread_id or parent.pk
+                self.depth = parent.depth + 1
         super(Message, self).save(**kwargs)
 
     class Meta:
         ordering = ['-sent_at']
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
+        # partial indexes matching the MessageManager query shapes, backends
+        # without partial indexes get plain composite ones in 0005
+        indexes = [
+            models.Index(fields=['recipient', '-sent_at', '-id'], name='dm_inbox_idx',
+                         condition=Q(recipient_deleted_at__isnull=True)),
+            models.Index(fields=['recipient', '-sent_at'], name='dm_unread_idx',
+                         condition=Q(read_at__isnull=True, recipient_deleted_at__isnull=True)),
+            models.Index(fields=['sender', '-sent_at', '-id'], name='dm_outbox_idx',
+                         condition=Q(sender_deleted_at__isnull=True)),
+            models.Index(fields=['recipient', '-sent_at', '-id'], name='dm_trash_recipient_idx',
+                         condition=Q(recipient_deleted_at__isnull=False)),
+            models.Index(fields=['sender', '-sent_at', '-id'], name='dm_trash_sender_idx',
+                         condition=Q(sender_deleted_at__isnull=False)),
+            models.Index(fields=['thread_id', 'sent_at', 'id'], name='dm_thread_idx'),
+        ]
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the hot table by ``archive_messages``. The
+    columns match ``Message`` one for one so both can be read in one UNION.
+
+    On PostgreSQL the table is partitioned by year of ``sent_at``, see
+    migration 0011, which also creates the table and its indexes on every
+    backend since the migration framework can not describe a partitioned
+    table.
+    """
+    id = models.IntegerField(primary_key=True)
+    subject = models.CharField(_("Subject"), max_length=140)
+    body = models.TextField(_("Body"))
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Sender"), on_delete=models.PROTECT, db_constraint=False)
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='+', null=True, blank=True, verbose_name=_("Recipient"), on_delete=models.SET_NULL, db_constraint=False)
+    # the parent may still be in the hot table, or be archived as well
+    parent_msg_id = models.IntegerField(_("Parent message"), null=True, blank=True)
+    sent_at = models.DateTimeField(_("sent at"))
+    read_at = models.DateTimeField(_("read at"), null=True, blank=True)
+    replied_at = models.DateTimeField(_("replied at"), null=True, blank=True)
+    sender_deleted_at = models.DateTimeField(_("Sender deleted at"), null=True, blank=True)
+    recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
+    xml = models.FileField(upload_to=None, max_length=254, storage=get_xml_storage)
+    xml_type = models.CharField(max_length=20, null=True)
+    peppol_classic = models.BooleanField(default=False)
+    thread_id = models.PositiveIntegerField(_("Thread"), null=True, blank=True)
+    depth = models.PositiveIntegerField(_("Depth"), default=0)
+    archived_at = models.DateTimeField(_("archived at"), default=timezone.now)
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        managed = False
+        db_table = 'django_messages_archivedmessage'
+        ordering = ['-sent_at']
+        verbose_name = _("Archived message")
+        verbose_name_plural = _("Archived messages")
+
+
+class XmlBlob(models.Model):
+    """
+    A deduplicated attachment stored by ``ContentAddressedStorage``
+    """
+    digest = models.CharField(_("SHA-256"), max_length=64, db_index=True)
+    name = models.CharField(_("Name"), max_length=254, unique=True)
+    size = models.PositiveIntegerField(_("Size"))
+    refcount = models.PositiveIntegerField(_("References"), default=0)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = _("XML blob")
+        verbose_name_plural = _("XML blobs")
+
+
+def release_xml(sender, instance, **kwargs):
+    """
+    Drops the reference a deleted message held on its deduplicated XML.
+    """
+    if instance.xml and hasattr(instance.xml.storage, 'retain'):
+        instance.xml.delete(save=False)
+
+signals.post_delete.connect(release_xml, sender=Message, dispatch_uid='django_messages_release_xml')
+signals.post_delete.connect(release_xml, sender=ArchivedMessage, dispatch_uid='django_messages_release_archived_xml')
+
+
+from django_messages.summary import summarize_message
+signals.post_save.connect(summarize_message, sender=Message, dispatch_uid='django_messages_summarize_message')
+
+from django_messages.search import index_message, unindex_message
+signals.post_save.connect(index_message, sender=Message, dispatch_uid='django_messages_index_message')
+signals.post_delete.connect(unindex_message, sender=Message, dispatch_uid='django_messages_unindex_message')
+
+
+class InvoiceSummary(models.Model):
+    """
+    Header fields of the invoice attached to a message, extracted once
+    when the message is saved
+    """
+    message = models.OneToOneField(Message, primary_key=True, related_name='invoice_summary', verbose_name=_("Message"), on_delete=models.CASCADE)
+    document_type = models.CharField(_("Document type"), max_length=20, blank=True)
+    invoice_id = models.CharField(_("Invoice ID"), max_length=100, blank=True, db_index=True)
+    issue_date = models.DateField(_("Issue date"), null=True, blank=True, db_index=True)
+    due_date = models.DateField(_("Due date"), null=True, blank=True, db_index=True)
+    currency = models.CharField(_("Currency"), max_length=3, blank=True)
+    seller_endpoint = models.CharField(_("Seller endpoint"), max_length=100, blank=True, db_index=True)
+    seller_scheme = models.CharField(_("Seller scheme"), max_length=10, blank=True)
+    buyer_endpoint = models.CharField(_("Buyer endpoint"), max_length=100, blank=True, db_index=True)
+    buyer_scheme = models.CharField(_("Buyer scheme"), max_length=10, blank=True)
+    payable_amount = models.DecimalField(_("Payable amount"), max_digits=19, decimal_places=4, null=True, blank=True)
+
+    def __str__(self):
+        return self.invoice_id
+
+    class Meta:
+        verbose_name = _("Invoice summary")
+        verbose_name_plural = _("Invoice summaries")
+
+
+def unread_version(user_pk):
+    # the cached counter is stored under a version that every change bumps
+    # once committed, a reader that raced a change can only fill a version
+    # nobody reads anymore. Starts from the clock so an evicted version
+    # doesn't come back to a number that stale counters are stored under.
+    return cache.get_or_set(UNREAD_VERSION_KEY % user_pk,
+                            lambda: int(time.time() * 1000), None)
+
+
+def unread_cache_key(user_pk, version=None):
+    if version is None:
+        version = unread_version(user_pk)
+    return "django_messages:unread:%s:%s" % (user_pk, version)
+
+
+class UnreadCountManager(models.Manager):
+
+    def recount(self, user_ids):
+        """
+        Recomputes the counters of the given users from their messages and
+        returns them as ``{user_id: count}``.
+
+        The counts are computed by the UPDATE itself, so a message that
+        arrives in between can not be lost between reading and writing.
+        """
+        user_ids = list(user_ids)
+        unread = Message.objects.filter(
+            recipient_id=OuterRef('user_id'),
+            read_at__isnull=True,
+            recipient_deleted_at__isnull=True,
+        ).order_by().values('recipient_id').annotate(n=Count('pk')).values('n')
+        with transaction.atomic(using=self.db):
+            self.bulk_create([UnreadCount(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+            self.filter(user_id__in=user_ids).update(
+                count=Coalesce(Subquery(unread, output_field=models.IntegerField()), 0))
+            counts = dict(self.filter(user_id__in=user_ids).values_list('user_id', 'count'))
+        self._bust(user_ids)
+        return counts
+
+    def adjust(self, deltas):
+        """
+        Applies ``{user_id: delta}`` to the counters with ``F()`` updates, one
+        query per distinct delta. Users without a counter yet get theirs
+        recomputed instead.
+        """
+        by_delta = defaultdict(list)
+        for user_id, delta in deltas.items():
+            if delta and user_id is not None:
+                by_delta[delta].append(user_id)
+        for delta, user_ids in by_delta.items():
+            updated = self.filter(user_id__in=user_ids).update(count=F('count') + delta)
+            if updated < len(user_ids):
+                existing = set(self.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+                self.recount([user_id for user_id in user_ids if user_id not in existing])
+            self._bust(user_ids)
+
+    def _bust(self, user_ids):
+        user_ids = list(user_ids)
+
+        def bump():
+            for user_id in user_ids:
+                try:
+                    cache.incr(UNREAD_VERSION_KEY % user_id)
+                except ValueError:
+                    unread_version(user_id)
+
+        if user_ids:
+            # readers must not cache a value that is not committed yet
+            transaction.on_commit(bump, using=self.db)
+
+
+class UnreadCount(models.Model):
+    """
+    Number of unread messages in the inbox of a user, kept up to date by
+    signal receivers so the navbar badge never has to count messages
+    """
+    user = models.OneToOneField(AUTH_USER_MODEL, primary_key=True, related_name='+', verbose_name=_("User"), on_delete=models.CASCADE)
+    count = models.IntegerField(_("Unread messages"), default=0)
+
+    objects = UnreadCountManager()
+
+    def __str__(self):
+        return "%s: %s" % (self.user_id, self.count)
+
+    class Meta:
+        verbose_name = _("Unread count")
+        verbose_name_plural = _("Unread counts")
+
+
+def _unread_state(instance):
+    """
+    ``(recipient_id, unread)`` of a message, or ``None`` when one of the
+    fields was deferred and reading it would cost a query.
+    """
+    values = instance.__dict__
+    if not all(name in values for name in ('recipient_id', 'read_at', 'recipient_deleted_at')):
+        return None
+    unread = values['read_at'] is None and values['recipient_deleted_at'] is None
+    return values['recipient_id'], unread
+
+
+def remember_unread_state(sender, instance, **kwargs):
+    instance._unread_state = _unread_state(instance)
+
+
+def update_unread_count(sender, instance, created=False, **kwargs):
+    """
+    Moves the unread counters by the difference between the state the
+    message was loaded with and the state it was saved with.
+    """
+    new = _unread_state(instance)
+    old = (None, False) if created else getattr(instance, '_unread_state', None)
+    instance._unread_state = new
+    if new is None or old is None:
+        if instance.recipient_id is not None:
+            UnreadCount.objects.recount([instance.recipient_id])
+        return
+    if old == new:
+        return
+    deltas = defaultdict(int)
+    if old[1]:
+        deltas[old[0]] -= 1
+    if new[1]:
+        deltas[new[0]] += 1
+    UnreadCount.objects.adjust(deltas)
+
+
+def release_unread_count(sender, instance, **kwargs):
+    state = getattr(instance, '_unread_state', None)
+    if state is None:
+        if instance.recipient_id is not None:
+            UnreadCount.objects.recount([instance.recipient_id])
+    elif state[1]:
+        UnreadCount.objects.adjust({state[0]: -1})
+
+signals.post_init.connect(remember_unread_state, sender=Message, dispatch_uid='django_messages_remember_unread_state')
+signals.post_save.connect(update_unread_count, sender=Message, dispatch_uid='django_messages_update_unread_count')
+signals.post_delete.connect(release_unread_count, sender=Message, dispatch_uid='django_messages_release_unread_count')
+
+
+class QueueManager(models.Manager):
+    """
+    Claiming for models used as a job queue, they need ``PENDING`` and
+    ``PROCESSING`` statuses and ``status`` and ``claimed_at`` fields
+    """
+
+    def claim(self, batch_size):
+        """
+        Marks up to ``batch_size`` pending jobs as processing and returns
+        their ids. Rows are locked while claiming so that concurrent workers
+        never pick up the same job.
+        """
+        with transaction.atomic(using=self.db):
+            qs = self.filter(status=self.model.PENDING).order_by('pk')
+            if connections[self.db].features.has_select_for_update:
+                skip_locked = connections[self.db].features.has_select_for_update_skip_locked
+                qs = qs.select_for_update(skip_locked=skip_locked)
+            ids = list(qs.values_list('pk', flat=True)[:batch_size])
+            return self._mark_claimed(ids)
+
+    def _mark_claimed(self, ids):
+        # without row locks another worker may have read the same ids, only
+        # the rows still pending when the UPDATE runs belong to this one
+        if not ids:
+            return []
+        now = timezone.now()
+        claimed = self.filter(pk__in=ids, status=self.model.PENDING).update(
+            status=self.model.PROCESSING,
+            claimed_at=now,
+        )
+        if claimed == len(ids):
+            return ids
+        return list(self.filter(
+            pk__in=ids, status=self.model.PROCESSING, claimed_at=now,
+        ).order_by('pk').values_list('pk', flat=True))
+
+    def requeue_stale(self, older_than):
+        """
+        Puts jobs back in the queue that were claimed by a worker more than
+        ``older_than`` (a timedelta) ago and never finished.
+        """
+        return self.filter(
+            status=self.model.PROCESSING,
+            claimed_at__lt=timezone.now() - older_than,
+        ).update(status=self.model.PENDING, claimed_at=None)
+
+
+class OutboxManager(QueueManager):
+
+    def enqueue(self, sender, recipient, xml_type, peppol_classic, parent_msg=None):
+        """
+        Queues a message for delivery by the ``process_outbox`` worker. This
+        is a single insert, everything else happens outside the request.
+        """
+        return self.create(
+            sender=sender,
+            recipient=recipient,
+            xml_type=xml_type,
+            peppol_classic=peppol_classic,
+            parent_msg=parent_msg,
+        )
+
+
+class OutboxMessage(models.Model):
+    """
+    A message waiting to be sent by the outbox worker
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (PROCESSING, _("Processing")),
+        (SENT, _("Sent")),
+        (FAILED, _("Failed")),
+    )
+
+    sender = models.ForeignKey(AUTH_USER_MODEL, related_name='outbox_messages', verbose_name=_("Sender"), on_delete=models.CASCADE)
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Recipient"), on_delete=models.CASCADE)
+    parent_msg = models.ForeignKey(Message, related_name='+', null=True, blank=True, verbose_name=_("Parent message"), on_delete=models.SET_NULL)
+    xml_type = models.CharField(max_length=20, null=True)
+    peppol_classic = models.BooleanField(default=False)
+    status = models.CharField(_("Status"), max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(_("Attempts"), default=0)
+    last_error = models.TextField(_("Last error"), blank=True)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    claimed_at = models.DateTimeField(_("claimed at"), null=True, blank=True)
+    processed_at = models.DateTimeField(_("processed at"), null=True, blank=True)
+    message = models.ForeignKey(Message, related_name='+', null=True, blank=True, verbose_name=_("Message"), on_delete=models.SET_NULL)
+
+    objects = OutboxManager()
+
+    def __str__(self):
+        return "Outbox #%s (%s)" % (self.pk, self.status)
+
+    class Meta:
+        ordering = ['pk']
+        verbose_name = _("Outbox message")
+        verbose_name_plural = _("Outbox messages")
+        indexes = [
+            models.Index(fields=['status', 'id'], name='dm_outbox_status_idx'),
+        ]
+
+
+class Notification(models.Model):
+    """
+    A new message email waiting to be sent by the ``send_notifications``
+    worker, or one that could not be sent
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (PROCESSING, _("Processing")),
+        (SENT, _("Sent")),
+        (FAILED, _("Failed")),
+    )
+
+    recipient = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_("Recipient"), on_delete=models.CASCADE)
+    message = models.ForeignKey(Message, related_name='+', verbose_name=_("Message"), on_delete=models.CASCADE)
+    status = models.CharField(_("Status"), max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(_("Attempts"), default=0)
+    last_error = models.TextField(_("Last error"), blank=True)
+    created_at = models.DateTimeField(_("created at"), default=timezone.now)
+    claimed_at = models.DateTimeField(_("claimed at"), null=True, blank=True)
+    processed_at = models.DateTimeField(_("processed at"), null=True, blank=True)
+
+    objects = QueueManager()
+
+    def __str__(self):
+        return "Notification #%s (%s)" % (self.pk, self.status)
+
+    class Meta:
+        ordering = ['pk']
+        verbose_name = _("Notification")
+        verbose_name_plural = _("Notifications")
+        indexes = [
+            models.Index(fields=['status', 'id'], name='dm_notification_status_idx'),
+        ]
 
 
 def inbox_count_for(user):
@@ -105,8 +768,16 @@ def inbox_count_for(user):
     returns the number of unread messages for the given user but does not
     mark them seen
     """
-    unread_messages = Message.objects.filter(recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True).count()
-    if unread_messages == 0:
+    # the version is read before the counter, so a change committed in
+    # between makes this fill a key nobody reads anymore
+    key = unread_cache_key(user.pk)
+    unread_messages = cache.get(key)
+    if unread_messages is None:
+        unread_messages = UnreadCount.objects.filter(user_id=user.pk).values_list('count', flat=True).first()
+        if unread_messages is None:
+            unread_messages = UnreadCount.objects.recount([user.pk])[user.pk]
+        cache.set(key, unread_messages, UNREAD_CACHE_TIMEOUT)
+    if unread_messages <= 0:
         return None
     return unread_messages
 
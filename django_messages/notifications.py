@@ -0,0 +1,238 @@
+"""
+New message emails.
+
+With ``DJANGO_MESSAGES_NOTIFY_QUEUE`` set, saving a message only queues a
+``Notification`` and the ``send_notifications`` command sends them in
+batches over one SMTP connection, optionally collapsing several messages
+to the same recipient into a digest (``DJANGO_MESSAGES_NOTIFY_DIGEST``).
+Otherwise the email is sent right away as before. Either way an email
+that can not be sent is recorded on a ``Notification`` instead of being
+dropped.
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _, ngettext
+
+from django_messages.models import Notification
+
+# favour django-mailer but fall back to django.core.mail
+if "mailer" in settings.INSTALLED_APPS:
+    from mailer import send_mass_mail
+else:
+    from django.core.mail import send_mass_mail
+
+# whether new_message_email is connected, see django_messages.models
+NOTIFY_EMAIL = ("pinax.notifications" not in settings.INSTALLED_APPS
+                and getattr(settings, 'DJANGO_MESSAGES_NOTIFY', True))
+NOTIFY_QUEUE = getattr(settings, 'DJANGO_MESSAGES_NOTIFY_QUEUE', False)
+NOTIFY_DIGEST = getattr(settings, 'DJANGO_MESSAGES_NOTIFY_DIGEST', False)
+NOTIFY_MAX_ATTEMPTS = getattr(settings, 'DJANGO_MESSAGES_NOTIFY_MAX_ATTEMPTS', 5)
+
+SUBJECT_PREFIX = _(u'New Message: %(subject)s')
+TEMPLATE_NAME = 'django_messages/new_message.html'
+DIGEST_TEMPLATE_NAME = 'django_messages/new_messages_digest.html'
+
+_templates = {}
+_site_urls = {}
+
+
+def get_cached_template(name):
+    """
+    Loads a template once per process.
+    """
+    if name not in _templates:
+        _templates[name] = get_template(name)
+    return _templates[name]
+
+
+def get_site_url(default_protocol=None):
+    """
+    Returns the URL of the current site, looked up once per process.
+    """
+    if default_protocol is None:
+        default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
+    if default_protocol not in _site_urls:
+        from django.contrib.sites.models import Site
+        _site_urls[default_protocol] = '%s://%s' % (default_protocol, Site.objects.get_current().domain)
+    return _site_urls[default_protocol]
+
+
+def render_message_email(message, subject_prefix=SUBJECT_PREFIX, template_name=TEMPLATE_NAME,
+                         default_protocol=None):
+    """
+    Returns the ``(subject, body, from_email, recipient_list)`` tuple of the
+    email announcing ``message`` to its recipient.
+    """
+    subject = subject_prefix % {'subject': message.subject}
+    body = get_cached_template(template_name).render({
+        'site_url': get_site_url(default_protocol),
+        'message': message,
+    })
+    return subject, body, settings.DEFAULT_FROM_EMAIL, [message.recipient.email]
+
+
+def render_digest_email(recipient, messages, template_name=DIGEST_TEMPLATE_NAME, default_protocol=None):
+    """
+    Like ``render_message_email`` for a single email listing several
+    messages to the same recipient.
+    """
+    subject = ngettext(u'%(count)d new message', u'%(count)d new messages', len(messages)) % {
+        'count': len(messages),
+    }
+    body = get_cached_template(template_name).render({
+        'site_url': get_site_url(default_protocol),
+        'recipient': recipient,
+        'messages': messages,
+    })
+    return subject, body, settings.DEFAULT_FROM_EMAIL, [recipient.email]
+
+
+def _error(e):
+    return "%s: %s" % (e.__class__.__name__, e)
+
+
+def _failed_notification(message, e):
+    return Notification(
+        recipient_id=message.recipient_id,
+        message=message,
+        status=Notification.FAILED,
+        attempts=1,
+        last_error=_error(e),
+        processed_at=timezone.now(),
+    )
+
+
+def notify(message, subject_prefix=SUBJECT_PREFIX, template_name=TEMPLATE_NAME, default_protocol=None):
+    """
+    Queues or sends the email for a new message. Never raises, so a
+    broken mail setup can not keep a message from being saved.
+    """
+    if message.recipient_id is None:
+        return
+    try:
+        if not message.recipient.email:
+            return
+        if NOTIFY_QUEUE:
+            with transaction.atomic():
+                Notification.objects.create(recipient_id=message.recipient_id, message=message)
+            return
+        send_mass_mail([render_message_email(message, subject_prefix, template_name, default_protocol)])
+    except Exception as e:
+        try:
+            with transaction.atomic():
+                _failed_notification(message, e).save()
+        except Exception:
+            pass
+
+
+def notify_many(messages, subject_prefix=SUBJECT_PREFIX, template_name=TEMPLATE_NAME, default_protocol=None):
+    """
+    ``notify`` for messages written with ``bulk_create``, which sends no
+    ``post_save``. Queued notifications are written in one query, emails
+    sent right away go out over one connection once the transaction
+    commits.
+    """
+    if not NOTIFY_EMAIL:
+        return
+    messages = [msg for msg in messages if msg.recipient_id is not None and msg.recipient.email]
+    if not messages:
+        return
+    if NOTIFY_QUEUE:
+        Notification.objects.bulk_create(
+            [Notification(recipient_id=msg.recipient_id, message=msg) for msg in messages])
+        return
+    transaction.on_commit(lambda: _send_now(messages, subject_prefix, template_name, default_protocol))
+
+
+def _send_now(messages, subject_prefix, template_name, default_protocol):
+    failed = []
+    try:
+        connection = get_connection()
+        connection.open()
+    except Exception as e:
+        failed = [_failed_notification(msg, e) for msg in messages]
+    else:
+        try:
+            for msg in messages:
+                try:
+                    email = render_message_email(msg, subject_prefix, template_name, default_protocol)
+                    send_mass_mail([email], connection=connection)
+                except Exception as e:
+                    failed.append(_failed_notification(msg, e))
+        finally:
+            connection.close()
+    if failed:
+        Notification.objects.bulk_create(failed)
+
+
+def _record_failure(jobs, error, max_attempts):
+    now = timezone.now()
+    for job in jobs:
+        job.attempts += 1
+        job.last_error = error
+        if job.attempts >= max_attempts:
+            job.status = Notification.FAILED
+            job.processed_at = now
+        else:
+            job.status = Notification.PENDING
+            job.claimed_at = None
+        job.save(update_fields=['attempts', 'last_error', 'status', 'claimed_at', 'processed_at'])
+
+
+def send_batch(batch_size=100, digest=NOTIFY_DIGEST, max_attempts=NOTIFY_MAX_ATTEMPTS):
+    """
+    Claims up to ``batch_size`` queued notifications and sends them over a
+    single connection. Returns ``(claimed, sent, failed)``, counting
+    notifications rather than emails.
+
+    The emails go out one ``send_mass_mail`` call at a time on the shared
+    connection, so a failure is pinned on the right notification and the
+    ones already delivered are not sent twice when it is retried.
+    """
+    ids = Notification.objects.claim(batch_size)
+    if not ids:
+        return 0, 0, 0
+
+    jobs = Notification.objects.filter(pk__in=ids).select_related(
+        'recipient', 'message__sender', 'message__recipient')
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job.recipient_id if digest else job.pk, []).append(job)
+
+    sent_ids = []
+    failed = 0
+    try:
+        connection = get_connection()
+        connection.open()
+    except Exception as e:
+        _record_failure([job for group in groups.values() for job in group], _error(e), max_attempts)
+        return len(ids), 0, len(ids)
+
+    try:
+        for group in groups.values():
+            try:
+                if len(group) == 1:
+                    email = render_message_email(group[0].message)
+                else:
+                    email = render_digest_email(group[0].recipient, [job.message for job in group])
+                send_mass_mail([email], connection=connection)
+            except Exception as e:
+                _record_failure(group, _error(e), max_attempts)
+                failed += len(group)
+            else:
+                sent_ids.extend(job.pk for job in group)
+    finally:
+        connection.close()
+
+    if sent_ids:
+        Notification.objects.filter(pk__in=sent_ids).update(
+            status=Notification.SENT,
+            last_error='',
+            processed_at=timezone.now(),
+        )
+    return len(ids), len(sent_ids), failed
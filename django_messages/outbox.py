@@ -0,0 +1,130 @@
+"""
+Delivery side of the message outbox. Jobs are written by
+``OutboxMessage.objects.enqueue`` and processed here by the
+``process_outbox`` management command.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from connection.exceptions import BlockedError
+from django_messages.models import OutboxMessage
+from django_messages.validation import InvoiceValidationError
+
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'DJANGO_MESSAGES_OUTBOX_MAX_ATTEMPTS', 5)
+
+# these come out the same on every attempt, the job fails right away
+PERMANENT_ERRORS = (InvoiceValidationError, BlockedError)
+
+
+def outbox_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_OUTBOX', False)
+
+
+def _owned(job):
+    # the job as long as it is still claimed by this worker
+    return OutboxMessage.objects.filter(
+        pk=job.pk, status=OutboxMessage.PROCESSING, claimed_at=job.claimed_at)
+
+
+def deliver(job, max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """
+    Runs the regular send path for a single outbox job and records the
+    outcome on the job. Returns True if the message was sent.
+
+    The message and the job's new status are written in one transaction,
+    so a crash in between can't send the invoice twice. A job requeued by
+    ``requeue_stale`` while this worker was slow is left to its new owner.
+    """
+    from django_messages.forms import ComposeForm
+
+    job.attempts += 1
+    try:
+        with transaction.atomic():
+            # also locks the row where the database can
+            if not _owned(job).update(attempts=job.attempts):
+                return False
+            message_list = ComposeForm().save(
+                sender=job.sender,
+                recipient=job.recipient,
+                xml_type=job.xml_type,
+                peppol_classic=job.peppol_classic,
+                parent_msg=job.parent_msg,
+            )
+            job.message = message_list[0]
+            job.status = OutboxMessage.SENT
+            job.last_error = ''
+            job.processed_at = timezone.now()
+            job.save(update_fields=['attempts', 'last_error', 'status', 'processed_at', 'message'])
+    except Exception as e:
+        job.last_error = "%s: %s" % (e.__class__.__name__, e)
+        if isinstance(e, PERMANENT_ERRORS) or job.attempts >= max_attempts:
+            job.status = OutboxMessage.FAILED
+            job.processed_at = timezone.now()
+        else:
+            job.status = OutboxMessage.PENDING
+            job.processed_at = None
+        _owned(job).update(
+            attempts=job.attempts,
+            last_error=job.last_error,
+            status=job.status,
+            claimed_at=None if job.status == OutboxMessage.PENDING else job.claimed_at,
+            processed_at=job.processed_at,
+        )
+        return False
+    return True
+
+
+def deliver_ids(ids, max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """
+    Delivers a chunk of claimed jobs. Runs inside a pool worker, so the
+    connection it opened is closed again before returning.
+    """
+    sent = failed = 0
+    try:
+        jobs = OutboxMessage.objects.select_related(
+            'sender', 'recipient', 'parent_msg').filter(pk__in=ids)
+        for job in jobs:
+            if deliver(job, max_attempts=max_attempts):
+                sent += 1
+            else:
+                failed += 1
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def _chunks(ids, count):
+    size = max(1, -(-len(ids) // count))
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def process_batch(batch_size=100, workers=4, mode='thread', max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """
+    Claims one batch of jobs and delivers it on a thread or process pool.
+    Returns a ``(claimed, sent, failed)`` tuple.
+    """
+    ids = OutboxMessage.objects.claim(batch_size)
+    if not ids:
+        return 0, 0, 0
+
+    if workers <= 1:
+        sent, failed = deliver_ids(ids, max_attempts)
+        return len(ids), sent, failed
+
+    if mode == 'process':
+        # children inherit the parent's sockets, never share them
+        connections.close_all()
+        executor_class = ProcessPoolExecutor
+    else:
+        executor_class = ThreadPoolExecutor
+
+    sent = failed = 0
+    chunks = _chunks(ids, workers)
+    with executor_class(max_workers=min(workers, len(chunks))) as executor:
+        for s, f in executor.map(deliver_ids, chunks, [max_attempts] * len(chunks)):
+            sent += s
+            failed += f
+    return len(ids), sent, failed
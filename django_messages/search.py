@@ -0,0 +1,433 @@
+"""
+Full text search over messages and the invoices attached to them.
+
+Every message is indexed once when it is created, with its subject, body
+and the interesting text of its invoice (parties, references, item names
+and descriptions). Besides the words, each document carries owner tokens
+(``r<recipient id>`` and ``s<sender id>``) so that scoping a search to a
+user is one more term for the engine to intersect instead of a filter
+over all matches.
+
+The engine depends on the database: an FTS5 table on SQLite, a
+``tsvector`` column with a GIN index on PostgreSQL, both created by
+migration 0010. Anywhere else, including SQLite builds without FTS5, the
+messages are searched with ``LIKE`` queries, which keeps working on any
+database but scans the user's messages and only sees the invoice fields
+kept in ``InvoiceSummary``. With ``DJANGO_MESSAGES_SEARCH_BACKEND =
+'memory'`` an in-process inverted index is used, which is only meant for
+tests and development since it is empty after a restart.
+"""
+import re
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Case, ExpressionWrapper, FloatField, Q, Value, When
+from lxml import etree
+
+SEARCH_BACKEND = getattr(settings, 'DJANGO_MESSAGES_SEARCH_BACKEND', None)
+# text search configuration used on PostgreSQL
+SEARCH_CONFIG = getattr(settings, 'DJANGO_MESSAGES_SEARCH_CONFIG', 'simple')
+
+SEARCH_TABLE = 'django_messages_search'
+
+# UBL elements whose text is worth searching
+INVOICE_ELEMENTS = {
+    'ID', 'Name', 'RegistrationName', 'CompanyID', 'EndpointID', 'Description',
+    'Note', 'BuyerReference', 'AccountingCost', 'CityName', 'StreetName',
+}
+INVOICE_TEXT_LIMIT = 64 * 1024
+INVOICE_CACHE_SIZE = 256
+
+WORD_RE = re.compile(r'\w+', re.U)
+
+SearchDocument = namedtuple('SearchDocument', ['message_id', 'subject', 'body', 'invoice', 'owners'])
+
+_invoice_cache = OrderedDict()
+_invoice_lock = threading.Lock()
+
+
+def extract_invoice_text(source):
+    """
+    Returns the searchable text of the UBL document in ``source`` (a path
+    or a binary file object), each value once.
+    """
+    values = OrderedDict()
+    size = 0
+    for event, elem in etree.iterparse(source, events=('end',), resolve_entities=False,
+                                       no_network=True, huge_tree=True):
+        if elem.tag.rsplit('}', 1)[-1] in INVOICE_ELEMENTS and elem.text:
+            text = elem.text.strip()
+            if text and text not in values:
+                values[text] = None
+                size += len(text) + 1
+                if size > INVOICE_TEXT_LIMIT:
+                    break
+        elem.clear()
+    return ' '.join(values)
+
+
+def invoice_text_for(xml):
+    """
+    Returns the searchable text of a stored attachment. Attachments never
+    change once stored, so results are cached by file name.
+    """
+    if not xml:
+        return ''
+    name = xml.name
+    with _invoice_lock:
+        if name in _invoice_cache:
+            _invoice_cache.move_to_end(name)
+            return _invoice_cache[name]
+
+    try:
+        with xml.storage.open(name, 'rb') as f:
+            text = extract_invoice_text(f)
+    except (etree.XMLSyntaxError, OSError, ValueError):
+        return ''
+
+    with _invoice_lock:
+        _invoice_cache[name] = text
+        while len(_invoice_cache) > INVOICE_CACHE_SIZE:
+            _invoice_cache.popitem(last=False)
+    return text
+
+
+def owner_tokens(recipient_id=None, sender_id=None):
+    tokens = []
+    if recipient_id is not None:
+        tokens.append('r%s' % recipient_id)
+    if sender_id is not None:
+        tokens.append('s%s' % sender_id)
+    return tokens
+
+
+def document_for(message):
+    return SearchDocument(
+        message_id=message.pk,
+        subject=message.subject or '',
+        body=message.body or '',
+        invoice=invoice_text_for(message.xml),
+        owners=' '.join(owner_tokens(message.recipient_id, message.sender_id)),
+    )
+
+
+def query_words(query):
+    return [word.lower() for word in WORD_RE.findall(query)]
+
+
+class SQLiteSearchBackend(object):
+    """
+    FTS5 table keyed by the message id, ranked with ``bm25``.
+    """
+
+    def __init__(self, using):
+        self.using = using
+
+    def index(self, documents):
+        ids = [doc.message_id for doc in documents]
+        with connections[self.using].cursor() as cursor:
+            self._delete(cursor, ids)
+            cursor.executemany(
+                'INSERT INTO %s (rowid, subject, body, invoice, owners) VALUES (%%s, %%s, %%s, %%s, %%s)'
+                % SEARCH_TABLE,
+                [tuple(doc) for doc in documents],
+            )
+
+    def remove(self, ids):
+        with connections[self.using].cursor() as cursor:
+            self._delete(cursor, ids)
+
+    def _delete(self, cursor, ids):
+        if ids:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(ids))), ids)
+
+    def indexed(self, ids):
+        if not ids:
+            return set()
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT rowid FROM %s WHERE rowid IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(ids))), ids)
+            return {row[0] for row in cursor.fetchall()}
+
+    def clear(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % SEARCH_TABLE)
+
+    def search(self, words, owners, limit, offset=0):
+        match = '{subject body invoice} : (%s) AND owners : (%s)' % (
+            ' AND '.join('"%s"' % word for word in words),
+            ' OR '.join('"%s"' % owner for owner in owners),
+        )
+        with connections[self.using].cursor() as cursor:
+            # bm25 is lower for better matches
+            cursor.execute(
+                'SELECT rowid, -bm25(%s, 3.0, 2.0, 1.0, 0.0) AS rank FROM %s WHERE %s MATCH %%s '
+                'ORDER BY rank DESC, rowid DESC LIMIT %%s OFFSET %%s' % (SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE),
+                [match, limit, offset],
+            )
+            return cursor.fetchall()
+
+
+class PostgresSearchBackend(object):
+    """
+    ``tsvector`` column with a GIN index, ranked with ``ts_rank``. Subject,
+    body and invoice are weighted A, B and C, the owner tokens go in
+    unweighted with the ``simple`` configuration.
+    """
+    DOCUMENT = (
+        "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+        "setweight(to_tsvector(%s::regconfig, %s), 'B') || "
+        "setweight(to_tsvector(%s::regconfig, %s), 'C') || "
+        "to_tsvector('simple', %s)"
+    )
+
+    def __init__(self, using):
+        self.using = using
+
+    def index(self, documents):
+        with connections[self.using].cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (message_id, document) VALUES (%%s, %s) '
+                'ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document'
+                % (SEARCH_TABLE, self.DOCUMENT),
+                [(doc.message_id, SEARCH_CONFIG, doc.subject, SEARCH_CONFIG, doc.body,
+                  SEARCH_CONFIG, doc.invoice, doc.owners) for doc in documents],
+            )
+
+    def remove(self, ids):
+        if ids:
+            with connections[self.using].cursor() as cursor:
+                cursor.execute('DELETE FROM %s WHERE message_id = ANY(%%s)' % SEARCH_TABLE, [list(ids)])
+
+    def indexed(self, ids):
+        if not ids:
+            return set()
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT message_id FROM %s WHERE message_id = ANY(%%s)' % SEARCH_TABLE, [list(ids)])
+            return {row[0] for row in cursor.fetchall()}
+
+    def clear(self):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('TRUNCATE %s' % SEARCH_TABLE)
+
+    def search(self, words, owners, limit, offset=0):
+        with connections[self.using].cursor() as cursor:
+            cursor.execute(
+                'SELECT message_id, ts_rank(document, q) AS rank '
+                'FROM %s, plainto_tsquery(%%s::regconfig, %%s) q '
+                "WHERE document @@ (q && to_tsquery('simple', %%s)) "
+                'ORDER BY rank DESC, message_id DESC LIMIT %%s OFFSET %%s' % SEARCH_TABLE,
+                [SEARCH_CONFIG, ' '.join(words), ' | '.join(owners), limit, offset],
+            )
+            return cursor.fetchall()
+
+
+class MemorySearchBackend(object):
+    """
+    Inverted index in a dict, for tests and development. Ranks by term
+    frequency with the same field weights as the database backends.
+    """
+    WEIGHTS = (('subject', 3.0), ('body', 2.0), ('invoice', 1.0))
+
+    def __init__(self, using=None):
+        self.postings = defaultdict(dict)
+        self.owners = defaultdict(set)
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def index(self, documents):
+        with self.lock:
+            for doc in documents:
+                self._remove(doc.message_id)
+                scores = defaultdict(float)
+                for field, weight in self.WEIGHTS:
+                    for word in query_words(getattr(doc, field)):
+                        scores[word] += weight
+                for word, score in scores.items():
+                    self.postings[word][doc.message_id] = score
+                owners = doc.owners.split()
+                for owner in owners:
+                    self.owners[owner].add(doc.message_id)
+                self.documents[doc.message_id] = (list(scores), owners)
+
+    def _remove(self, message_id):
+        words, owners = self.documents.pop(message_id, ((), ()))
+        for word in words:
+            self.postings[word].pop(message_id, None)
+        for owner in owners:
+            self.owners[owner].discard(message_id)
+
+    def remove(self, ids):
+        with self.lock:
+            for message_id in ids:
+                self._remove(message_id)
+
+    def indexed(self, ids):
+        return {message_id for message_id in ids if message_id in self.documents}
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.owners.clear()
+            self.documents.clear()
+
+    def search(self, words, owners, limit, offset=0):
+        with self.lock:
+            candidates = set()
+            for owner in owners:
+                candidates |= self.owners.get(owner, set())
+            for word in words:
+                candidates &= self.postings.get(word, {}).keys()
+            ranked = sorted(
+                ((message_id, sum(self.postings[word][message_id] for word in words)) for message_id in candidates),
+                key=lambda row: (row[1], row[0]), reverse=True,
+            )
+        return ranked[offset:offset + limit]
+
+
+class DatabaseSearchBackend(object):
+    """
+    No index at all, searches the message table with ``LIKE``. Ranked with
+    the same field weights as the other backends, the invoice weight going
+    to the ``InvoiceSummary`` fields.
+    """
+    INVOICE_FIELDS = ('invoice_summary__invoice_id', 'invoice_summary__seller_endpoint',
+                      'invoice_summary__buyer_endpoint')
+
+    def __init__(self, using):
+        self.using = using
+
+    def index(self, documents):
+        pass
+
+    def remove(self, ids):
+        pass
+
+    def indexed(self, ids):
+        return set(ids)
+
+    def clear(self):
+        pass
+
+    def search(self, words, owners, limit, offset=0):
+        from django_messages.models import Message
+
+        scope = Q()
+        for owner in owners:
+            scope |= Q(**{('recipient_id' if owner[0] == 'r' else 'sender_id'): int(owner[1:])})
+        matches = Q()
+        rank = Value(0.0)
+        for word in words:
+            invoice = Q()
+            for field in self.INVOICE_FIELDS:
+                invoice |= Q(**{field + '__icontains': word})
+            matches &= Q(subject__icontains=word) | Q(body__icontains=word) | invoice
+            for q, weight in ((Q(subject__icontains=word), 3.0), (Q(body__icontains=word), 2.0), (invoice, 1.0)):
+                rank = rank + Case(When(q, then=Value(weight)), default=Value(0.0))
+        return list(
+            Message.objects.using(self.using).filter(scope, matches)
+            .annotate(search_rank=ExpressionWrapper(rank, output_field=FloatField()))
+            .order_by('-search_rank', '-pk')
+            .values_list('pk', 'search_rank')[offset:offset + limit]
+        )
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+    'database': DatabaseSearchBackend,
+    'memory': MemorySearchBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    """
+    Returns the search backend for a database, picked once per process:
+    the configured one, or the native one when migration 0010 could create
+    its table, or ``LIKE`` queries.
+    """
+    with _backends_lock:
+        if using not in _backends:
+            name = SEARCH_BACKEND
+            if name is None:
+                connection = connections[using]
+                name = 'database'
+                if connection.vendor in BACKENDS and SEARCH_TABLE in connection.introspection.table_names():
+                    name = connection.vendor
+            _backends[using] = BACKENDS[name](using)
+        return _backends[using]
+
+
+def index_messages(messages, using=DEFAULT_DB_ALIAS):
+    """
+    Adds or replaces the search documents of the given messages.
+    """
+    documents = [document_for(message) for message in messages if message.pk is not None]
+    if documents:
+        get_search_backend(using).index(documents)
+
+
+def index_message(sender, instance, created=False, **kwargs):
+    """
+    Signal receiver indexing new messages once they are committed, so
+    reading the invoice doesn't happen while the transaction holds its
+    locks. Messages are not edited after they are sent, so later saves
+    (reading, deleting) leave the index alone. A message whose indexing
+    failed is picked up by ``update_search_index``.
+    """
+    if created and not kwargs.get('raw'):
+        using = kwargs.get('using') or DEFAULT_DB_ALIAS
+        transaction.on_commit(lambda: index_messages([instance], using=using), using=using)
+
+
+def unindex_message(sender, instance, **kwargs):
+    get_search_backend(kwargs.get('using') or DEFAULT_DB_ALIAS).remove([instance.pk])
+
+
+def search_messages(user, query, folder='all', limit=20, offset=0, using=DEFAULT_DB_ALIAS):
+    """
+    Returns a ``MessagePage`` with the messages of ``user`` matching every
+    word of ``query``, best match first, with their sender and recipient
+    loaded and the score in ``search_rank``. ``folder`` is ``'inbox'``,
+    ``'outbox'`` or ``'all'``; messages the user deleted are left out.
+    The ``next_cursor`` of the page is the offset to pass for the next one.
+    """
+    from django_messages.models import Message, MessagePage
+
+    words = query_words(query)
+    if not words:
+        return MessagePage([], None)
+    owners = {
+        'inbox': owner_tokens(recipient_id=user.pk),
+        'outbox': owner_tokens(sender_id=user.pk),
+        'all': owner_tokens(user.pk, user.pk),
+    }[folder]
+    backend = get_search_backend(using)
+
+    results = []
+    position = offset
+    exhausted = False
+    # deleted messages are filtered here, so keep reading until the page
+    # is full or the matches run out
+    while len(results) < limit and not exhausted:
+        chunk = backend.search(words, owners, limit, position)
+        exhausted = len(chunk) < limit
+        messages = Message.objects.using(using).filter(
+            pk__in=[message_id for message_id, rank in chunk]).select_related('sender', 'recipient').in_bulk()
+        for message_id, rank in chunk:
+            if len(results) == limit:
+                exhausted = False
+                break
+            position += 1
+            message = messages.get(message_id)
+            if message is None:
+                continue
+            if ((folder != 'outbox' and message.recipient_id == user.pk and message.recipient_deleted_at is None)
+                    or (folder != 'inbox' and message.sender_id == user.pk and message.sender_deleted_at is None)):
+                message.search_rank = rank
+                results.append(message)
+    return MessagePage(results, None if exhausted else position)
@@ -0,0 +1,227 @@
+"""
+Storage backends for ``Message.xml``.
+
+``ContentAddressedStorage`` keeps every distinct attachment once, under a
+name derived from the SHA-256 of its content, and counts how many messages
+point at it in ``XmlBlob``. Saving a file that is already stored only bumps
+the reference count, deleting only drops the file once nobody uses it.
+The reference is always taken before the file is checked or written, so a
+save and a delete of the same blob can't leave a row without its file.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from django_messages.compression import compressing_writer, decompressing_reader
+
+XML_STORAGE = getattr(settings, 'DJANGO_MESSAGES_XML_STORAGE',
+                      'django_messages.storage.ContentAddressedStorage')
+XML_BLOB_DIR = getattr(settings, 'DJANGO_MESSAGES_XML_BLOB_DIR', 'xml')
+
+_xml_storage = None
+
+
+def get_xml_storage():
+    """
+    Returns the storage instance used by ``Message.xml``. Used as a callable
+    ``storage`` argument so that the backend can be swapped in the settings
+    without a migration.
+    """
+    global _xml_storage
+    if _xml_storage is None:
+        _xml_storage = import_string(XML_STORAGE)()
+    return _xml_storage
+
+
+class HashedContentFile(ContentFile):
+    """
+    A ``ContentFile`` that already knows its SHA-256, so storing it again
+    does not need to read it.
+    """
+
+    def __init__(self, content, name=None, sha256=None):
+        super(HashedContentFile, self).__init__(content, name=name)
+        if sha256 is None:
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            sha256 = hashlib.sha256(data).hexdigest()
+        self.sha256 = sha256
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that deduplicates files by their SHA-256 digest
+    """
+
+    def blob_name(self, digest, ext):
+        return '%s/%s/%s/%s%s' % (XML_BLOB_DIR, digest[:2], digest[2:4], digest, ext)
+
+    def save(self, name, content, max_length=None):
+        from django_messages.models import XmlBlob
+
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = ContentFile(content, name)
+        ext = os.path.splitext(name)[1].lower()
+
+        digest = getattr(content, 'sha256', None)
+        tmp_path = None
+        try:
+            if digest is None:
+                digest, tmp_path = self._write_tmp(content)
+            name = self.blob_name(digest, ext)
+            with transaction.atomic(using=router.db_for_write(XmlBlob)):
+                # take the reference first, the locked row keeps delete()
+                # from removing the file before it is checked
+                self.retain(name, size=content.size)
+                if not self.exists(name):
+                    if tmp_path is None:
+                        digest, tmp_path = self._write_tmp(content)
+                    self._place(tmp_path, name)
+                    tmp_path = None
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
+    def _write_tmp(self, content):
+        """
+        Streams the content to a temporary file while hashing it, returns
+        the digest and the temporary path.
+        """
+        directory = self.path(XML_BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        sha = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer = self.blob_writer(f)
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode('utf-8')
+                    sha.update(chunk)
+                    writer.write(chunk)
+                if writer is not f:
+                    writer.close()
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return sha.hexdigest(), tmp_path
+
+    def _place(self, tmp_path, name):
+        """
+        Moves a temporary file into place. Two writers racing on the same
+        blob write identical bytes, so the second ``os.replace`` is harmless.
+        """
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp_path, self.file_permissions_mode)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, full_path)
+
+    def blob_writer(self, f):
+        """
+        Returns the file object blob content is written to, a hook for
+        storages that transform the content on the way to disk.
+        """
+        return f
+
+    def retain(self, name, count=1, size=None):
+        """
+        Adds ``count`` references to a stored blob.
+        """
+        from django_messages.models import XmlBlob
+
+        using = router.db_for_write(XmlBlob)
+        blobs = XmlBlob.objects.using(using).filter(name=name)
+        if blobs.update(refcount=F('refcount') + count):
+            return
+        if size is None:
+            size = self.size(name)
+        digest = os.path.splitext(os.path.basename(name))[0]
+        try:
+            with transaction.atomic(using=using):
+                XmlBlob.objects.using(using).create(name=name, digest=digest, size=size, refcount=count)
+        except IntegrityError:
+            blobs.update(refcount=F('refcount') + count)
+
+    def delete(self, name):
+        """
+        Drops one reference and removes the file once it is unused. Files
+        that were stored before deduplication are deleted right away.
+
+        The file of the last reference is only removed once the
+        transaction commits, a rollback brings the row back and the file
+        is still there for it.
+        """
+        from django_messages.models import XmlBlob
+
+        using = router.db_for_write(XmlBlob)
+        with transaction.atomic(using=using):
+            blob = XmlBlob.objects.using(using).select_for_update().filter(name=name).first()
+            if blob is None:
+                return super(ContentAddressedStorage, self).delete(name)
+            if blob.refcount > 1:
+                XmlBlob.objects.using(using).filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+                return
+            blob.delete()
+            transaction.on_commit(lambda: self._delete_unused(name, using), using=using)
+
+    def _delete_unused(self, name, using):
+        from django_messages.models import XmlBlob
+
+        # a save() may have counted a new reference since the commit, it
+        # then keeps the file
+        if not XmlBlob.objects.using(using).filter(name=name).exists():
+            super(ContentAddressedStorage, self).delete(name)
+
+
+class CompressionMixin(object):
+    """
+    Compresses files on write and transparently decompresses them on read.
+    Files that were stored uncompressed are read as they are. ``size()``
+    reports the size on disk.
+    """
+    compression = None
+
+    def blob_writer(self, f):
+        return compressing_writer(f, self.compression)
+
+    def _open(self, name, mode='rb'):
+        f = super(CompressionMixin, self)._open(name, 'rb')
+        return File(decompressing_reader(f.file), name)
+
+    def _save(self, name, content):
+        tmp = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        writer = self.blob_writer(tmp)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            writer.write(chunk)
+        writer.close()
+        tmp.seek(0)
+        try:
+            return super(CompressionMixin, self)._save(name, File(tmp, name))
+        finally:
+            tmp.close()
+
+
+class CompressedFileSystemStorage(CompressionMixin, FileSystemStorage):
+    pass
+
+
+class CompressedContentAddressedStorage(CompressionMixin, ContentAddressedStorage):
+    pass
@@ -0,0 +1,125 @@
+"""
+Pulls the header fields of a UBL invoice into ``InvoiceSummary`` so that
+listing and filtering invoices does not need to open the XML.
+
+The document is read with ``iterparse`` and parsing stops as soon as the
+invoice lines start, which is where the interesting header ends. Elements
+are cleared as soon as they are closed so memory stays flat no matter how
+large the invoice is.
+"""
+import threading
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+from django.utils.dateparse import parse_date
+from lxml import etree
+
+# (path below the root element, summary field, attribute field)
+FIELDS = {
+    ('ID',): ('invoice_id', None),
+    ('IssueDate',): ('issue_date', None),
+    ('DueDate',): ('due_date', None),
+    ('DocumentCurrencyCode',): ('currency', None),
+    ('AccountingSupplierParty', 'Party', 'EndpointID'): ('seller_endpoint', 'seller_scheme'),
+    ('AccountingCustomerParty', 'Party', 'EndpointID'): ('buyer_endpoint', 'buyer_scheme'),
+    ('LegalMonetaryTotal', 'PayableAmount'): ('payable_amount', None),
+}
+STOP_AT = {'InvoiceLine', 'CreditNoteLine'}
+
+SUMMARY_CACHE_SIZE = 256
+
+_summary_cache = OrderedDict()
+_summary_lock = threading.Lock()
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def extract_invoice_fields(source):
+    """
+    Returns a dict of summary fields for the UBL document in ``source`` (a
+    path or a binary file object). Missing fields are left out.
+    """
+    values = {}
+    path = []
+    events = etree.iterparse(source, events=('start', 'end'), resolve_entities=False,
+                             no_network=True, huge_tree=True)
+    for event, elem in events:
+        if event == 'start':
+            name = _local(elem.tag)
+            if not path:
+                values['document_type'] = name
+            elif len(path) == 1 and name in STOP_AT:
+                break
+            path.append(name)
+            continue
+
+        field = FIELDS.get(tuple(path[1:]))
+        if field is not None:
+            text_field, attribute_field = field
+            values[text_field] = (elem.text or '').strip()
+            if attribute_field:
+                values[attribute_field] = elem.get('schemeID', '')
+        path.pop()
+        if path:
+            # drop what we are done with, including earlier siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        if len(values) == len(FIELDS) + 3:
+            break
+    del events
+
+    for date_field in ('issue_date', 'due_date'):
+        if date_field in values:
+            values[date_field] = parse_date(values[date_field])
+    if 'payable_amount' in values:
+        try:
+            values['payable_amount'] = Decimal(values['payable_amount'])
+        except InvalidOperation:
+            del values['payable_amount']
+    for field in ('invoice_id', 'seller_endpoint', 'buyer_endpoint'):
+        if field in values:
+            values[field] = values[field][:100]
+    if 'currency' in values:
+        values['currency'] = values['currency'][:3]
+    return values
+
+
+def summary_fields_for(xml):
+    """
+    Returns the summary fields for a stored attachment. Attachments never
+    change once stored, so results are cached by file name.
+    """
+    name = xml.name
+    with _summary_lock:
+        if name in _summary_cache:
+            _summary_cache.move_to_end(name)
+            return dict(_summary_cache[name])
+
+    with xml.storage.open(name, 'rb') as f:
+        values = extract_invoice_fields(f)
+
+    with _summary_lock:
+        _summary_cache[name] = values
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+    return dict(values)
+
+
+def summarize_message(sender, instance, created=False, **kwargs):
+    """
+    Signal receiver that stores the summary of a newly created message.
+    A broken or missing attachment never keeps the message from being
+    saved, the backfill command can pick it up later.
+    """
+    from django_messages.models import InvoiceSummary
+
+    if not created or not instance.xml or kwargs.get('raw'):
+        return
+    try:
+        values = summary_fields_for(instance.xml)
+    except (etree.XMLSyntaxError, OSError, ValueError):
+        return
+    InvoiceSummary.objects.update_or_create(message=instance, defaults=values)
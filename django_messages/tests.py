@@ -0,0 +1,650 @@
+import gzip
+import io
+import json
+import hashlib
+import importlib
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models import signals
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from lxml import etree, isoschematron
+
+from connection.exceptions import BlockedError
+from connection.models import Block, ConnectionRequest
+from django_messages.archive import archive_batch
+from django_messages.forms import ComposeForm
+from django_messages.models import (
+    ArchivedMessage, InvalidCursor, InvoiceSummary, Message, Notification, OutboxMessage, UnreadCount, XmlBlob,
+    inbox_count_for, unread_cache_key,
+)
+from django_messages.notifications import notify
+from django_messages.outbox import deliver
+from django_messages.search import DatabaseSearchBackend, _backends, search_messages
+from django_messages import validation
+from django_messages.storage import ContentAddressedStorage, HashedContentFile
+from django_messages.threads import rebuild_threads
+
+
+class MediaTestCase(TestCase):
+    """ Stores attachments in a throwaway MEDIA_ROOT """
+
+    @classmethod
+    def setUpClass(cls):
+        super(MediaTestCase, cls).setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super(MediaTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username='sender', email='sender@example.com')
+        self.recipient = User.objects.create(username='recipient', email='recipient@example.com')
+
+
+class OutboxTest(MediaTestCase):
+
+    def enqueue(self, count=1):
+        return [
+            OutboxMessage.objects.enqueue(
+                sender=self.sender, recipient=self.recipient, xml_type='invoice', peppol_classic=False)
+            for i in range(count)
+        ]
+
+    def claimed(self, job):
+        job.refresh_from_db()
+        return job
+
+    def test_claim_skips_jobs_claimed_meanwhile(self):
+        jobs = self.enqueue(3)
+        # another worker got to the second job after our SELECT
+        OutboxMessage.objects.filter(pk=jobs[1].pk).update(
+            status=OutboxMessage.PROCESSING, claimed_at=timezone.now())
+        claimed = OutboxMessage.objects._mark_claimed([job.pk for job in jobs])
+        self.assertEqual(claimed, [jobs[0].pk, jobs[2].pk])
+
+    def test_claim_twice(self):
+        jobs = self.enqueue(2)
+        self.assertEqual(OutboxMessage.objects.claim(10), [job.pk for job in jobs])
+        self.assertEqual(OutboxMessage.objects.claim(10), [])
+
+    def test_deliver(self):
+        job, = self.enqueue()
+        OutboxMessage.objects.claim(1)
+        self.assertTrue(deliver(self.claimed(job)))
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxMessage.SENT)
+        self.assertEqual(job.message.recipient, self.recipient)
+
+    def test_deliver_requeued_job_is_left_alone(self):
+        job, = self.enqueue()
+        OutboxMessage.objects.claim(1)
+        job = self.claimed(job)
+        OutboxMessage.objects.requeue_stale(timedelta(seconds=-1))
+        self.assertFalse(deliver(job))
+        self.assertFalse(Message.objects.exists())
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxMessage.PENDING)
+
+    def test_deliver_failure_rolls_back_message(self):
+        job, = self.enqueue()
+        OutboxMessage.objects.claim(1)
+        with mock.patch.object(OutboxMessage, 'save', side_effect=RuntimeError('boom')):
+            self.assertFalse(deliver(self.claimed(job)))
+        self.assertFalse(Message.objects.exists())
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxMessage.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('boom', job.last_error)
+
+    def test_deliver_blocked_fails_at_once(self):
+        Block.objects.create(blocker=self.recipient, blocked=self.sender)
+        job, = self.enqueue()
+        OutboxMessage.objects.claim(1)
+        self.assertFalse(deliver(self.claimed(job), max_attempts=5))
+        job.refresh_from_db()
+        self.assertEqual(job.status, OutboxMessage.FAILED)
+        self.assertEqual(job.attempts, 1)
+
+
+class ComposeTest(MediaTestCase):
+
+    def send(self):
+        return ComposeForm().save(sender=self.sender, recipient=self.recipient, xml_type='invoice',
+                                  peppol_classic=False)
+
+    def test_send_requests_connection(self):
+        msg, = self.send()
+        self.assertEqual(msg.recipient, self.recipient)
+        self.assertTrue(ConnectionRequest.objects.filter(from_user=self.sender, to_user=self.recipient).exists())
+
+    def test_blocked_either_way(self):
+        for blocker, blocked in ((self.recipient, self.sender), (self.sender, self.recipient)):
+            with self.captureOnCommitCallbacks(execute=True):
+                Block.objects.all().delete()
+                Block.objects.add_block(blocker, blocked)
+            with self.assertRaises(BlockedError):
+                self.send()
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConnectionRequest.objects.exists())
+
+
+class ThreadTest(MediaTestCase):
+
+    def send(self, parent_msg=None):
+        return ComposeForm().save(sender=self.sender, recipient=self.recipient, xml_type='invoice',
+                                  peppol_classic=False, parent_msg=parent_msg)[0]
+
+    def test_thread(self):
+        msg = self.send()
+        reply = self.send(parent_msg=msg)
+        other = self.send()
+        msg.refresh_from_db()
+        # the first message is its own thread without a second write
+        self.assertEqual((msg.thread_id, msg.depth), (None, 0))
+        self.assertEqual((reply.thread_id, reply.depth), (msg.pk, 1))
+        self.assertEqual(list(Message.objects.thread_for(self.recipient, msg.pk)), [msg, reply])
+        self.assertEqual(list(Message.objects.thread_for(self.recipient, other.pk)), [other])
+        self.assertEqual(
+            [(row['thread'], row['message_count']) for row in Message.objects.threads_for(self.sender)],
+            [(other.pk, 1), (msg.pk, 2)])
+
+    def test_rebuild_keeps_empty_roots(self):
+        msg = self.send()
+        reply = self.send(parent_msg=msg)
+        Message.objects.filter(pk=reply.pk).update(thread_id=None, depth=0)
+        self.assertEqual(rebuild_threads(), 1)
+        reply.refresh_from_db()
+        self.assertEqual((reply.thread_id, reply.depth), (msg.pk, 1))
+        self.assertEqual(rebuild_threads(), 0)
+
+
+class ContentAddressedStorageTest(MediaTestCase):
+
+    def setUp(self):
+        super(ContentAddressedStorageTest, self).setUp()
+        self.storage = ContentAddressedStorage(location=self.media_root)
+
+    def refcount(self, name):
+        return XmlBlob.objects.get(name=name).refcount
+
+    def test_refcounts(self):
+        name = self.storage.save('a.xml', HashedContentFile(b'<Invoice/>'))
+        self.assertEqual(self.storage.save('b.xml', ContentFile(b'<Invoice/>')), name)
+        self.assertEqual(self.refcount(name), 2)
+        self.storage.delete(name)
+        self.assertEqual(self.refcount(name), 1)
+        self.assertTrue(self.storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.delete(name)
+        self.assertFalse(XmlBlob.objects.filter(name=name).exists())
+        self.assertFalse(self.storage.exists(name))
+
+    def test_last_reference_file_is_removed_on_commit(self):
+        name = self.storage.save('a.xml', HashedContentFile(b'<Invoice/>'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.storage.delete(name)
+            self.assertTrue(self.storage.exists(name))
+        self.assertFalse(self.storage.exists(name))
+
+    def test_rolled_back_delete_keeps_the_file(self):
+        name = self.storage.save('a.xml', HashedContentFile(b'<Invoice/>'))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.storage.delete(name)
+                    raise RuntimeError('rollback')
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.refcount(name), 1)
+        self.assertTrue(self.storage.exists(name))
+
+    def test_counted_blob_without_file_is_written_again(self):
+        name = self.storage.save('a.xml', HashedContentFile(b'<Invoice/>'))
+        # the file went away between a delete and this save
+        super(ContentAddressedStorage, self.storage).delete(name)
+        self.assertEqual(self.storage.save('a.xml', HashedContentFile(b'<Invoice/>')), name)
+        self.assertEqual(self.refcount(name), 2)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'<Invoice/>')
+
+
+class NotifyTest(MediaTestCase):
+
+    def test_queue_failure_is_recorded(self):
+        msg = Message.objects.create(sender=self.sender, recipient=self.recipient, subject='s', body='b')
+        Notification.objects.all().delete()
+        with mock.patch('django_messages.notifications.NOTIFY_QUEUE', True), \
+                mock.patch.object(Notification.objects, 'create', side_effect=RuntimeError('down')):
+            notify(msg)
+        notification, = Notification.objects.all()
+        self.assertEqual(notification.status, Notification.FAILED)
+        self.assertIn('down', notification.last_error)
+
+
+class UnreadCountTest(MediaTestCase):
+
+    def test_racing_reader_does_not_cache_a_stale_count(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            msg = Message.objects.create(sender=self.sender, recipient=self.recipient, subject='s', body='b')
+        self.assertEqual(inbox_count_for(self.recipient), 1)
+        # a reader picked its key and read the counter just before the change
+        key = unread_cache_key(self.recipient.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            msg.read_at = timezone.now()
+            msg.save()
+        cache.set(key, 1)
+        self.assertIsNone(inbox_count_for(self.recipient))
+
+    def test_recount(self):
+        for read_at in (None, None, timezone.now()):
+            Message.objects.create(sender=self.sender, recipient=self.recipient, subject='s', body='b',
+                                   read_at=read_at)
+        UnreadCount.objects.update(count=7)
+        UnreadCount.objects.filter(user=self.sender).delete()
+        with CaptureQueriesContext(connection) as queries:
+            counts = UnreadCount.objects.recount([self.recipient.pk, self.sender.pk])
+        self.assertEqual(counts, {self.recipient.pk: 2, self.sender.pk: 0})
+        self.assertEqual(dict(UnreadCount.objects.values_list('user_id', 'count')), counts)
+        # counted inside the UPDATE, not read first and written back
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('COUNT(', updates[0])
+
+
+class XmlDownloadTest(MediaTestCase):
+
+    content = b'<Invoice>' + b'x' * 100 + b'</Invoice>'
+
+    def store(self, name, data):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        msg = Message.objects.create(sender=self.sender, recipient=self.recipient, subject='s', body='b', xml=name)
+        self.client.force_login(self.recipient)
+        return reverse('django_messages:messages_xml', args=[msg.pk])
+
+    def store_gzip(self):
+        self.digest = hashlib.sha256(self.content).hexdigest()
+        name = 'xml/%s/%s/%s.xml' % (self.digest[:2], self.digest[2:4], self.digest)
+        return self.store(name, gzip.compress(self.content))
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_gzip_has_its_own_etag(self):
+        url = self.store_gzip()
+        encoded = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(encoded['ETag'], '"%s-gzip"' % self.digest)
+        self.assertEqual(encoded['Content-Encoding'], 'gzip')
+        plain = self.client.get(url)
+        self.assertEqual(plain['ETag'], '"%s"' % self.digest)
+        self.assertEqual(self.body(plain), self.content)
+
+    def test_not_modified(self):
+        url = self.store_gzip()
+        tag = '"%s-gzip"' % self.digest
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 304)
+        # the cached copy is compressed, a client that can't take that gets the file
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"%s"' % self.digest)
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        url = self.store('xml/plain.xml', self.content)
+        response = self.client.get(url, HTTP_RANGE='bytes=0-8')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), b'<Invoice>')
+        # weak ETags never match If-Range, the whole file is sent
+        response = self.client.get(url, HTTP_RANGE='bytes=0-8', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class KeysetPageTest(MediaTestCase):
+
+    def setUp(self):
+        super(KeysetPageTest, self).setUp()
+        now = timezone.now()
+        for i in range(5):
+            msg = Message.objects.create(sender=self.sender, recipient=self.recipient, subject=str(i), body='b')
+            # two messages share a timestamp, the pk breaks the tie
+            Message.objects.filter(pk=msg.pk).update(sent_at=now - timedelta(minutes=min(i, 3)))
+
+    def pages(self, page, limit=2):
+        seen, cursor = [], None
+        while True:
+            messages, cursor = page(self.recipient, cursor=cursor, limit=limit)
+            seen.extend(msg.subject for msg in messages)
+            if cursor is None:
+                return seen
+
+    def test_pages_cover_the_listing_once(self):
+        expected = [msg.subject for msg in Message.objects.inbox_for(self.recipient)]
+        self.assertEqual(expected, ['0', '1', '2', '4', '3'])
+        self.assertEqual(self.pages(Message.objects.inbox_page), expected)
+        self.assertEqual(self.pages(Message.objects.inbox_page, limit=5), expected)
+
+    def test_trash_union(self):
+        Message.objects.filter(subject__in=['1', '3']).update(recipient_deleted_at=timezone.now())
+        Message.objects.filter(subject='4').update(
+            sender=self.recipient, recipient=self.sender, sender_deleted_at=timezone.now())
+        self.assertEqual(self.pages(Message.objects.trash_page, limit=1), ['1', '4', '3'])
+
+    def test_messages_without_sent_at_are_left_out(self):
+        Message.objects.filter(subject='1').update(sent_at=None)
+        self.assertEqual(self.pages(Message.objects.inbox_page, limit=1), ['0', '2', '4', '3'])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            Message.objects.inbox_page(self.recipient, cursor='bm9wZQ')
+
+
+class ArchiveTest(MediaTestCase):
+
+    def send(self, parent_msg=None):
+        return ComposeForm().save(sender=self.sender, recipient=self.recipient, xml_type='invoice',
+                                  peppol_classic=False, parent_msg=parent_msg)[0]
+
+    def test_archive_batch(self):
+        old = self.send()
+        reply = self.send(parent_msg=old)
+        Message.objects.filter(pk=old.pk).update(sent_at=timezone.now() - timedelta(days=1000))
+        blob = XmlBlob.objects.get(name=old.xml.name)
+        self.assertEqual(inbox_count_for(self.recipient), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive_batch(), 1)
+
+        self.assertEqual(list(Message.objects.values_list('pk', flat=True)), [reply.pk])
+        archived = ArchivedMessage.objects.get()
+        self.assertEqual((archived.pk, archived.xml.name), (old.pk, old.xml.name))
+        reply.refresh_from_db()
+        self.assertEqual((reply.parent_msg_id, reply.thread_id), (None, old.pk))
+        self.assertFalse(InvoiceSummary.objects.filter(message_id=old.pk).exists())
+        # the XML reference moved with the row
+        self.assertEqual(XmlBlob.objects.get(pk=blob.pk).refcount, blob.refcount)
+        self.assertEqual(inbox_count_for(self.recipient), 1)
+        self.assertEqual(archive_batch(), 0)
+
+
+class SearchTest(MediaTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            for subject, body in (('apples', 'pears'), ('pears', 'apples'), ('plums', 'plums')):
+                Message.objects.create(sender=self.sender, recipient=self.recipient, subject=subject, body=body)
+
+    def subjects(self, user, query, folder='all'):
+        return [msg.subject for msg in search_messages(user, query, folder=folder).messages]
+
+    def check_search(self):
+        self.assertEqual(self.subjects(self.recipient, 'apples'), ['apples', 'pears'])
+        # same score, the newer message first
+        self.assertEqual(self.subjects(self.recipient, 'apples pears'), ['pears', 'apples'])
+        self.assertEqual(self.subjects(self.sender, 'plums', 'outbox'), ['plums'])
+        self.assertEqual(self.subjects(self.sender, 'plums', 'inbox'), [])
+
+    def test_search(self):
+        self.check_search()
+
+    def test_like_fallback(self):
+        with mock.patch.dict(_backends, {'default': DatabaseSearchBackend('default')}):
+            self.check_search()
+
+    def test_indexed_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Message.objects.create(sender=self.sender, recipient=self.recipient, subject='cherries', body='b')
+        self.assertEqual(self.subjects(self.recipient, 'cherries'), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.subjects(self.recipient, 'cherries'), ['cherries'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+    def test_old_sqlite_tokenizer(self):
+        migration = importlib.import_module('django_messages.migrations.0010_search')
+        for version, option in (((3, 27, 0), 'remove_diacritics 2'), ((3, 26, 0), 'remove_diacritics 1')):
+            schema_editor = mock.Mock(connection=connection)
+            with mock.patch.object(connection.Database, 'sqlite_version_info', version):
+                migration.create_search_table(None, schema_editor)
+            self.assertIn(option, schema_editor.execute.call_args[0][0])
+
+
+class BenchMailboxTest(TestCase):
+
+    def test_refuses_default_database(self):
+        with self.assertRaisesMessage(CommandError, 'Refusing'):
+            call_command('bench_mailbox', stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, 'No benchmark data'):
+            call_command('bench_mailbox', force=True, stdout=io.StringIO())
+
+
+class BulkActionTest(MediaTestCase):
+
+    def setUp(self):
+        super(BulkActionTest, self).setUp()
+        self.other = User.objects.create(username='other')
+        create = lambda sender, recipient, **kwargs: Message.objects.create(
+            sender=sender, recipient=recipient, subject='s', body='b', **kwargs)
+        self.unread = [create(self.sender, self.recipient) for i in range(3)]
+        self.read = [create(self.sender, self.recipient, read_at=timezone.now()) for i in range(2)]
+        self.sent = create(self.recipient, self.sender)
+        self.foreign = create(self.sender, self.other)
+
+    def stored_counts(self):
+        return dict(UnreadCount.objects.values_list('user_id', 'count'))
+
+    def assertCountsRepaired(self):
+        stored = self.stored_counts()
+        call_command('repair_unread_counts', stdout=io.StringIO())
+        self.assertEqual(stored, self.stored_counts())
+
+    def run_committed(self, method, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(Message.objects, method)(*args, **kwargs)
+
+    def pks(self, *messages):
+        return [msg.pk for msg in messages]
+
+    def test_mark_read_and_unread(self):
+        ids = self.pks(self.unread[0], self.read[0], self.sent, self.foreign)
+        self.assertEqual(self.run_committed('mark_read', self.recipient, ids), 1)
+        self.assertEqual(inbox_count_for(self.recipient), 2)
+        self.assertCountsRepaired()
+        self.assertEqual(self.run_committed('mark_unread', self.recipient, ids), 2)
+        self.assertEqual(inbox_count_for(self.recipient), 4)
+        self.assertCountsRepaired()
+        self.assertEqual(self.run_committed('mark_read', self.recipient), 4)
+        self.assertIsNone(inbox_count_for(self.recipient))
+        self.assertCountsRepaired()
+        self.assertIsNone(Message.objects.get(pk=self.foreign.pk).read_at)
+
+    def test_trash_and_restore(self):
+        ids = self.pks(self.unread[0], self.read[0], self.sent, self.foreign)
+        self.assertEqual(self.run_committed('move_to_trash', self.recipient, ids), 3)
+        self.assertEqual(inbox_count_for(self.recipient), 2)
+        self.assertCountsRepaired()
+        # already in the trash, nothing changes
+        self.assertEqual(self.run_committed('move_to_trash', self.recipient, ids), 0)
+        self.assertEqual(self.run_committed('restore', self.recipient, ids, folder='inbox'), 2)
+        self.assertEqual(inbox_count_for(self.recipient), 3)
+        self.assertCountsRepaired()
+        self.assertEqual(self.run_committed('restore', self.recipient, ids), 1)
+        self.assertIsNone(Message.objects.get(pk=self.sent.pk).sender_deleted_at)
+        self.assertIsNone(Message.objects.get(pk=self.foreign.pk).recipient_deleted_at)
+
+    def post(self, data):
+        self.client.force_login(self.recipient)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('django_messages:messages_bulk'), json.dumps(data),
+                                    content_type='application/json')
+
+    def test_endpoint(self):
+        response = self.post({'action': 'read', 'ids': self.pks(self.unread[0], self.foreign)})
+        self.assertEqual(response.json(), {'action': 'read', 'count': 1})
+        self.assertIsNone(Message.objects.get(pk=self.foreign.pk).read_at)
+        response = self.post({'action': 'trash', 'ids': self.pks(self.foreign)})
+        self.assertEqual(response.json()['count'], 0)
+        self.assertIsNone(Message.objects.get(pk=self.foreign.pk).recipient_deleted_at)
+        self.assertEqual(self.post({'action': 'read', 'all': True}).json()['count'], 2)
+        self.assertCountsRepaired()
+
+    def test_endpoint_rejects_bad_input(self):
+        for data in ({'action': 'burn', 'ids': [self.unread[0].pk]},
+                     {'action': 'read', 'ids': 'x'},
+                     {'action': 'read', 'ids': []},
+                     {'action': 'trash', 'ids': [self.unread[0].pk], 'folder': 'spam'}):
+            self.assertEqual(self.post(data).status_code, 400)
+        self.assertEqual(inbox_count_for(self.recipient), 3)
+
+
+TEST_XSD = b"""<?xml version="1.0"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns="urn:test"
+           targetNamespace="urn:test" elementFormDefault="qualified">
+  <xs:element name="Invoice">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="ID" type="xs:string"/>
+        <xs:element name="Amount" type="xs:decimal"/>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+TEST_SCH = b"""<?xml version="1.0"?>
+<schema xmlns="http://purl.oclc.org/dsdl/schematron" queryBinding="xslt1">
+  <ns prefix="t" uri="urn:test"/>
+  <pattern>
+    <rule context="t:Invoice">
+      <assert id="R-001" flag="fatal" test="t:Amount &gt;= 0">Amount must not
+        be negative.</assert>
+      <report id="R-002" test="t:ID = 'TEST'">This is a test invoice.</report>
+    </rule>
+  </pattern>
+</schema>
+"""
+
+VALID_INVOICE = b'<Invoice xmlns="urn:test"><ID>A</ID><Amount>1.00</Amount></Invoice>'
+NEGATIVE_INVOICE = b'<Invoice xmlns="urn:test"><ID>A</ID><Amount>-1</Amount></Invoice>'
+
+
+class ValidationTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.xsd = self.write('invoice.xsd', TEST_XSD)
+        self.sch = self.write('rules.sch', TEST_SCH)
+        # the same rules compiled to XSLT ahead of time
+        self.xslt = self.write('rules.xslt', etree.tostring(
+            isoschematron.Schematron(etree.fromstring(TEST_SCH), store_xslt=True).validator_xslt))
+        self.configure(self.xsd, [self.sch])
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def configure(self, xsd, schematron):
+        for name, value in (('UBL_XSD', xsd), ('SCHEMATRON', schematron),
+                            ('_compiled', threading.local())):
+            patcher = mock.patch.object(validation, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_valid(self):
+        self.assertEqual(validation.validate(VALID_INVOICE), [])
+        self.assertEqual(validation.validate(self.write('valid.xml', VALID_INVOICE)), [])
+        self.assertEqual(validation.validate(io.BytesIO(VALID_INVOICE)), [])
+
+    def test_syntax_error(self):
+        issue, = validation.validate(b'<Invoice xmlns="urn:test">\n<ID>')
+        self.assertEqual((issue.stage, issue.severity, issue.line), ('syntax', 'fatal', 2))
+
+    def test_xsd(self):
+        issues = validation.validate(b'<Invoice xmlns="urn:test">\n<ID>A</ID>\n<Amount>x</Amount></Invoice>')
+        self.assertEqual(len(issues), 1)
+        issue = issues[0]
+        self.assertEqual((issue.stage, issue.severity, issue.rule, issue.line), ('xsd', 'fatal', None, 3))
+        self.assertIn('Amount', issue.message)
+        self.assertFalse(validation.is_valid(issues))
+
+    def test_schematron(self):
+        for schematron in (self.sch, self.xslt):
+            self.configure(self.xsd, [schematron])
+            issue, = validation.validate(NEGATIVE_INVOICE)
+            self.assertEqual(issue.stage, 'schematron:%s' % os.path.basename(schematron))
+            self.assertEqual((issue.severity, issue.rule, issue.line), ('fatal', 'R-001', None))
+            self.assertIn('Invoice', issue.location)
+            self.assertEqual(issue.message, 'Amount must not be negative.')
+
+    def test_schematron_report_is_a_warning(self):
+        issues = validation.validate(VALID_INVOICE.replace(b'>A<', b'>TEST<'))
+        self.assertEqual([(issue.severity, issue.rule, issue.message) for issue in issues],
+                         [('warning', 'R-002', 'This is a test invoice.')])
+        self.assertTrue(validation.is_valid(issues))
+        self.assertEqual(validation.check(VALID_INVOICE.replace(b'>A<', b'>TEST<')), issues)
+        with self.assertRaises(validation.InvoiceValidationError) as cm:
+            validation.check(NEGATIVE_INVOICE)
+        self.assertEqual(cm.exception.issues[0].rule, 'R-001')
+
+    def test_svrl_issues(self):
+        report = etree.fromstring(
+            '<svrl:schematron-output xmlns:svrl="%s">'
+            '<svrl:failed-assert id="BR-01" flag="warning" location="/Invoice[1]">'
+            '<svrl:text>  Spread\n  over lines </svrl:text></svrl:failed-assert>'
+            '<svrl:failed-assert role="error" location="/Invoice[1]/ID[1]">'
+            '<svrl:text>No flag</svrl:text></svrl:failed-assert>'
+            '<svrl:successful-report id="BR-02" location="/Invoice[1]">'
+            '<svrl:text>Reported</svrl:text></svrl:successful-report>'
+            '<svrl:fired-rule context="/"/>'
+            '</svrl:schematron-output>' % validation.SVRL_NS)
+        self.assertEqual(validation._svrl_issues('rules', report), [
+            validation.ValidationIssue('schematron:rules', 'warning', 'BR-01', '/Invoice[1]', None,
+                                       'Spread over lines'),
+            validation.ValidationIssue('schematron:rules', 'error', None, '/Invoice[1]/ID[1]', None,
+                                       'No flag'),
+            validation.ValidationIssue('schematron:rules', 'warning', 'BR-02', '/Invoice[1]', None,
+                                       'Reported'),
+        ])
+
+    def test_validate_many(self):
+        documents = [VALID_INVOICE, NEGATIVE_INVOICE, self.write('valid.xml', VALID_INVOICE), b'<x']
+        expected = [validation.validate(document) for document in documents]
+        self.assertEqual([len(issues) for issues in expected], [0, 1, 0, 1])
+        self.assertEqual(validation.validate_many(documents), expected)
+        self.assertEqual(validation.validate_many(documents, workers=2, chunksize=1), expected)
+
+    def test_compiled_per_thread(self):
+        xsd = validation.get_xsd()
+        self.assertIs(validation.get_xsd(), xsd)
+        compiled = []
+        thread = threading.Thread(target=lambda: compiled.append(validation.get_xsd()))
+        thread.start()
+        thread.join()
+        self.assertIsNotNone(compiled[0])
+        self.assertIsNot(compiled[0], xsd)
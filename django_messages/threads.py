@@ -0,0 +1,44 @@
+"""
+Rebuilds the conversation columns of ``Message`` (``thread_id`` and
+``depth``) from the ``parent_msg`` chains. The first message of a
+conversation may leave ``thread_id`` empty, it is its own thread.
+
+The chains are walked by the database in a single recursive query, only
+the rows whose values change come back and are written in batches.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+
+THREADS_SQL = """
+WITH RECURSIVE chain (id, root, depth) AS (
+    SELECT id, id, 0 FROM {table} WHERE parent_msg_id IS NULL
+    UNION ALL
+    SELECT m.id, chain.root, chain.depth + 1
+    FROM {table} m INNER JOIN chain ON m.parent_msg_id = chain.id
+)
+SELECT chain.id, chain.root, chain.depth
+FROM chain INNER JOIN {table} m ON m.id = chain.id
+WHERE COALESCE(m.thread_id, m.id) <> chain.root OR m.depth <> chain.depth
+"""
+
+
+def rebuild_threads(model=None, using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """
+    Brings ``thread_id`` and ``depth`` of every message in line with its
+    ``parent_msg`` chain and returns the number of messages changed.
+    ``model`` defaults to ``Message``, migrations pass their historical one.
+    """
+    if model is None:
+        from django_messages.models import Message as model
+
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(THREADS_SQL.format(table=connection.ops.quote_name(model._meta.db_table)))
+        rows = cursor.fetchall()
+
+    manager = model._base_manager.using(using)
+    for i in range(0, len(rows), batch_size):
+        manager.bulk_update(
+            [model(pk=pk, thread_id=root, depth=depth) for pk, root, depth in rows[i:i + batch_size]],
+            ['thread_id', 'depth'],
+        )
+    return len(rows)
@@ -0,0 +1,17 @@
+from django.conf.urls import re_path
+
+from django_messages.views import bulk_action, message_search, xml_download
+
+app_name = 'django_messages'
+
+urlpatterns = [
+    re_path(r'^(?P<message_id>[\d]+)/xml/$',
+            xml_download,
+            name='messages_xml'),
+    re_path(r'^search/$',
+            message_search,
+            name='messages_search'),
+    re_path(r'^bulk/$',
+            bulk_action,
+            name='messages_bulk'),
+]
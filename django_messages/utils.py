@@ -1,16 +1,28 @@
+import os
 import re
 import django
 from django.utils.text import wrap
 from django.utils.translation import gettext, gettext_lazy as _
-from django.template.loader import render_to_string
 from django.conf import settings
 
-# favour django-mailer but fall back to django.core.mail
+from django_messages.storage import HashedContentFile
 
-if "mailer" in settings.INSTALLED_APPS:
-    from mailer import send_mail
-else:
-    from django.core.mail import send_mail
+INVOICE_TEMPLATE = getattr(settings, 'DJANGO_MESSAGES_INVOICE_TEMPLATE', 'peppol-bis-invoice-3.xml')
+
+_invoice_template = None
+
+def get_invoice_template():
+    """
+    Returns the invoice attachment as a new file object. The template is
+    read and hashed once per process.
+    """
+    global _invoice_template
+    if _invoice_template is None:
+        with open(INVOICE_TEMPLATE, 'rb') as f:
+            content = HashedContentFile(f.read())
+        _invoice_template = (content.file.getvalue(), content.sha256)
+    data, sha256 = _invoice_template
+    return HashedContentFile(data, name=os.path.basename(INVOICE_TEMPLATE), sha256=sha256)
 
 def format_quote(sender, body):
     """
@@ -62,29 +74,17 @@ def new_message_email(sender, instance, signal,
         *args, **kwargs):
     """
     This function sends an email and is called via Django's signal framework.
+    With ``DJANGO_MESSAGES_NOTIFY_QUEUE`` set the email is only queued, see
+    ``django_messages.notifications``.
     Optional arguments:
         ``template_name``: the template to use
         ``subject_prefix``: prefix for the email subject.
         ``default_protocol``: default protocol in site URL passed to template
     """
-    if default_protocol is None:
-        default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
-
     if 'created' in kwargs and kwargs['created']:
-        try:
-            from django.contrib.sites.models import Site
-            current_domain = Site.objects.get_current().domain
-            subject = subject_prefix % {'subject': instance.subject}
-            message = render_to_string(template_name, {
-                'site_url': '%s://%s' % (default_protocol, current_domain),
-                'message': instance,
-            })
-            if instance.recipient.email != "":
-                send_mail(subject, message, settings.DEFAULT_FROM_EMAIL,
-                    [instance.recipient.email,])
-        except Exception as e:
-            #print e
-            pass #fail silently
+        from django_messages.notifications import notify
+        notify(instance, subject_prefix=subject_prefix, template_name=template_name,
+               default_protocol=default_protocol)
 
 
 def get_user_model():
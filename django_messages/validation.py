@@ -0,0 +1,199 @@
+"""
+Validation of invoice XML against the UBL XSD and the Peppol Schematron
+rules.
+
+Compiling the schemas is by far the slowest part, so they are compiled once
+per thread and kept. The compiled objects keep the last error log and
+report on themselves, so threads never share them. Point the settings at local copies of the rules:
+
+    DJANGO_MESSAGES_UBL_XSD = '/path/to/maindoc/UBL-Invoice-2.1.xsd'
+    DJANGO_MESSAGES_SCHEMATRON = [
+        '/path/to/CEN-EN16931-UBL.sch',
+        '/path/to/PEPPOL-EN16931-UBL.xslt',
+    ]
+
+``.sch`` files are compiled with ``lxml.isoschematron``, anything else is
+treated as a Schematron rule set that was already compiled to XSLT and has
+to produce SVRL. lxml only runs XSLT 1.0, so the rule sets must use the
+xslt1 query binding (or be converted to it).
+"""
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from lxml import etree, isoschematron
+
+from django_messages.compression import open_decompressed
+
+UBL_XSD = getattr(settings, 'DJANGO_MESSAGES_UBL_XSD', None)
+SCHEMATRON = getattr(settings, 'DJANGO_MESSAGES_SCHEMATRON', [])
+VALIDATE_XML = getattr(settings, 'DJANGO_MESSAGES_VALIDATE_XML', False)
+
+SVRL_NS = 'http://purl.oclc.org/dsdl/svrl'
+
+ValidationIssue = namedtuple('ValidationIssue', ['stage', 'severity', 'rule', 'location', 'line', 'message'])
+
+_compiled = threading.local()
+_checked_digests = set()
+
+
+class InvoiceValidationError(ValueError):
+
+    def __init__(self, issues):
+        self.issues = issues
+        super(InvoiceValidationError, self).__init__(
+            '; '.join(issue.message for issue in issues[:5]))
+
+
+def _parser():
+    # never fetch anything while parsing documents from outside
+    return etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+
+def get_xsd():
+    """
+    Returns the compiled UBL schema, or ``None`` if none is configured.
+    """
+    if getattr(_compiled, 'xsd', None) is None and UBL_XSD:
+        _compiled.xsd = etree.XMLSchema(etree.parse(UBL_XSD))
+    return getattr(_compiled, 'xsd', None)
+
+
+def get_schematrons():
+    """
+    Returns the compiled Schematron rule sets as ``(name, callable)`` pairs.
+    """
+    if getattr(_compiled, 'schematrons', None) is None:
+        compiled = []
+        for path in SCHEMATRON:
+            name = os.path.basename(path)
+            if path.endswith('.sch'):
+                schematron = isoschematron.Schematron(etree.parse(path), store_report=True)
+                compiled.append((name, schematron))
+            else:
+                compiled.append((name, etree.XSLT(etree.parse(path))))
+        _compiled.schematrons = compiled
+    return _compiled.schematrons
+
+
+def warm_up():
+    """
+    Compiles everything up front, e.g. in a pool initializer.
+    """
+    get_xsd()
+    get_schematrons()
+
+
+def _svrl_issues(name, report):
+    issues = []
+    for failed in report.iter('{%s}failed-assert' % SVRL_NS, '{%s}successful-report' % SVRL_NS):
+        text = failed.findtext('{%s}text' % SVRL_NS) or ''
+        severity = failed.get('flag') or failed.get('role') or 'error'
+        if failed.tag.endswith('successful-report') and severity == 'error':
+            severity = 'warning'
+        issues.append(ValidationIssue(
+            'schematron:%s' % name, severity, failed.get('id'), failed.get('location'),
+            None, ' '.join(text.split())))
+    return issues
+
+
+def validate(xml):
+    """
+    Validates a document given as bytes, a path or a file object. Returns a
+    list of ``ValidationIssue``, empty when the document is valid.
+    """
+    try:
+        if isinstance(xml, bytes):
+            tree = etree.ElementTree(etree.fromstring(xml, _parser()))
+        elif isinstance(xml, str):
+            with open_decompressed(xml) as f:
+                tree = etree.parse(f, _parser())
+        else:
+            tree = etree.parse(xml, _parser())
+    except etree.XMLSyntaxError as e:
+        return [ValidationIssue('syntax', 'fatal', None, None, e.lineno, e.msg)]
+
+    issues = []
+    xsd = get_xsd()
+    if xsd is not None and not xsd.validate(tree):
+        for error in xsd.error_log:
+            issues.append(ValidationIssue('xsd', 'fatal', None, error.path, error.line, error.message))
+        # rules assume a schema valid document
+        return issues
+
+    for name, rules in get_schematrons():
+        if isinstance(rules, isoschematron.Schematron):
+            rules.validate(tree)
+            report = rules.validation_report
+        else:
+            report = rules(tree)
+        issues.extend(_svrl_issues(name, report.getroot() if hasattr(report, 'getroot') else report))
+    return issues
+
+
+def is_valid(issues):
+    return not any(issue.severity in ('fatal', 'error') for issue in issues)
+
+
+def validate_message(message):
+    """
+    Validates the XML attached to a ``Message``.
+    """
+    with message.xml.open('rb') as f:
+        return validate(f)
+
+
+def check(xml):
+    """
+    Raises ``InvoiceValidationError`` if ``xml`` (bytes) is not valid.
+    """
+    issues = validate(xml)
+    if not is_valid(issues):
+        raise InvoiceValidationError(issues)
+    return issues
+
+
+def check_file(f):
+    """
+    Like ``check`` for a file about to be attached to a message. Files that
+    know their SHA-256 (like the invoice template) are only checked once.
+    """
+    digest = getattr(f, 'sha256', None)
+    if digest is not None and digest in _checked_digests:
+        return []
+    f.seek(0)
+    data = f.read()
+    f.seek(0)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    issues = check(data)
+    if digest is not None:
+        _checked_digests.add(digest)
+    return issues
+
+
+def _validate_chunk(documents):
+    return [validate(document) for document in documents]
+
+
+def validate_many(documents, workers=None, chunksize=16):
+    """
+    Validates many documents (bytes or paths, paths are cheaper to send to
+    the workers) on a process pool. Every worker compiles the schemas once.
+    Returns a list of issue lists in the order of ``documents``.
+    """
+    documents = list(documents)
+    if workers == 1 or len(documents) <= chunksize:
+        return [validate(document) for document in documents]
+
+    chunks = [documents[i:i + chunksize] for i in range(0, len(documents), chunksize)]
+    results = []
+    # children inherit the parent's sockets, never share them
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up) as executor:
+        for chunk_result in executor.map(_validate_chunk, chunks):
+            results.extend(chunk_result)
+    return results
@@ -0,0 +1,283 @@
+import json
+import os
+import re
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.views.decorators.http import require_POST, require_safe
+
+from django_messages.compression import GZIP, ZSTD, decompressing_reader, detect
+from django_messages.models import Message
+from django_messages.search import search_messages
+
+# 'nginx' answers with X-Accel-Redirect, 'apache' with X-Sendfile
+XML_SENDFILE = getattr(settings, 'DJANGO_MESSAGES_XML_SENDFILE', None)
+XML_ACCEL_PREFIX = getattr(settings, 'DJANGO_MESSAGES_XML_ACCEL_PREFIX', '/protected-media/')
+
+CONTENT_TYPE = 'application/xml'
+STREAM_CHUNK_SIZE = 64 * 1024
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SEARCH_FOLDERS = ('all', 'inbox', 'outbox')
+SEARCH_PAGE_SIZE = 20
+BULK_ACTIONS = {
+    'read': 'mark_read',
+    'unread': 'mark_unread',
+    'trash': 'move_to_trash',
+    'restore': 'restore',
+}
+
+
+def xml_etag(storage, name):
+    """
+    Content addressed files carry their digest in the name, so their ETag
+    costs nothing. Anything else gets a weak ETag from a ``stat``.
+    """
+    digest = os.path.splitext(os.path.basename(name))[0]
+    if DIGEST_RE.match(digest):
+        return '"%s"' % digest
+    stat = os.stat(storage.path(name))
+    return 'W/"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def encoded_etag(etag, coding):
+    """
+    The ETag of the stored compressed bytes sent with a ``Content-Encoding``,
+    which must differ from the one of the decompressed content.
+    """
+    return '%s-%s"' % (etag[:-1], coding)
+
+
+def _requested_etag(request, etag):
+    # which of our ETags the conditional headers are about. A suffixed one
+    # was only ever sent for a compressed file, so it can be matched
+    # without opening the file to find out how it is stored.
+    header = request.META.get('HTTP_IF_NONE_MATCH') or request.META.get('HTTP_IF_MATCH') or ''
+    for coding in (GZIP, ZSTD):
+        candidate = encoded_etag(etag, coding)
+        if candidate in header and _accepts(request, coding):
+            return candidate
+    return etag
+
+
+def _accepts(request, coding):
+    accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    return coding in [part.split(';')[0].strip() for part in accepted.split(',')]
+
+
+def _parse_range(header, size):
+    """
+    Returns ``(start, end)`` (inclusive) for a single byte range, ``None``
+    to ignore the header and ``False`` when it can not be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def _stream(f, start=0, length=None):
+    try:
+        if start:
+            f.seek(start)
+        while length is None or length > 0:
+            size = STREAM_CHUNK_SIZE if length is None else min(STREAM_CHUNK_SIZE, length)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+@login_required
+@require_safe
+def xml_download(request, message_id):
+    """
+    Serves the XML attached to a message to its sender or recipient.
+
+    Answers ``If-None-Match`` with 304 without touching the file, supports
+    single byte ranges and hands stored compressed files to clients that
+    accept the encoding as they are, under an ETag of their own. Everything else is streamed, and with
+    ``DJANGO_MESSAGES_XML_SENDFILE`` set the web server sends the file.
+    """
+    name = (
+        Message.objects.filter(pk=message_id)
+        .filter(Q(sender=request.user) | Q(recipient=request.user))
+        .exclude(xml='')
+        .values_list('xml', flat=True)
+        .first()
+    )
+    if name is None:
+        raise Http404
+
+    storage = Message._meta.get_field('xml').storage
+    try:
+        etag = xml_etag(storage, name)
+    except OSError:
+        raise Http404
+
+    not_modified = get_conditional_response(request, etag=_requested_etag(request, etag))
+    if not_modified is not None:
+        patch_cache_control(not_modified, private=True)
+        return not_modified
+
+    filename = os.path.basename(name)
+    try:
+        raw = open(storage.path(name), 'rb')
+    except OSError:
+        raise Http404
+    coding = detect(raw.read(4))
+    raw.seek(0)
+
+    if coding is not None and not _accepts(request, coding):
+        # the client can not take the stored encoding, decompress on the fly
+        response = StreamingHttpResponse(_stream(decompressing_reader(raw)), content_type=CONTENT_TYPE)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        response['ETag'] = etag
+        patch_cache_control(response, private=True)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    if coding is not None:
+        etag = encoded_etag(etag, coding)
+    size = os.fstat(raw.fileno()).st_size
+    byte_range = None
+    # If-Range needs a strong comparison, a weak ETag never matches
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in request.META and (if_range is None or (if_range == etag and not etag.startswith('W/'))):
+        byte_range = _parse_range(request.META['HTTP_RANGE'], size)
+        if byte_range is False:
+            raw.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+
+    if XML_SENDFILE and byte_range is None:
+        raw.close()
+        response = HttpResponse(content_type=CONTENT_TYPE)
+        if XML_SENDFILE == 'nginx':
+            response['X-Accel-Redirect'] = XML_ACCEL_PREFIX + name
+        else:
+            response['X-Sendfile'] = storage.path(name)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(_stream(raw, start, end - start + 1),
+                                         status=206, content_type=CONTENT_TYPE)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    else:
+        # a real file lets the WSGI server use os.sendfile
+        response = FileResponse(raw, content_type=CONTENT_TYPE, as_attachment=True, filename=filename)
+
+    if coding == GZIP:
+        response['Content-Encoding'] = 'gzip'
+    elif coding == ZSTD:
+        response['Content-Encoding'] = 'zstd'
+    if coding is not None:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    patch_cache_control(response, private=True)
+    return response
+
+
+@login_required
+@require_safe
+def message_search(request):
+    """
+    Searches the messages and invoices of the current user. Takes ``q``,
+    ``folder`` (``all``, ``inbox`` or ``outbox``) and the ``offset`` of
+    the previous response's ``next``, and answers JSON.
+    """
+    folder = request.GET.get('folder', 'all')
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid offset")
+    if folder not in SEARCH_FOLDERS:
+        return HttpResponseBadRequest("Invalid folder")
+
+    page = search_messages(request.user, request.GET.get('q', ''), folder=folder,
+                           limit=SEARCH_PAGE_SIZE, offset=offset)
+    response = JsonResponse({
+        'results': [{
+            'id': message.pk,
+            'subject': message.subject,
+            'sender': message.sender.username,
+            'recipient': message.recipient.username if message.recipient_id else None,
+            'sent_at': message.sent_at,
+            'rank': message.search_rank,
+        } for message in page.messages],
+        'next': page.next_cursor,
+    })
+    patch_cache_control(response, private=True)
+    return response
+
+
+@login_required
+@require_POST
+def bulk_action(request):
+    """
+    Applies ``action`` (``read``, ``unread``, ``trash`` or ``restore``) to
+    the messages of the current user listed in ``ids``, or with ``all`` set
+    to every message the action applies to. ``folder`` (``inbox`` or
+    ``outbox``) limits ``trash`` and ``restore`` to one side. Takes a form
+    or a JSON body and answers with the number of changes.
+    """
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body.decode('utf-8') or '{}')
+        except ValueError:
+            return JsonResponse({'error': "Invalid JSON"}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'error': "Expected an object"}, status=400)
+        ids = data.get('ids')
+        if ids is not None and not isinstance(ids, list):
+            return JsonResponse({'error': "Invalid ids"}, status=400)
+    else:
+        data = request.POST
+        ids = [pk for value in data.getlist('ids') for pk in value.split(',') if pk.strip()]
+
+    action = data.get('action')
+    folder = data.get('folder') or None
+    if action not in BULK_ACTIONS:
+        return JsonResponse({'error': "Unknown action"}, status=400)
+    if folder not in (None, 'inbox', 'outbox'):
+        return JsonResponse({'error': "Invalid folder"}, status=400)
+
+    if data.get('all') in (True, '1', 'true', 'on'):
+        ids = None
+    else:
+        try:
+            ids = [int(pk) for pk in ids or ()]
+        except (TypeError, ValueError):
+            return JsonResponse({'error': "Invalid ids"}, status=400)
+        if not ids:
+            return JsonResponse({'error': "No messages selected"}, status=400)
+
+    method = getattr(Message.objects, BULK_ACTIONS[action])
+    if action in ('trash', 'restore'):
+        count = method(request.user, ids, folder=folder)
+    else:
+        count = method(request.user, ids)
+    return JsonResponse({'action': action, 'count': count})
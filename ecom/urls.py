@@ -8,6 +8,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', view=IndexPageView, name='index'),
     path('webshop/', include('webshop.urls') , name = 'webshop'),
+    path('messages/', include('django_messages.urls')),
 
 ]
 
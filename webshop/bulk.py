@@ -0,0 +1,208 @@
+"""
+Bulk invoice dispatch, sends the same invoice to many addresses with a
+fixed number of queries no matter how many rows there are.
+"""
+import csv
+import io
+import json
+from collections import Counter
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from accounts.resolver import WEBID, resolve_addresses
+from connection.blocks import block_set
+from connection.models import Contact
+from django_messages.models import InvoiceSummary, Message, OutboxMessage, UnreadCount
+from django_messages.notifications import notify_many
+from django_messages.outbox import outbox_enabled
+from django_messages.search import index_messages
+from django_messages.summary import summary_fields_for
+from django_messages.utils import get_invoice_template
+from django_messages.validation import VALIDATE_XML, check_file
+
+VIA_CHOICES = ('AS4', 'peppol')
+SUBJECT = 'Invoice'
+BODY = 'Yooo we send you the Invoice for your order.'
+
+
+class BulkParseError(ValueError):
+    pass
+
+
+def parse_rows(data, content_type):
+    """
+    Turns a JSON list or a CSV document into a list of
+    ``{'address': ..., 'via': ...}`` dicts. JSON rows may be plain strings,
+    CSV needs an ``address`` column and may have a ``via`` column.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+
+    if 'json' in content_type:
+        try:
+            rows = json.loads(data)
+        except ValueError as e:
+            raise BulkParseError(_(u"Invalid JSON: %s") % e)
+        if isinstance(rows, dict):
+            rows = rows.get('rows')
+        if not isinstance(rows, list):
+            raise BulkParseError(_(u"Expected a list of rows"))
+        return [row if isinstance(row, dict) else {'address': row} for row in rows]
+
+    reader = csv.DictReader(io.StringIO(data))
+    if not reader.fieldnames or 'address' not in reader.fieldnames:
+        raise BulkParseError(_(u"CSV needs an 'address' column"))
+    return list(reader)
+
+
+def store_invoice_xml(count):
+    """
+    Writes the invoice attachment to storage once and returns its name so
+    that all ``count`` messages of a bulk run can point at the same file.
+    """
+    field = Message._meta.get_field('xml')
+    xml = get_invoice_template()
+    name = field.generate_filename(None, xml.name)
+    name = field.storage.save(name, xml, max_length=field.max_length)
+    if count > 1 and hasattr(field.storage, 'retain'):
+        field.storage.retain(name, count - 1)
+    return name
+
+
+def check_invoice_xml():
+    """
+    Validates the invoice attachment, raises ``InvoiceValidationError``
+    """
+    if VALIDATE_XML:
+        check_file(get_invoice_template())
+
+
+def dispatch_invoices(sender, rows, xml_type='invoice', batch_size=500):
+    """
+    Sends one invoice per row and returns a per row report.
+
+    The invoice is validated before anything is written, an invalid one
+    raises ``InvoiceValidationError`` and leaves the database untouched.
+
+    Recipients are resolved with one query, missing connection requests
+    are created in one batch and the messages are written with
+    ``bulk_create`` where their pks can be told (see ``bulk_pks_known``),
+    otherwise they are saved one by one. ``post_save`` is not sent for bulk created messages,
+    so their emails are queued or sent by ``notify_many``. With the outbox
+    enabled outbox jobs are bulk created instead of messages. All writes
+    happen in one transaction, a failure leaves no partial batch behind.
+    """
+    report = []
+    for index, row in enumerate(rows):
+        address = str(row.get('address') or '').strip()
+        via = str(row.get('via') or 'AS4').strip()
+        report.append({'row': index, 'address': address, 'via': via,
+                       'status': 'error', 'error': None, 'message': None})
+
+    resolved = resolve_addresses([entry['address'] for entry in report])
+    blocks = block_set(sender)
+
+    valid = []
+    for entry in report:
+        hit = resolved.get(entry['address'])
+        if not entry['address']:
+            entry['error'] = _(u"Missing address")
+        elif entry['via'] not in VIA_CHOICES:
+            entry['error'] = _(u"Unknown via %s") % entry['via']
+        elif hit is None:
+            entry['error'] = _(u"No user found for address %s") % entry['address']
+        elif hit.kind == WEBID and entry['via'] != 'AS4':
+            entry['error'] = _(u"You can't send a new message to a WEebID through Peppol classic ")
+        elif hit.user in blocks:
+            entry['error'] = _(u"You can't contact this user.")
+        else:
+            valid.append((entry, hit.user))
+
+    if not valid:
+        return report
+
+    check_invoice_xml()
+    with transaction.atomic():
+        Contact.objects.add_connections(sender, {user for entry, user in valid})
+        if outbox_enabled():
+            OutboxMessage.objects.bulk_create([
+                OutboxMessage(
+                    sender=sender,
+                    recipient=user,
+                    xml_type=xml_type,
+                    peppol_classic=entry['via'] != 'AS4',
+                )
+                for entry, user in valid
+            ], batch_size=batch_size)
+            status = 'queued'
+        else:
+            send_messages(sender, valid, xml_type, batch_size)
+            status = 'sent'
+    for entry, user in valid:
+        entry['status'] = status
+    return report
+
+
+def bulk_pks_known(using):
+    """
+    Whether the pks of bulk inserted rows can be told: the insert returns
+    them, or on SQLite they are read back after the insert, since the
+    writing transaction holds the lock on the whole database until it
+    commits so no one else can add rows in between.
+    """
+    connection = connections[using]
+    return connection.features.can_return_rows_from_bulk_insert or connection.vendor == 'sqlite'
+
+
+def send_messages(sender, valid, xml_type, batch_size):
+    """
+    Writes one message per ``(entry, user)`` pair and sets the message pks
+    in the report entries. Has to run in a transaction.
+    """
+    xml = store_invoice_xml(len(valid))
+    now = timezone.now()
+    messages = [
+        Message(
+            sender=sender,
+            recipient=user,
+            subject=SUBJECT,
+            body=BODY,
+            xml=xml,
+            xml_type=xml_type,
+            peppol_classic=entry['via'] != 'AS4',
+            sent_at=now,
+        )
+        for entry, user in valid
+    ]
+    if not bulk_pks_known(router.db_for_write(Message)):
+        # nothing tells which rows a bulk insert wrote, save them one by
+        # one and let the post_save receivers do the rest as for any message
+        for (entry, user), msg in zip(valid, messages):
+            msg.save()
+            entry['message'] = msg.pk
+        return
+
+    messages = Message.objects.bulk_create(messages, batch_size=batch_size)
+    if messages[0].pk is None:
+        # SQLite before RETURNING support, see bulk_pks_known. The newest
+        # rows of this sender, time and file are the ones just written.
+        pks = Message.objects.filter(sender=sender, sent_at=now, xml=xml).order_by('-pk').values_list(
+            'pk', flat=True)[:len(messages)]
+        for msg, pk in zip(messages, sorted(pks)):
+            msg.pk = pk
+    for (entry, user), msg in zip(valid, messages):
+        entry['message'] = msg.pk
+    # bulk_create skips the signal receivers keeping the unread counters
+    UnreadCount.objects.adjust(Counter(user.pk for entry, user in valid))
+
+    # bulk_create skips post_save, so summarize and index here, reading
+    # the invoice for the index once committed like index_message does
+    values = summary_fields_for(messages[0].xml)
+    InvoiceSummary.objects.bulk_create(
+        [InvoiceSummary(message=msg, **values) for msg in messages],
+        batch_size=batch_size,
+    )
+    transaction.on_commit(lambda: index_messages(messages))
+    notify_many(messages)
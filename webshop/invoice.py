@@ -0,0 +1,322 @@
+"""
+Builds Peppol BIS Billing 3.0 (UBL 2.1) invoices from order data.
+
+The document skeleton is split into fragments that are compiled once per
+process into ``(literal bytes, field)`` pairs. Writing an invoice walks
+those pairs and writes straight to a file like object, so there is no
+DOM and no string holding the whole document.
+
+An invoice is a plain dict::
+
+    {
+        'id': 'INV-1',
+        'issue_date': date(2021, 9, 1),
+        'due_date': date(2021, 10, 1),          # optional
+        'currency': 'EUR',
+        'buyer_reference': 'PO-123',            # optional
+        'supplier': PARTY,
+        'customer': PARTY,
+        'payment': {'means_code': '30', 'payment_id': 'INV-1',
+                    'account_id': 'IBAN...'},   # optional
+        'lines': [
+            {'id': '1', 'name': 'Widget', 'quantity': 2, 'unit_code': 'C62',
+             'price': '10.00', 'tax_category': 'S', 'tax_percent': '25',
+             'description': '...'},             # description optional
+        ],
+    }
+
+where a party is::
+
+    {'endpoint_id': '...', 'endpoint_scheme': '0088', 'name': '...',
+     'registration_name': '...', 'company_id': '...', 'vat_id': '...',
+     'street': '...', 'city': '...', 'postal_zone': '...', 'country': 'NL'}
+
+of which ``endpoint_id``, ``endpoint_scheme``, ``registration_name`` and
+``country`` are required.
+"""
+import io
+import re
+from decimal import ROUND_HALF_UP, Decimal
+
+from django_messages.storage import HashedContentFile
+
+CUSTOMIZATION_ID = 'urn:cen.eu:en16931:2017#compliant#urn:fdc:peppol.eu:2017:poacc:billing:3.0'
+PROFILE_ID = 'urn:fdc:peppol.eu:2017:poacc:billing:01:1.0'
+INVOICE_TYPE_CODE = '380'
+
+CENT = Decimal('0.01')
+
+FRAGMENTS = {
+    'head': (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"'
+        ' xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"'
+        ' xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">\n'
+        '<cbc:CustomizationID>' + CUSTOMIZATION_ID + '</cbc:CustomizationID>\n'
+        '<cbc:ProfileID>' + PROFILE_ID + '</cbc:ProfileID>\n'
+        '<cbc:ID>{id}</cbc:ID>\n'
+        '<cbc:IssueDate>{issue_date}</cbc:IssueDate>\n'
+    ),
+    'due_date': '<cbc:DueDate>{due_date}</cbc:DueDate>\n',
+    'type': (
+        '<cbc:InvoiceTypeCode>' + INVOICE_TYPE_CODE + '</cbc:InvoiceTypeCode>\n'
+        '<cbc:DocumentCurrencyCode>{currency}</cbc:DocumentCurrencyCode>\n'
+    ),
+    'buyer_reference': '<cbc:BuyerReference>{buyer_reference}</cbc:BuyerReference>\n',
+    'party_open': (
+        '<cac:{role}>\n<cac:Party>\n'
+        '<cbc:EndpointID schemeID="{endpoint_scheme}">{endpoint_id}</cbc:EndpointID>\n'
+    ),
+    'party_name': '<cac:PartyName>\n<cbc:Name>{name}</cbc:Name>\n</cac:PartyName>\n',
+    'party_address_open': '<cac:PostalAddress>\n',
+    'party_street': '<cbc:StreetName>{street}</cbc:StreetName>\n',
+    'party_city': '<cbc:CityName>{city}</cbc:CityName>\n',
+    'party_postal_zone': '<cbc:PostalZone>{postal_zone}</cbc:PostalZone>\n',
+    'party_address_close': (
+        '<cac:Country>\n<cbc:IdentificationCode>{country}</cbc:IdentificationCode>\n</cac:Country>\n'
+        '</cac:PostalAddress>\n'
+    ),
+    'party_vat': (
+        '<cac:PartyTaxScheme>\n<cbc:CompanyID>{vat_id}</cbc:CompanyID>\n'
+        '<cac:TaxScheme>\n<cbc:ID>VAT</cbc:ID>\n</cac:TaxScheme>\n</cac:PartyTaxScheme>\n'
+    ),
+    'party_legal_open': (
+        '<cac:PartyLegalEntity>\n'
+        '<cbc:RegistrationName>{registration_name}</cbc:RegistrationName>\n'
+    ),
+    'party_company_id': '<cbc:CompanyID>{company_id}</cbc:CompanyID>\n',
+    'party_close': '</cac:PartyLegalEntity>\n</cac:Party>\n</cac:{role}>\n',
+    'payment_means': (
+        '<cac:PaymentMeans>\n<cbc:PaymentMeansCode>{means_code}</cbc:PaymentMeansCode>\n'
+        '<cbc:PaymentID>{payment_id}</cbc:PaymentID>\n'
+    ),
+    'payment_account': (
+        '<cac:PayeeFinancialAccount>\n<cbc:ID>{account_id}</cbc:ID>\n</cac:PayeeFinancialAccount>\n'
+    ),
+    'payment_close': '</cac:PaymentMeans>\n',
+    'tax_total': (
+        '<cac:TaxTotal>\n<cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>\n'
+    ),
+    'tax_subtotal': (
+        '<cac:TaxSubtotal>\n'
+        '<cbc:TaxableAmount currencyID="{currency}">{taxable_amount}</cbc:TaxableAmount>\n'
+        '<cbc:TaxAmount currencyID="{currency}">{tax_amount}</cbc:TaxAmount>\n'
+        '<cac:TaxCategory>\n<cbc:ID>{tax_category}</cbc:ID>\n<cbc:Percent>{tax_percent}</cbc:Percent>\n'
+        '<cac:TaxScheme>\n<cbc:ID>VAT</cbc:ID>\n</cac:TaxScheme>\n</cac:TaxCategory>\n'
+        '</cac:TaxSubtotal>\n'
+    ),
+    'monetary_total': (
+        '</cac:TaxTotal>\n'
+        '<cac:LegalMonetaryTotal>\n'
+        '<cbc:LineExtensionAmount currencyID="{currency}">{line_extension_amount}</cbc:LineExtensionAmount>\n'
+        '<cbc:TaxExclusiveAmount currencyID="{currency}">{tax_exclusive_amount}</cbc:TaxExclusiveAmount>\n'
+        '<cbc:TaxInclusiveAmount currencyID="{currency}">{tax_inclusive_amount}</cbc:TaxInclusiveAmount>\n'
+        '<cbc:PayableAmount currencyID="{currency}">{payable_amount}</cbc:PayableAmount>\n'
+        '</cac:LegalMonetaryTotal>\n'
+    ),
+    'line_open': (
+        '<cac:InvoiceLine>\n<cbc:ID>{id}</cbc:ID>\n'
+        '<cbc:InvoicedQuantity unitCode="{unit_code}">{quantity}</cbc:InvoicedQuantity>\n'
+        '<cbc:LineExtensionAmount currencyID="{currency}">{line_extension_amount}</cbc:LineExtensionAmount>\n'
+        '<cac:Item>\n'
+    ),
+    'line_description': '<cbc:Description>{description}</cbc:Description>\n',
+    'line_close': (
+        '<cbc:Name>{name}</cbc:Name>\n'
+        '<cac:ClassifiedTaxCategory>\n<cbc:ID>{tax_category}</cbc:ID>\n<cbc:Percent>{tax_percent}</cbc:Percent>\n'
+        '<cac:TaxScheme>\n<cbc:ID>VAT</cbc:ID>\n</cac:TaxScheme>\n</cac:ClassifiedTaxCategory>\n'
+        '</cac:Item>\n'
+        '<cac:Price>\n<cbc:PriceAmount currencyID="{currency}">{price}</cbc:PriceAmount>\n</cac:Price>\n'
+        '</cac:InvoiceLine>\n'
+    ),
+    'tail': '</Invoice>\n',
+}
+
+# values may end up inside attribute values, so quotes are escaped too
+ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'))
+
+FIELD_RE = re.compile(r'\{(\w+)\}')
+
+_compiled = None
+
+
+class InvoiceError(ValueError):
+    pass
+
+
+def compile_fragment(fragment):
+    """
+    Splits a fragment into a tuple of ``(literal, field)`` pairs followed
+    by the trailing literal, with all literals already encoded.
+    """
+    parts = []
+    pos = 0
+    for match in FIELD_RE.finditer(fragment):
+        parts.append((fragment[pos:match.start()].encode('utf-8'), match.group(1)))
+        pos = match.end()
+    return tuple(parts), fragment[pos:].encode('utf-8')
+
+
+def get_compiled():
+    global _compiled
+    if _compiled is None:
+        _compiled = dict((key, compile_fragment(fragment)) for key, fragment in FRAGMENTS.items())
+    return _compiled
+
+
+def _value(field, values):
+    try:
+        value = values[field]
+    except KeyError:
+        raise InvoiceError("Missing invoice field '%s'" % field)
+    if value is None:
+        raise InvoiceError("Missing invoice field '%s'" % field)
+    value = str(value)
+    for char, entity in ESCAPES:
+        if char in value:
+            value = value.replace(char, entity)
+    return value.encode('utf-8')
+
+
+def write_fragment(out, key, values):
+    parts, tail = get_compiled()[key]
+    chunks = []
+    for literal, field in parts:
+        chunks.append(literal)
+        chunks.append(_value(field, values))
+    chunks.append(tail)
+    out.write(b''.join(chunks))
+
+
+def amount(value):
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def percent(value):
+    value = Decimal(value).normalize()
+    return value.quantize(Decimal(1)) if value == value.to_integral() else value
+
+
+def compute_totals(invoice):
+    """
+    Runs over the lines once and returns the line amounts, the tax
+    subtotals per (category, percent) and the document totals.
+    """
+    line_amounts = []
+    subtotals = {}
+    for line in invoice['lines']:
+        line_amount = amount(Decimal(line['quantity']) * Decimal(line['price']))
+        line_amounts.append(line_amount)
+        key = (line.get('tax_category', 'S'), percent(line.get('tax_percent', 0)))
+        subtotals[key] = subtotals.get(key, Decimal(0)) + line_amount
+
+    tax_subtotals = []
+    tax_amount = Decimal(0)
+    for (category, rate), taxable in sorted(subtotals.items()):
+        tax = amount(taxable * rate / 100)
+        tax_amount += tax
+        tax_subtotals.append({
+            'taxable_amount': amount(taxable),
+            'tax_amount': tax,
+            'tax_category': category,
+            'tax_percent': rate,
+        })
+
+    line_extension = amount(sum(line_amounts, Decimal(0)))
+    totals = {
+        'tax_amount': amount(tax_amount),
+        'line_extension_amount': line_extension,
+        'tax_exclusive_amount': line_extension,
+        'tax_inclusive_amount': amount(line_extension + tax_amount),
+        'payable_amount': amount(line_extension + tax_amount),
+    }
+    return line_amounts, tax_subtotals, totals
+
+
+def _write_party(out, role, party):
+    values = dict(party, role=role)
+    write_fragment(out, 'party_open', values)
+    if party.get('name'):
+        write_fragment(out, 'party_name', values)
+    write_fragment(out, 'party_address_open', values)
+    for field in ('street', 'city', 'postal_zone'):
+        if party.get(field):
+            write_fragment(out, 'party_' + field, values)
+    write_fragment(out, 'party_address_close', values)
+    if party.get('vat_id'):
+        write_fragment(out, 'party_vat', values)
+    write_fragment(out, 'party_legal_open', values)
+    if party.get('company_id'):
+        write_fragment(out, 'party_company_id', values)
+    write_fragment(out, 'party_close', values)
+
+
+def write_invoice(invoice, out):
+    """
+    Writes the UBL document for ``invoice`` to the binary file like ``out``.
+    """
+    if not invoice.get('lines'):
+        raise InvoiceError("An invoice needs at least one line")
+    currency = invoice.get('currency', 'EUR')
+    line_amounts, tax_subtotals, totals = compute_totals(invoice)
+
+    write_fragment(out, 'head', invoice)
+    if invoice.get('due_date'):
+        write_fragment(out, 'due_date', invoice)
+    write_fragment(out, 'type', {'currency': currency})
+    if invoice.get('buyer_reference'):
+        write_fragment(out, 'buyer_reference', invoice)
+
+    _write_party(out, 'AccountingSupplierParty', invoice['supplier'])
+    _write_party(out, 'AccountingCustomerParty', invoice['customer'])
+
+    payment = invoice.get('payment')
+    if payment:
+        payment = dict(payment)
+        payment.setdefault('means_code', '30')
+        payment.setdefault('payment_id', invoice['id'])
+        write_fragment(out, 'payment_means', payment)
+        if payment.get('account_id'):
+            write_fragment(out, 'payment_account', payment)
+        write_fragment(out, 'payment_close', payment)
+
+    totals['currency'] = currency
+    write_fragment(out, 'tax_total', totals)
+    for subtotal in tax_subtotals:
+        subtotal['currency'] = currency
+        write_fragment(out, 'tax_subtotal', subtotal)
+    write_fragment(out, 'monetary_total', totals)
+
+    for line, line_amount in zip(invoice['lines'], line_amounts):
+        values = {
+            'currency': currency,
+            'unit_code': 'C62',
+            'tax_category': 'S',
+            'tax_percent': 0,
+        }
+        values.update(line)
+        values['line_extension_amount'] = line_amount
+        values['tax_percent'] = percent(values['tax_percent'])
+        write_fragment(out, 'line_open', values)
+        if line.get('description'):
+            write_fragment(out, 'line_description', values)
+        write_fragment(out, 'line_close', values)
+
+    write_fragment(out, 'tail', invoice)
+
+
+def build_invoice(invoice):
+    """
+    Returns the UBL document for ``invoice`` as bytes.
+    """
+    out = io.BytesIO()
+    write_invoice(invoice, out)
+    return out.getvalue()
+
+
+def invoice_file(invoice):
+    """
+    Returns the built invoice as a file ready to be attached to a message,
+    e.g. ``ComposeForm().save(..., xml=invoice_file(invoice))``.
+    """
+    return HashedContentFile(build_invoice(invoice), name='%s.xml' % invoice['id'])
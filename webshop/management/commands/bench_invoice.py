@@ -0,0 +1,69 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from webshop.invoice import build_invoice, get_compiled
+
+PARTY = {
+    'endpoint_id': '9482348239847239874',
+    'endpoint_scheme': '0088',
+    'name': 'SupplierTradingName Ltd.',
+    'registration_name': 'SupplierOfficialName Ltd',
+    'company_id': 'GB983294',
+    'vat_id': 'GB1232434',
+    'street': 'Main street 1',
+    'city': 'London',
+    'postal_zone': 'GB 123 EW',
+    'country': 'GB',
+}
+
+
+def sample_invoice(line_count):
+    return {
+        'id': 'BENCH-%d' % line_count,
+        'issue_date': date(2021, 9, 1),
+        'due_date': date(2021, 10, 1),
+        'currency': 'EUR',
+        'buyer_reference': 'PO-1',
+        'supplier': PARTY,
+        'customer': dict(PARTY, endpoint_id='FR23342', endpoint_scheme='0002', country='FR'),
+        'payment': {'account_id': 'IBAN32423940'},
+        'lines': [
+            {
+                'id': str(i + 1),
+                'name': 'Item %d' % i,
+                'description': 'Description & details of item %d' % i,
+                'quantity': i % 7 + 1,
+                'price': '%d.95' % (i % 100),
+                'tax_category': 'S',
+                'tax_percent': '21' if i % 2 else '9',
+            }
+            for i in range(line_count)
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = "Measures how many invoices per second the UBL builder produces."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, nargs='+', default=[1, 100, 10000],
+            help="Invoice sizes (number of lines) to measure.")
+        parser.add_argument('--seconds', type=float, default=2.0,
+            help="Minimum time spent on each size.")
+
+    def handle(self, *args, **options):
+        get_compiled()
+        self.stdout.write("%8s %12s %14s %12s" % ("lines", "invoices", "invoices/s", "KiB/invoice"))
+        for line_count in options['lines']:
+            invoice = sample_invoice(line_count)
+            count = 0
+            size = 0
+            started = time.perf_counter()
+            elapsed = 0
+            while elapsed < options['seconds']:
+                size = len(build_invoice(invoice))
+                count += 1
+                elapsed = time.perf_counter() - started
+            self.stdout.write("%8d %12d %14.1f %12.1f" % (line_count, count, count / elapsed, size / 1024.0))
@@ -1,3 +1,239 @@
-from django.test import TestCase
+import io
+import json
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import SimpleTestCase
+from django.urls import reverse
+from lxml import etree
+
+from accounts.models import Activation
+from connection.models import Block, ConnectionRequest, Contact
+from django_messages.models import InvoiceSummary, Message, Notification, UnreadCount
+from django_messages.summary import extract_invoice_fields
+from django_messages.tests import MediaTestCase
+from django_messages.validation import InvoiceValidationError, ValidationIssue
+from webshop.bulk import dispatch_invoices
+from webshop.invoice import InvoiceError, build_invoice, compute_totals
+from webshop.views import SENDER_USERNAME
+
+
+class BulkPaymentTest(MediaTestCase):
+
+    def setUp(self):
+        super(BulkPaymentTest, self).setUp()
+        self.shop = User.objects.create(username=SENDER_USERNAME)
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def post(self, rows):
+        return self.client.post(reverse('webshop:bulk_payment'), json.dumps(rows),
+                                content_type='application/json')
+
+    def test_dispatch(self):
+        report = dispatch_invoices(self.shop, [
+            {'address': 'recipient'}, {'address': 'nobody'}, {'address': 'sender', 'via': 'peppol'}])
+        self.assertEqual([entry['status'] for entry in report], ['sent', 'error', 'sent'])
+        messages = Message.objects.order_by('pk')
+        self.assertEqual([msg.recipient for msg in messages], [self.recipient, self.sender])
+        self.assertEqual([msg.peppol_classic for msg in messages], [False, True])
+        self.assertEqual([report[0]['message'], report[2]['message']], [msg.pk for msg in messages])
+        self.assertEqual(InvoiceSummary.objects.filter(message__in=messages).count(), 2)
+
+    def test_dispatch_without_bulk_pks(self):
+        with mock.patch('webshop.bulk.bulk_pks_known', return_value=False), \
+                self.captureOnCommitCallbacks(execute=True):
+            report = dispatch_invoices(self.shop, [{'address': 'recipient'}, {'address': 'sender'}])
+        messages = Message.objects.order_by('pk')
+        self.assertEqual([entry['message'] for entry in report], [msg.pk for msg in messages])
+        self.assertEqual([msg.thread_id for msg in messages], [None, None])
+        self.assertEqual(InvoiceSummary.objects.filter(message__in=messages).count(), 2)
+        self.assertEqual(UnreadCount.objects.get(user=self.recipient).count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_dispatch_failure_writes_nothing(self):
+        with mock.patch('webshop.bulk.summary_fields_for', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                dispatch_invoices(self.shop, [{'address': 'recipient'}])
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConnectionRequest.objects.exists())
+
+    def test_invalid_invoice_writes_nothing(self):
+        issue = ValidationIssue('xsd', 'fatal', None, None, 1, 'broken')
+        with mock.patch('webshop.bulk.VALIDATE_XML', True), \
+                mock.patch('webshop.bulk.check_file', side_effect=InvoiceValidationError([issue])):
+            response = self.post(['recipient'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['issues'][0]['message'], 'broken')
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Contact.objects.exists())
+        self.assertFalse(ConnectionRequest.objects.exists())
+
+    def test_dispatch_starts_threads(self):
+        dispatch_invoices(self.shop, [{'address': 'recipient'}, {'address': 'sender'}])
+        self.assertEqual(Message.objects.filter(thread_id__isnull=True).count(), 2)
+        for msg in Message.objects.all():
+            self.assertEqual(list(Message.objects.thread_for(self.shop, msg.pk)), [msg])
+        self.assertEqual([row['message_count'] for row in Message.objects.threads_for(self.shop)], [1, 1])
+
+    def test_dispatch_notifies(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatch_invoices(self.shop, [{'address': 'recipient'}, {'address': 'sender'}])
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                         ['recipient@example.com', 'sender@example.com'])
+
+    def test_dispatch_queues_notifications(self):
+        with mock.patch('django_messages.notifications.NOTIFY_QUEUE', True):
+            dispatch_invoices(self.shop, [{'address': 'recipient'}, {'address': 'sender'}])
+        self.assertEqual(sorted(Notification.objects.values_list('recipient__username', flat=True)),
+                         ['recipient', 'sender'])
+
+    def test_missing_sender_account(self):
+        self.shop.delete()
+        response = self.post([{'address': 'recipient'}])
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Message.objects.exists())
+
+    def test_blocked_payment(self):
+        Block.objects.create(blocker=self.recipient, blocked=self.shop)
+        response = self.client.post(reverse('webshop:payment'), {'address': 'recipient', 'via': 'AS4'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['errors'], ["You can't contact this user."])
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConnectionRequest.objects.exists())
+
+    def test_blocked_rows_are_skipped(self):
+        Block.objects.create(blocker=self.shop, blocked=self.sender)
+        report = dispatch_invoices(self.shop, [{'address': 'recipient'}, {'address': 'sender'}])
+        self.assertEqual([entry['status'] for entry in report], ['sent', 'error'])
+
+    def test_sender_is_not_resolved_by_address(self):
+        Activation.objects.create(user=self.sender, code='x', peppolID=SENDER_USERNAME[:20])
+        Activation.objects.filter(user=self.sender).update(webID=SENDER_USERNAME)
+        response = self.post([{'address': 'recipient'}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.objects.get().sender, self.shop)
+
+
+UBL = {
+    'inv': 'urn:oasis:names:specification:ubl:schema:xsd:Invoice-2',
+    'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2',
+    'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
+}
+
+
+class InvoiceBuilderTest(SimpleTestCase):
+
+    def invoice(self, **kwargs):
+        invoice = {
+            'id': 'INV-1',
+            'issue_date': date(2021, 9, 1),
+            'due_date': date(2021, 10, 1),
+            'currency': 'EUR',
+            'supplier': {'endpoint_id': '1234', 'endpoint_scheme': '0088', 'name': 'Shop',
+                         'registration_name': 'Shop B.V.', 'vat_id': 'NL123B01', 'country': 'NL'},
+            'customer': {'endpoint_id': '5678', 'endpoint_scheme': '0106',
+                         'registration_name': 'Customer', 'city': 'Utrecht', 'country': 'NL'},
+            'lines': [
+                # 3 x 0.335 = 1.005 rounds half up to 1.01
+                {'id': '1', 'name': 'Screw', 'quantity': 3, 'price': '0.335',
+                 'tax_category': 'S', 'tax_percent': '21.0'},
+                {'id': '2', 'name': 'Widget', 'quantity': 1, 'price': '10.00',
+                 'tax_category': 'S', 'tax_percent': '21'},
+                {'id': '3', 'name': 'Book', 'quantity': 2, 'price': '2.50',
+                 'tax_category': 'Z', 'tax_percent': '0'},
+            ],
+        }
+        invoice.update(kwargs)
+        return invoice
+
+    def parse(self, invoice):
+        return etree.fromstring(build_invoice(invoice))
+
+    def texts(self, root, path):
+        return [elem.text for elem in root.xpath(path, namespaces=UBL)]
+
+    def test_well_formed_ubl(self):
+        root = self.parse(self.invoice())
+        self.assertEqual(root.tag, '{%s}Invoice' % UBL['inv'])
+        self.assertEqual(self.texts(root, 'cbc:ID'), ['INV-1'])
+        self.assertEqual(self.texts(root, 'cbc:IssueDate'), ['2021-09-01'])
+        self.assertEqual(self.texts(root, 'cbc:DueDate'), ['2021-10-01'])
+        self.assertEqual(self.texts(root, 'cac:AccountingSupplierParty/cac:Party/cbc:EndpointID'), ['1234'])
+        self.assertEqual(root.xpath('cac:AccountingCustomerParty/cac:Party/cbc:EndpointID/@schemeID',
+                                    namespaces=UBL), ['0106'])
+        self.assertEqual(len(root.xpath('cac:InvoiceLine', namespaces=UBL)), 3)
+
+    def test_totals(self):
+        root = self.parse(self.invoice())
+        self.assertEqual(self.texts(root, 'cac:InvoiceLine/cbc:LineExtensionAmount'),
+                         ['1.01', '10.00', '5.00'])
+        self.assertEqual(self.texts(root, 'cac:InvoiceLine/cac:Item/cac:ClassifiedTaxCategory/cbc:Percent'),
+                         ['21', '21', '0'])
+        self.assertEqual(self.texts(root, 'cac:TaxTotal/cbc:TaxAmount'), ['2.31'])
+        subtotals = root.xpath('cac:TaxTotal/cac:TaxSubtotal', namespaces=UBL)
+        self.assertEqual([(self.texts(sub, 'cac:TaxCategory/cbc:ID')[0],
+                           self.texts(sub, 'cac:TaxCategory/cbc:Percent')[0],
+                           self.texts(sub, 'cbc:TaxableAmount')[0],
+                           self.texts(sub, 'cbc:TaxAmount')[0]) for sub in subtotals],
+                         [('S', '21', '11.01', '2.31'), ('Z', '0', '5.00', '0.00')])
+        self.assertEqual(self.texts(root, 'cac:LegalMonetaryTotal/cbc:LineExtensionAmount'), ['16.01'])
+        self.assertEqual(self.texts(root, 'cac:LegalMonetaryTotal/cbc:TaxExclusiveAmount'), ['16.01'])
+        self.assertEqual(self.texts(root, 'cac:LegalMonetaryTotal/cbc:TaxInclusiveAmount'), ['18.32'])
+        self.assertEqual(self.texts(root, 'cac:LegalMonetaryTotal/cbc:PayableAmount'), ['18.32'])
+
+    def test_tax_is_rounded_per_subtotal(self):
+        # 0.05 at 25% is 0.0125 per line; rounding the subtotal gives 0.03,
+        # rounding per line would give 0.02
+        lines = [{'id': str(i), 'name': 'Pin', 'quantity': 1, 'price': '0.05', 'tax_percent': '25'}
+                 for i in range(2)]
+        line_amounts, subtotals, totals = compute_totals(self.invoice(lines=lines))
+        self.assertEqual(line_amounts, [Decimal('0.05'), Decimal('0.05')])
+        self.assertEqual(subtotals[0]['tax_amount'], Decimal('0.03'))
+        self.assertEqual(totals['payable_amount'], Decimal('0.13'))
+
+    def test_escaping(self):
+        customer = dict(self.invoice()['customer'], name='Smith & Sons <"Ltd">',
+                        registration_name='A&B "quoted" <b>')
+        lines = [{'id': '1', 'name': 'Nuts & <bolts>', 'quantity': 1, 'price': '1.00',
+                  'description': 'Size "M" & <L>'}]
+        root = self.parse(self.invoice(customer=customer, lines=lines, buyer_reference='PO "1" & 2'))
+        party = 'cac:AccountingCustomerParty/cac:Party/'
+        self.assertEqual(self.texts(root, party + 'cac:PartyName/cbc:Name'), ['Smith & Sons <"Ltd">'])
+        self.assertEqual(self.texts(root, party + 'cac:PartyLegalEntity/cbc:RegistrationName'),
+                         ['A&B "quoted" <b>'])
+        self.assertEqual(self.texts(root, 'cac:InvoiceLine/cac:Item/cbc:Name'), ['Nuts & <bolts>'])
+        self.assertEqual(self.texts(root, 'cac:InvoiceLine/cac:Item/cbc:Description'), ['Size "M" & <L>'])
+        self.assertEqual(self.texts(root, 'cbc:BuyerReference'), ['PO "1" & 2'])
+
+    def test_escaping_in_attributes(self):
+        customer = dict(self.invoice()['customer'], endpoint_scheme='"0106" & <x>')
+        root = self.parse(self.invoice(customer=customer))
+        self.assertEqual(root.xpath('cac:AccountingCustomerParty/cac:Party/cbc:EndpointID/@schemeID',
+                                    namespaces=UBL), ['"0106" & <x>'])
+
+    def test_summary_round_trip(self):
+        fields = extract_invoice_fields(io.BytesIO(build_invoice(self.invoice())))
+        self.assertEqual(fields, {
+            'document_type': 'Invoice',
+            'invoice_id': 'INV-1',
+            'issue_date': date(2021, 9, 1),
+            'due_date': date(2021, 10, 1),
+            'currency': 'EUR',
+            'seller_endpoint': '1234',
+            'seller_scheme': '0088',
+            'buyer_endpoint': '5678',
+            'buyer_scheme': '0106',
+            'payable_amount': Decimal('18.32'),
+        })
+
+    def test_missing_fields(self):
+        with self.assertRaises(InvoiceError):
+            build_invoice(self.invoice(lines=[]))
+        customer = dict(self.invoice()['customer'])
+        del customer['registration_name']
+        with self.assertRaises(InvoiceError):
+            build_invoice(self.invoice(customer=customer))
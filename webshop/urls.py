@@ -7,4 +7,7 @@ urlpatterns = [
     re_path(r'^payment/$',
             payment,
             name='payment'),
+    re_path(r'^payment/bulk/$',
+            bulk_payment,
+            name='bulk_payment'),
 ]
@@ -1,15 +1,32 @@
 from django.shortcuts import render
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
+from django.views.decorators.http import require_POST
+from django.contrib.admin.views.decorators import staff_member_required
+from .bulk import BulkParseError, dispatch_invoices, parse_rows
 from .forms import paymentForm
 from django.contrib.auth.models import User
-from accounts.models import Activation
+from accounts.resolver import WEBID, resolve_address
+from connection.exceptions import BlockedError
 from django import forms
 from django_messages.forms import ComposeForm
+from django_messages.models import OutboxMessage
+from django_messages.outbox import outbox_enabled
+from django_messages.validation import InvoiceValidationError
 from django.contrib import messages
 from django.utils.translation import gettext as _
 from django.core.files.base import ContentFile, File
 from django.core.exceptions import ObjectDoesNotExist
 
+SENDER_USERNAME = 'webshopPondersourceNet'
+
+
+def get_sender():
+    """
+    The shop's own account, by username only: the address resolver would
+    let a user claim it by setting their WebID or PeppolID to that name.
+    """
+    return User.objects.filter(username=SENDER_USERNAME).first()
+
 
 def payment(request, template_name='payment.html', form_class=ComposeForm):
 
@@ -18,14 +35,13 @@ def payment(request, template_name='payment.html', form_class=ComposeForm):
     ctx['form'] = form
 
     if request.method == 'POST':
+        recipient_UWP = None
         form_payment = paymentForm(request.POST)
         if form_payment.is_valid():
             recipient_UWP = form_payment.cleaned_data['address']
 
         form = form_class(request.POST)
         if form.is_valid():
-            sender = User.objects.get(username='webshopPondersourceNet')
-
             xml_type = 'invoice'
 
             via = request.POST['via']
@@ -35,31 +51,76 @@ def payment(request, template_name='payment.html', form_class=ComposeForm):
             else:
                 peppol_classic = True
 
-            try:
-                recipient = Activation.objects.get(webID=recipient_UWP)
-                if peppol_classic:
-                    ctx['form'] = form_class(initial={"subject": request.GET.get("subject", "")})
-                    messages.info(request, _(u"You can't send a new message to a WEebID through Peppol classic "))
-                    return render(request, template_name, ctx)
-                recipient_username = recipient.user.username
-                recipient = User.objects.get(username=recipient_username)
-            except ObjectDoesNotExist:
+            resolved = resolve_address(recipient_UWP)
+            if resolved is None:
+                ctx["errors"] = [_(u"No user found for address %s") % recipient_UWP]
+                return render(request, template_name, ctx )
+
+            if resolved.kind == WEBID and peppol_classic:
+                ctx['form'] = form_class(initial={"subject": request.GET.get("subject", "")})
+                messages.info(request, _(u"You can't send a new message to a WEebID through Peppol classic "))
+                return render(request, template_name, ctx)
+
+            recipient = resolved.user
+            sender = get_sender()
+            if sender is None:
+                ctx["errors"] = [_(u"The webshop sender account %s does not exist.") % SENDER_USERNAME]
+                return render(request, template_name, ctx)
+            if outbox_enabled():
+                OutboxMessage.objects.enqueue(sender=sender , recipient=recipient , xml_type=xml_type, peppol_classic = peppol_classic)
+                messages.info(request, _(u"Invoice queued for sending."))
+            else:
                 try:
-                    recipient = Activation.objects.get(peppolID=recipient_UWP)
-                    recipient_username = recipient.user.username
-                    recipient = User.objects.get(username=recipient_username)
-                except ObjectDoesNotExist:
-                    try:
-                        recipient = User.objects.get(username=recipient_UWP)
-                        recipient_username = recipient.username
-                    except ObjectDoesNotExist as e:
-                        ctx["errors"] = ["%s" % e]
-                        return render(request, template_name, ctx )
-
-            recipient = User.objects.get(pk=recipient.pk)
-            sender = User.objects.get(username='webshopPondersourceNet')
-            form.save(sender=sender , recipient=recipient , xml_type=xml_type, peppol_classic = peppol_classic)
-            messages.info(request, _(u"Invoice successfully sent."))
+                    form.save(sender=sender , recipient=recipient , xml_type=xml_type, peppol_classic = peppol_classic)
+                except InvoiceValidationError as e:
+                    ctx["errors"] = [issue.message for issue in e.issues]
+                    return render(request, template_name, ctx)
+                except BlockedError as e:
+                    ctx["errors"] = [str(e)]
+                    return render(request, template_name, ctx)
+                messages.info(request, _(u"Invoice successfully sent."))
             return HttpResponseRedirect('/')
 
     return render(request,template_name,ctx)
+
+
+@staff_member_required
+@require_POST
+def bulk_payment(request):
+    """
+    Sends an invoice to every address of a JSON or CSV list, either posted
+    as the request body or uploaded as ``file``. Answers with a per row
+    report.
+    """
+    if 'file' in request.FILES:
+        upload = request.FILES['file']
+        content_type = upload.content_type or ''
+        if upload.name.lower().endswith('.json'):
+            content_type = 'application/json'
+        data = upload.read()
+    else:
+        content_type = request.content_type
+        data = request.body
+
+    try:
+        rows = parse_rows(data, content_type)
+    except BulkParseError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    sender = get_sender()
+    if sender is None:
+        return JsonResponse(
+            {'error': _(u"The webshop sender account %s does not exist.") % SENDER_USERNAME}, status=500)
+    try:
+        report = dispatch_invoices(sender, rows)
+    except InvoiceValidationError as e:
+        return JsonResponse({
+            'error': _(u"The invoice is not valid"),
+            'issues': [issue._asdict() for issue in e.issues],
+        }, status=400)
+    failed = sum(1 for entry in report if entry['status'] == 'error')
+    return JsonResponse({
+        'total': len(report),
+        'failed': failed,
+        'results': report,
+    })